@@ -2,12 +2,38 @@
 基金爬蟲
 """
 import json
+import os
+import sys
 import time
 import requests
 from typing import Dict, Iterator
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'sdk'))
+from http_cache import HttpCache
 
 
 WAIT_TIME = 0.0
+_CACHE = None
+
+
+def get_cache() -> HttpCache:
+    """
+    回應快取於硬碟: 基金列表與淨值半天後重新驗證 (304 則不重新下載), 持股等資訊一週
+    CNYES_CACHE_MODE=replay 可完全離線, 只使用快取重跑
+    第一次使用時才建立 (import 本模組時不讀寫硬碟)
+    """
+    global _CACHE
+    if _CACHE is None:
+        _CACHE = HttpCache(
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), '.http_cache'),
+            ttls={
+                r'/search/fund$': 12 * 3600,
+                r'/(nav|dividend)$': 12 * 3600,
+                r'/(assets|regions|holdings|industries)$': 7 * 24 * 3600,
+            },
+            max_bytes=512 * 2 ** 20,
+            mode=os.environ.get('CNYES_CACHE_MODE', 'default'),
+        )
+    return _CACHE
 
 class MainCrawler:
     """
@@ -43,7 +69,8 @@ class MainCrawler:
             'x-platform': 'WEB',
             'x-system-kind': 'FUND-DESKTOP'
         }
-        res = requests.request(
+        res = get_cache().request(
+            requests,
             method = 'GET',
             url = url,
             headers=headers,
@@ -109,7 +136,8 @@ class NavCrawler:
             'x-platform': 'WEB',
             'x-system-kind': 'FUND-DESKTOP'
         }
-        res = requests.request(
+        res = get_cache().request(
+            requests,
             method = 'GET',
             url = url,
             headers=headers,
@@ -168,7 +196,8 @@ class DividentCrawler:
             'x-platform': 'WEB',
             'x-system-kind': 'FUND-DESKTOP'
         }
-        res = requests.request(
+        res = get_cache().request(
+            requests,
             method = 'GET',
             url = url,
             headers=headers,
@@ -226,7 +255,8 @@ class AssetsCrawler:
             'x-platform': 'WEB',
             'x-system-kind': 'FUND-DESKTOP'
         }
-        res = requests.request(
+        res = get_cache().request(
+            requests,
             method = 'GET',
             url = url,
             headers=headers
@@ -256,7 +286,8 @@ class RegionCrawler:
             'x-platform': 'WEB',
             'x-system-kind': 'FUND-DESKTOP'
         }
-        res = requests.request(
+        res = get_cache().request(
+            requests,
             method = 'GET',
             url = url,
             headers=headers
@@ -286,7 +317,8 @@ class HoldingsCrawler:
             'x-platform': 'WEB',
             'x-system-kind': 'FUND-DESKTOP'
         }
-        res = requests.request(
+        res = get_cache().request(
+            requests,
             method = 'GET',
             url = url,
             headers=headers
@@ -316,7 +348,8 @@ class IndustryCrawler:
             'x-platform': 'WEB',
             'x-system-kind': 'FUND-DESKTOP'
         }
-        res = requests.request(
+        res = get_cache().request(
+            requests,
             method = 'GET',
             url = url,
             headers=headers
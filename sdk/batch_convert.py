@@ -0,0 +1,179 @@
+"""
+Convert many JSON / HTML documents in parallel.
+
+Parsing and graph building are CPU bound, so a single converter thread is
+limited by the GIL. `convert_documents` spreads the documents over a
+`ProcessPoolExecutor` in chunks; every worker returns the converted graphs
+as `GraphBuffer`s (see graph_buffer.py), which pickle into a few flat
+arrays. A single ingestion stage then writes them through one
+`Neo4jIngestor` with `ingest_documents`.
+
+Usage:
+    documents = convert_documents('dump/*.html', id_mode='content')
+    ingest_documents(conn, documents, manifests=ManifestStore('manifests'))
+"""
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import json2cypher
+import html2cypher
+from graph_diff import sync_graph
+
+DEFAULT_CHUNK_SIZE = 16
+JSON_EXTENSIONS = ('.json',)
+HTML_EXTENSIONS = ('.html', '.htm')
+
+
+def iter_sources(documents):
+    """
+    Parameters:
+        - documents: a directory, a glob pattern, or an iterable of file paths
+            and / or `(name, payload)` tuples of JSON / HTML text.
+
+    Yields:
+        tuple: (name, path or None, payload or None)
+    """
+    if isinstance(documents, str):
+        if os.path.isdir(documents):
+            paths = sorted(
+                os.path.join(documents, name) for name in os.listdir(documents)
+                if name.lower().endswith(JSON_EXTENSIONS + HTML_EXTENSIONS)
+            )
+        else:
+            paths = sorted(glob.glob(documents, recursive=True))
+        documents = paths
+    for document in documents:
+        if isinstance(document, tuple):
+            name, payload = document
+            yield name, None, payload
+        else:
+            yield document, document, None
+
+
+def detect_kind(name, payload):
+    """
+    'json' or 'html', from the file extension or else from the first character.
+
+    Parameters:
+        - payload: the text of the document, or its bytes.
+    """
+    lowered = name.lower()
+    if lowered.endswith(JSON_EXTENSIONS):
+        return 'json'
+    if lowered.endswith(HTML_EXTENSIONS):
+        return 'html'
+    if isinstance(payload, bytes):
+        payload = payload.lstrip(b'\xef\xbb\xbf \t\r\n')
+        return 'json' if payload[:1] in (b'{', b'[') else 'html'
+    return 'json' if payload.lstrip('\ufeff \t\r\n')[:1] in ('{', '[') else 'html'
+
+
+def convert_document(name, path=None, payload=None, id_mode='content', json_options=None, html_options=None):
+    """
+    Convert one document into a GraphBuffer.
+
+    Parameters:
+        - name: name of the document, also the `source` of its content ids.
+        - path / payload: where to read the document from, or its text / bytes.
+            Files are read as bytes, so that the encoding of a page (e.g.
+            Big5 / cp950) is detected by the HTML parser and the one of a JSON
+            document (UTF-8 / 16 / 32) by `json.loads`.
+        - id_mode: see graph_ids.py.
+        - json_options: extra arguments of `json_to_graph` (e.g. `uniform_lists`).
+        - html_options: extra arguments of `html_to_graph` (e.g. `attributes`).
+
+    Returns:
+        dict: {'name', 'kind', 'roots', 'graph', 'error'}
+    """
+    document = {'name': name, 'kind': None, 'roots': None, 'graph': None, 'error': None}
+    try:
+        if payload is None:
+            with open(path, 'rb') as f:
+                payload = f.read()
+        document['kind'] = detect_kind(name, payload)
+        if document['kind'] == 'json':
+            graph = json2cypher.json_to_graph_buffer(
+                json.loads(payload), id_mode=id_mode, source=name, **(json_options or {}))
+            document['roots'] = [graph.node_id(0)] if graph.node_count else []
+        else:
+            document['roots'], graph = html2cypher.html_to_graph_buffer(
+                payload, id_mode=id_mode, source=name, **(html_options or {}))
+        document['graph'] = graph
+    except Exception as e:
+        document['error'] = f'{type(e).__name__}: {e}'
+    return document
+
+
+def _convert_chunk(sources, id_mode, json_options, html_options):
+    return [
+        convert_document(name, path, payload, id_mode=id_mode, json_options=json_options, html_options=html_options)
+        for name, path, payload in sources
+    ]
+
+
+def convert_documents(documents, id_mode='content', json_options=None, html_options=None, n_process=None,
+                      chunk_size=DEFAULT_CHUNK_SIZE, max_pending=None):
+    """
+    Convert documents across a process pool.
+
+    Parameters:
+        - documents: see `iter_sources`. Files are read by the workers, so only
+            their paths and the converted graphs cross process boundaries.
+        - id_mode, json_options, html_options: see `convert_document`.
+        - n_process: number of worker processes, defaults to the number of cores.
+        - chunk_size: documents sent to a worker at a time.
+        - max_pending: chunks dispatched ahead of the consumer, defaults to
+            twice the number of workers, which bounds the memory held by results.
+
+    Yields:
+        the dicts of `convert_document`, in completion order.
+    """
+    n_process = n_process or os.cpu_count() or 1
+    max_pending = max_pending or 2 * n_process
+    sources = iter_sources(documents)
+    with ProcessPoolExecutor(max_workers=n_process) as executor:
+        pending = set()
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < max_pending:
+                chunk = [source for _, source in zip(range(chunk_size), sources)]
+                if not chunk:
+                    exhausted = True
+                    break
+                pending.add(executor.submit(_convert_chunk, chunk, id_mode, json_options, html_options))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+
+
+def ingest_documents(conn, documents, n_thread=1, manifests=None):
+    """
+    Single ingestion stage for the output of `convert_documents`.
+
+    Parameters:
+        - conn: Neo4jIngestor
+        - documents: the dicts of `convert_document`.
+        - manifests: a `ManifestStore`, to write only what changed since the
+            last ingestion of each document (needs `id_mode='content'`).
+
+    Returns:
+        list: the documents which failed to convert.
+    """
+    failed = []
+    for document in documents:
+        if document['error'] is not None:
+            print(f"{document['name']}: {document['error']}")
+            failed.append(document)
+            continue
+        graph = document['graph']
+        converter = json2cypher if document['kind'] == 'json' else html2cypher
+        if manifests is not None:
+            sync_graph(
+                conn, manifests, document['name'], graph.nodes, graph.links, converter.item_to_row,
+                converter.node_to_record, converter.link_to_record, n_thread=n_thread)
+        else:
+            conn.ingest_batch(graph, converter.item_to_row, desc=document['name'], n_thread=n_thread)
+    return failed
@@ -0,0 +1,209 @@
+"""
+Pool of headless browsers for capturing pages with selenium-wire.
+
+Resolving the chromedriver and starting Chrome take longer than loading a
+page, so `BrowserPool` launches its browsers once and lends them out:
+- the driver path is resolved once per process (see `driver_path`),
+- a browser is handed out clean: no recorded requests, nor cookies or
+    storage of any site left by the previous page,
+- a browser is relaunched after `max_pages` pages, or as soon as it crashed,
+- `map` runs a function over many urls on all the browsers in parallel.
+
+Usage:
+    with BrowserPool(size=4) as pool:
+        records = pool.map(lambda driver, url: ..., urls)
+"""
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from seleniumwire import webdriver
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.chrome.service import Service
+from webdriver_manager.chrome import ChromeDriverManager
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_MAX_PAGES = 50
+DEFAULT_CHROME_ARGUMENTS = ('--headless=new', '--disable-gpu', '--disable-dev-shm-usage', '--no-sandbox')
+
+_driver_path = None
+_driver_path_lock = threading.Lock()
+
+
+def driver_path():
+    """
+    Path of the chromedriver: `$CHROMEDRIVER_PATH`, or the one
+    `ChromeDriverManager` installs, resolved once per process.
+    """
+    global _driver_path
+    with _driver_path_lock:
+        if _driver_path is None:
+            _driver_path = os.environ.get('CHROMEDRIVER_PATH') or ChromeDriverManager().install()
+        return _driver_path
+
+
+class BrowserPool:
+    """
+    Parameters:
+        - size: number of browsers.
+        - max_pages: pages a browser loads before it is relaunched, which
+            bounds the memory Chrome and the selenium-wire proxy accumulate.
+        - chrome_arguments: command line arguments of Chrome, headless by default.
+        - seleniumwire_options: see selenium-wire (e.g. `{'disable_encoding': True}`).
+    """
+    def __init__(self, size=DEFAULT_POOL_SIZE, max_pages=DEFAULT_MAX_PAGES, chrome_arguments=DEFAULT_CHROME_ARGUMENTS,
+                 seleniumwire_options=None):
+        self.size = size
+        self.max_pages = max_pages
+        self.chrome_arguments = chrome_arguments
+        self.seleniumwire_options = seleniumwire_options or {}
+        # idle browsers as [driver, number of pages loaded]; None is a slot to launch
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(None)
+        self._lock = threading.Lock()
+        self._drivers = []
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def launch(self):
+        """Start a new browser."""
+        options = webdriver.ChromeOptions()
+        for argument in self.chrome_arguments:
+            options.add_argument(argument)
+        return webdriver.Chrome(
+            service=Service(executable_path=driver_path()),
+            options=options,
+            seleniumwire_options=self.seleniumwire_options,
+        )
+
+    def start(self):
+        """Launch all the browsers up front, in parallel, rather than on first use."""
+        slots = [self._idle.get() for _ in range(self.size)]
+        try:
+            with ThreadPoolExecutor(max_workers=self.size) as executor:
+                for i, driver in enumerate(executor.map(lambda slot: None if slot else self._launched(), slots)):
+                    if driver is not None:
+                        slots[i] = [driver, 0]
+        finally:
+            # browsers which failed to launch are launched again on first use
+            for slot in slots:
+                self._idle.put(slot)
+        return self
+
+    def _launched(self):
+        driver = self.launch()
+        with self._lock:
+            self._drivers.append(driver)
+        return driver
+
+    def _quit(self, driver):
+        with self._lock:
+            if driver in self._drivers:
+                self._drivers.remove(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    @staticmethod
+    def reset(driver):
+        """
+        Leave the page, dropping the cookies and storage of every origin (not
+        only of the page left, which is all `delete_all_cookies` reaches),
+        the recorded requests and the capture policy.
+
+        Raises `WebDriverException` when the browser does not speak the Chrome
+        DevTools Protocol, the browser being relaunched instead (see `browser`).
+        """
+        driver.get('about:blank')
+        driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+        driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin': '*', 'storageTypes': 'all'})
+        del driver.requests
+        driver.scopes = []
+        driver.request_interceptor = None
+
+    @contextmanager
+    def browser(self):
+        """
+        Borrow a clean browser, waiting for one to be idle.
+
+        A browser raising a `WebDriverException` (crash, lost session...) is
+        thrown away and replaced by a new one on the next use. So is a
+        browser which cannot be reset once it is given back, without
+        failing the work already done with it.
+        """
+        if self.closed:
+            raise RuntimeError('The browser pool is closed')
+        slot = self._idle.get()
+        try:
+            if slot is None:
+                slot = [self._launched(), 0]
+            driver = slot[0]
+            yield driver
+            slot[1] += 1
+        except WebDriverException:
+            if slot is not None:
+                self._quit(slot[0])
+            slot = None
+            raise
+        finally:
+            if slot is not None:
+                slot = self._given_back(slot)
+            self._idle.put(slot)
+
+    def _given_back(self, slot):
+        """
+        Reset a browser given back (whatever state its page was left in),
+        or quit it when it is due for relaunch or cannot be reset.
+
+        Returns:
+            the slot to put back on the idle queue.
+        """
+        if slot[1] >= self.max_pages:
+            self._quit(slot[0])
+            return None
+        try:
+            self.reset(slot[0])
+        except Exception:
+            # WebDriverException, or a connection error when the driver process is gone
+            self._quit(slot[0])
+            return None
+        return slot
+
+    def run(self, func, url, retries=1):
+        """
+        `func(driver, url)` on a borrowed browser, retried on another browser
+        when the first one crashes.
+        """
+        for attempt in range(retries + 1):
+            try:
+                with self.browser() as driver:
+                    return func(driver, url)
+            except WebDriverException:
+                if attempt == retries:
+                    raise
+
+    def map(self, func, urls, retries=1):
+        """
+        `run(func, url)` for every url, on all the browsers in parallel.
+
+        Returns:
+            list: the results, in the order of `urls`.
+        """
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            return list(executor.map(lambda url: self.run(func, url, retries=retries), urls))
+
+    def close(self):
+        """Quit every browser."""
+        self.closed = True
+        with self._lock:
+            drivers = list(self._drivers)
+        for driver in drivers:
+            self._quit(driver)
@@ -0,0 +1,452 @@
+"""
+Offline bulk-import files for the converter output.
+
+For initial loads of many pages, transactional Cypher is the wrong tool.
+The writers below take the nodes / links produced by `json_to_graph`,
+`html_to_graph` and `webpage_to_graph` (lists or streams) and serialize them
+incrementally, so that one server-side import replaces thousands of client
+round trips:
+
+- `CsvBulkExporter`: header + data CSV files in the `neo4j-admin database import`
+    format, one pair of files per label set and per relationship type.
+- `GraphMLWriter`: a GraphML document for `apoc.import.graphml`.
+- `ApocJsonlWriter`: JSON lines for `apoc.import.json`.
+
+All of them can gzip their output.
+
+Usage:
+    exporter = CsvBulkExporter('import', json2cypher.node_to_record, json2cypher.link_to_record)
+    exporter.write(json2cypher.iter_json_graph(data))
+    exporter.close()
+    print(' '.join(exporter.command()))
+"""
+import csv
+import gzip
+import json
+import os
+import re
+from xml.sax.saxutils import escape, quoteattr
+from neo4j_ingestor import NODE_LABEL, is_link
+
+# neo4j-admin defaults
+ARRAY_DELIMITER = ';'
+LABEL_DELIMITER = ';'
+
+
+def default_node_to_record(node):
+    """
+    Labels and properties of a node without a converter specific record function:
+    the `type` becomes the label and every scalar / list value a property.
+    """
+    properties = {
+        key: value for key, value in node.items()
+        if isinstance(value, (str, int, float, bool, list))
+    }
+    return [node['type']], properties
+
+
+def default_link_to_record(link):
+    return link['type'], {}
+
+
+def _scalar_type(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'long'
+    if isinstance(value, float):
+        return 'double'
+    return 'string'
+
+
+def _merge_types(first, second):
+    """
+    Type holding the values of two types, None standing for no value yet:
+    integers and floats widen to double, any other conflict to string.
+    """
+    if first is None or first == second:
+        return second
+    if second is None:
+        return first
+    if {first, second} == {'long', 'double'}:
+        return 'double'
+    return 'string'
+
+
+def _field_type(value, previous=None):
+    """
+    Column type of a property given one more of its values.
+
+    Parameters:
+        - value: the new value.
+        - previous: the `(type, is_array)` of the values seen so far, or None.
+
+    Returns:
+        tuple: (type, is_array), type being None while only nulls were seen.
+    """
+    base, is_array = previous or (None, False)
+    if isinstance(value, list):
+        # typed arrays, e.g. the columns of a json2cypher Table node, a scalar
+        # met in the same column is read as a one element array
+        for element in value:
+            base = _merge_types(base, 'string' if isinstance(element, list) else _scalar_type(element))
+        return base, True
+    return _merge_types(base, _scalar_type(value)), is_array
+
+
+def _type_name(field_type):
+    base, is_array = field_type
+    return (base or 'string') + ('[]' if is_array else '')
+
+
+def _file_name(name):
+    return re.sub(r'[^0-9A-Za-z_.-]+', '_', name) or '_'
+
+
+def _open_text(path, mode, compress):
+    if compress:
+        return gzip.open(path, mode + 't', newline='', encoding='utf-8')
+    return open(path, mode, newline='', encoding='utf-8')
+
+
+class _RecordWriter:
+    """
+    Common part of the writers: turns nodes / links into records with the
+    converter specific `node_to_record` / `link_to_record` functions.
+    """
+    def __init__(self, node_to_record, link_to_record, base_labels):
+        self.node_to_record = node_to_record
+        self.link_to_record = link_to_record
+        self.base_labels = list(base_labels)
+
+    def node_record(self, node):
+        """
+        Returns:
+            tuple: (node id, labels, properties without the id)
+        """
+        labels, properties = self.node_to_record(node)
+        labels = self.base_labels + [label for label in labels if label not in self.base_labels]
+        properties = dict(properties)
+        node_id = properties.pop('id')
+        return node_id, labels, properties
+
+    def write(self, items):
+        """
+        Write a list or a stream of nodes and links (e.g. `iter_html_graph`).
+        """
+        for item in items:
+            if is_link(item):
+                self.write_link(item)
+            else:
+                self.write_node(item)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _CsvFile:
+    """
+    One header file and one data file. The columns are fixed by the first
+    row written, since the header of a label set / type never changes, but
+    their types are worked out over all the rows (see `_merge_types`), so
+    the header is only written by `close()`.
+    """
+    def __init__(self, directory, name, leading_columns, properties, compress):
+        self.columns = list(properties)
+        self.leading_columns = leading_columns
+        self.types = dict.fromkeys(self.columns)
+        self.header_path = os.path.join(directory, f'{name}.header.csv')
+        self.data_path = os.path.join(directory, f'{name}.csv' + ('.gz' if compress else ''))
+        self.file = _open_text(self.data_path, 'w', compress)
+        self.writer = csv.writer(self.file)
+        self.count = 0
+
+    def write(self, leading_values, properties):
+        unknown = set(properties) - set(self.columns)
+        if unknown:
+            raise ValueError(f'{self.data_path}: properties {sorted(unknown)} are not in the header {self.columns}')
+        values = []
+        for column in self.columns:
+            value = properties.get(column)
+            self.types[column] = _field_type(value, self.types[column])
+            if value is None:
+                values.append('')
+            elif isinstance(value, list):
+                values.append(ARRAY_DELIMITER.join(
+                    ('true' if element else 'false') if isinstance(element, bool) else str(element) for element in value
+                ))
+            elif isinstance(value, bool):
+                values.append('true' if value else 'false')
+            else:
+                values.append(value)
+        self.writer.writerow(leading_values + values)
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+        with open(self.header_path, 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerow(
+                self.leading_columns + [f'{column}:{_type_name(self.types[column])}' for column in self.columns]
+            )
+
+
+class CsvBulkExporter(_RecordWriter):
+    """
+    Parameters:
+        - directory: where the `nodes/` and `relationships/` files are written.
+        - node_to_record: maps a node into `(labels, properties)`, e.g. `json2cypher.node_to_record`.
+        - link_to_record: maps a link into `(type, properties)`.
+        - base_labels: labels added to every node, `:Node` by default so that the
+            imported graph matches the one written through `Neo4jIngestor`.
+        - compress: gzip the data files.
+    """
+    def __init__(self, directory, node_to_record=default_node_to_record, link_to_record=default_link_to_record,
+                 base_labels=(NODE_LABEL,), compress=False):
+        super().__init__(node_to_record, link_to_record, base_labels)
+        self.directory = directory
+        self.compress = compress
+        self.node_files = {}
+        self.link_files = {}
+        self.file_names = set()
+        os.makedirs(os.path.join(directory, 'nodes'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'relationships'), exist_ok=True)
+
+    def write_node(self, node):
+        node_id, labels, properties = self.node_record(node)
+        # nodes of one label set may carry different properties (e.g. json2cypher
+        # Table / Row nodes), each property set gets its own header
+        key = tuple(labels), tuple(sorted(properties))
+        if key not in self.node_files:
+            self.node_files[key] = _CsvFile(
+                os.path.join(self.directory, 'nodes'), self._unique_name('_'.join(labels)),
+                ['id:ID', ':LABEL'], properties, self.compress
+            )
+        self.node_files[key].write([node_id, LABEL_DELIMITER.join(labels)], properties)
+
+    def write_link(self, link):
+        link_type, properties = self.link_to_record(link)
+        key = link_type, tuple(sorted(properties))
+        if key not in self.link_files:
+            self.link_files[key] = _CsvFile(
+                os.path.join(self.directory, 'relationships'), self._unique_name(link_type),
+                [':START_ID', ':END_ID', ':TYPE'], properties, self.compress
+            )
+        self.link_files[key].write([link['source'], link['target'], link_type], properties)
+
+    def _unique_name(self, name):
+        """
+        File name for a label set / type, which must stay distinct after
+        the characters not allowed in file names are replaced.
+        """
+        name = _file_name(name)
+        unique_name = name
+        i = 1
+        while unique_name in self.file_names:
+            unique_name = f'{name}.{i}'
+            i += 1
+        self.file_names.add(unique_name)
+        return unique_name
+
+    def close(self):
+        for csv_file in list(self.node_files.values()) + list(self.link_files.values()):
+            csv_file.close()
+
+    def counts(self):
+        """
+        Returns:
+            dict: number of rows written per data file.
+        """
+        return {
+            csv_file.data_path: csv_file.count
+            for csv_file in list(self.node_files.values()) + list(self.link_files.values())
+        }
+
+    def command(self, database='neo4j'):
+        """
+        Returns:
+            list: the `neo4j-admin database import full` command for the written files.
+        """
+        args = ['neo4j-admin', 'database', 'import', 'full', '--multiline-fields=true']
+        for csv_file in self.node_files.values():
+            args.append(f'--nodes={csv_file.header_path},{csv_file.data_path}')
+        for (link_type, _), csv_file in self.link_files.items():
+            args.append(f'--relationships={link_type}={csv_file.header_path},{csv_file.data_path}')
+        args.append(database)
+        return args
+
+
+def export_csv(directory, items, node_to_record=default_node_to_record, link_to_record=default_link_to_record,
+               base_labels=(NODE_LABEL,), compress=False):
+    """
+    Write `items` (nodes and links, list or stream) and return the exporter
+    so that its `counts()` / `command()` can be inspected.
+    """
+    exporter = CsvBulkExporter(directory, node_to_record, link_to_record, base_labels, compress)
+    try:
+        exporter.write(items)
+    finally:
+        exporter.close()
+    return exporter
+
+
+# characters that are not allowed in XML 1.0 documents
+_INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+def _xml_text(value):
+    return escape(_INVALID_XML_CHARS.sub('', str(value)))
+
+
+class GraphMLWriter(_RecordWriter):
+    """
+    Streams nodes / links into a GraphML document readable by
+    `apoc.import.graphml(path, {readLabels: true, storeNodeIds: true})`.
+
+    GraphML declares its `<key>`s, with their types, before the graph, but
+    they are only known once every item is seen: a property first met as a
+    scalar may hold a list later on. Nodes and edges are therefore written
+    as JSON lines to a temporary body file as they come, and `close()`
+    writes the keys followed by the body, each value encoded according to
+    the final type of its key, so memory use does not depend on the size
+    of the graph.
+    """
+    def __init__(self, path, node_to_record=default_node_to_record, link_to_record=default_link_to_record,
+                 base_labels=(NODE_LABEL,), compress=False):
+        super().__init__(node_to_record, link_to_record, base_labels)
+        self.path = path
+        self.compress = compress
+        self.body_path = path + '.body'
+        self.body = open(self.body_path, 'w', encoding='utf-8')
+        # (for, name) -> (type, is_array) worked out over all the values (see
+        # `_field_type`), key ids are prefixed by n_ / e_
+        self.keys = {}
+        self.n_edge = 0
+
+    def _observe(self, domain, properties):
+        for name, value in properties.items():
+            if value is not None:
+                self.keys[(domain, name)] = _field_type(value, self.keys.get((domain, name)))
+
+    def _data(self, domain, properties):
+        data = []
+        for name, value in properties.items():
+            if value is None:
+                continue
+            if self.keys[(domain, name)][1]:
+                # list keys hold JSON arrays, a scalar of the same key becomes a one element list
+                elements = value if isinstance(value, list) else [value]
+                value = json.dumps([str(element) for element in elements], ensure_ascii=False)
+            elif isinstance(value, bool):
+                value = 'true' if value else 'false'
+            data.append(f'<data key={quoteattr(domain[0] + "_" + name)}>{_xml_text(value)}</data>')
+        return ''.join(data)
+
+    def _dump(self, record):
+        self.body.write(json.dumps(record, ensure_ascii=False, default=str))
+        self.body.write('\n')
+
+    def write_node(self, node):
+        node_id, labels, properties = self.node_record(node)
+        label_str = ''.join(':' + label for label in labels)
+        properties = dict(properties, labels=label_str)
+        self._observe('node', properties)
+        self._dump(['node', node_id, label_str, properties])
+
+    def write_link(self, link):
+        link_type, properties = self.link_to_record(link)
+        properties = dict(properties, label=link_type)
+        self._observe('edge', properties)
+        self._dump(['edge', link['source'], link['target'], link_type, properties])
+
+    def _element(self, record):
+        if record[0] == 'node':
+            _, node_id, label_str, properties = record
+            data = self._data('node', properties)
+            return f'<node id={quoteattr(node_id)} labels={quoteattr(label_str)}>{data}</node>\n'
+        _, source, target, link_type, properties = record
+        element = (
+            f'<edge id="e{self.n_edge}" source={quoteattr(source)} target={quoteattr(target)} '
+            f'label={quoteattr(link_type)}>{self._data("edge", properties)}</edge>\n'
+        )
+        self.n_edge += 1
+        return element
+
+    def close(self):
+        self.body.close()
+        with _open_text(self.path, 'w', self.compress) as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            f.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+            for (domain, name), (key_type, is_array) in self.keys.items():
+                if is_array:
+                    key_type, list_attr = 'string', ' attr.list="string"'
+                else:
+                    list_attr = ''
+                f.write(
+                    f'<key id={quoteattr(domain[0] + "_" + name)} for="{domain}" attr.name={quoteattr(name)} '
+                    f'attr.type="{key_type or "string"}"{list_attr}/>\n'
+                )
+            f.write('<graph id="G" edgedefault="directed">\n')
+            with open(self.body_path, 'r', encoding='utf-8') as body:
+                for line in body:
+                    f.write(self._element(json.loads(line)))
+            f.write('</graph>\n</graphml>\n')
+        os.remove(self.body_path)
+
+    def cypher(self):
+        compression = ", compression: 'GZIP'" if self.compress else ''
+        return (
+            f"CALL apoc.import.graphml({json.dumps(self.path)}, "
+            f"{{readLabels: true, storeNodeIds: true{compression}}});"
+        )
+
+
+class ApocJsonlWriter(_RecordWriter):
+    """
+    Streams nodes / links as JSON lines readable by
+    `apoc.import.json(path, {importIdName: 'id'})`.
+
+    Relationship endpoints are referenced by id and by the base labels only
+    (`:Node`), which every converter node carries, so no id -> labels map
+    has to be kept in memory.
+    """
+    def __init__(self, path, node_to_record=default_node_to_record, link_to_record=default_link_to_record,
+                 base_labels=(NODE_LABEL,), compress=False):
+        super().__init__(node_to_record, link_to_record, base_labels)
+        self.path = path
+        self.compress = compress
+        self.file = _open_text(path, 'w', compress)
+        self.n_relationship = 0
+
+    def _dump(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False, default=str))
+        self.file.write('\n')
+
+    def write_node(self, node):
+        node_id, labels, properties = self.node_record(node)
+        self._dump({'type': 'node', 'id': node_id, 'labels': labels, 'properties': properties})
+
+    def write_link(self, link):
+        link_type, properties = self.link_to_record(link)
+        self._dump({
+            'type': 'relationship',
+            'id': link.get('id', str(self.n_relationship)),
+            'label': link_type,
+            'properties': properties,
+            'start': {'id': link['source'], 'labels': self.base_labels},
+            'end': {'id': link['target'], 'labels': self.base_labels}
+        })
+        self.n_relationship += 1
+
+    def close(self):
+        self.file.close()
+
+    def cypher(self):
+        # the record ids are imported as the `id` property the `:Node(id)`
+        # constraint and the ingestion / diff queries match on
+        compression = ", compression: 'GZIP'" if self.compress else ''
+        return f"CALL apoc.import.json({json.dumps(self.path)}, {{importIdName: 'id'{compression}}});"
@@ -0,0 +1,150 @@
+"""
+What the browser is allowed to download while a page is captured.
+
+Without a policy the browser loads everything (images, fonts, videos, ads,
+analytics...) before the endpoints are filtered. A `CapturePolicy` is
+applied to the selenium-wire driver instead:
+- blocked requests are aborted in flight by a request interceptor, so
+    they cost neither bandwidth nor loading time,
+- requests outside the `scopes` are let through but not recorded,
+- `allows` filters the recorded requests the same way.
+
+A request is blocked when its domain is not in `allow_domains` (if given)
+or is in `deny_domains`, domains being matched by suffix
+(`google.com` covers `www.google.com`), or when its resource type (from the
+`Sec-Fetch-Dest` header Chrome sends, otherwise its extension) is in
+`block_resource_types`, or when its extension is in `block_extensions`.
+
+Usage:
+    policy = CapturePolicy(allow_domains=['cnyes.com'], block_resource_types=['image', 'font', 'media', 'stylesheet'])
+    records = get_webpage_records(url, policy=policy)
+"""
+import os
+import re
+from urllib.parse import urlsplit
+
+RESOURCE_TYPES = ('document', 'script', 'stylesheet', 'image', 'font', 'media', 'xhr', 'other')
+# replaces the former 'google' / 'facebook' substring filter of get_webpage_records,
+# with the CDN / API domains it also excluded
+DEFAULT_DENY_DOMAINS = (
+    'google.com', 'google-analytics.com', 'googletagmanager.com', 'googlesyndication.com', 'googleadservices.com',
+    'google.com.tw', 'googleapis.com', 'googleusercontent.com', 'googlevideo.com', 'gstatic.com', 'doubleclick.net',
+    'facebook.com', 'facebook.net', 'fbcdn.net',
+)
+DEFAULT_BLOCK_RESOURCE_TYPES = ('image', 'font', 'media')
+# value of the Sec-Fetch-Dest request header -> resource type
+_DESTINATION_TYPES = {
+    'document': 'document', 'iframe': 'document', 'frame': 'document',
+    'script': 'script', 'worker': 'script', 'sharedworker': 'script', 'serviceworker': 'script',
+    'style': 'stylesheet',
+    'image': 'image',
+    'font': 'font',
+    'video': 'media', 'audio': 'media', 'track': 'media',
+    'empty': 'xhr',
+}
+_EXTENSION_TYPES = {
+    **dict.fromkeys(('.html', '.htm'), 'document'),
+    **dict.fromkeys(('.js', '.mjs'), 'script'),
+    '.css': 'stylesheet',
+    **dict.fromkeys(('.png', '.jpg', '.jpeg', '.gif', '.webp', '.avif', '.svg', '.ico', '.bmp'), 'image'),
+    **dict.fromkeys(('.woff', '.woff2', '.ttf', '.otf', '.eot'), 'font'),
+    **dict.fromkeys(('.mp4', '.webm', '.m3u8', '.ts', '.mp3', '.ogg', '.wav', '.vtt'), 'media'),
+    **dict.fromkeys(('.json', '.xml'), 'xhr'),
+}
+
+
+def _domains(domains):
+    return tuple(domain.strip().lower().lstrip('.') for domain in domains)
+
+
+def domain_matches(host, domains):
+    """Whether `host` is one of `domains` or a subdomain of one of them."""
+    host = host.lower().rstrip('.')
+    return any(host == domain or host.endswith('.' + domain) for domain in domains)
+
+
+def resource_type(url, headers=None):
+    """
+    Resource type of a request, one of `RESOURCE_TYPES`.
+
+    Parameters:
+        - url: of the request.
+        - headers: of the request, `Sec-Fetch-Dest` being preferred to the extension.
+    """
+    for name, value in (headers or {}).items():
+        if name.lower() == 'sec-fetch-dest' and value.lower() in _DESTINATION_TYPES:
+            return _DESTINATION_TYPES[value.lower()]
+    return _EXTENSION_TYPES.get(os.path.splitext(urlsplit(url).path)[-1].lower(), 'other')
+
+
+class CapturePolicy:
+    """
+    Parameters:
+        - allow_domains: only these domains (and their subdomains) are loaded,
+            empty for every domain.
+        - deny_domains: domains (and their subdomains) never loaded.
+        - block_resource_types: resource types never loaded, see `RESOURCE_TYPES`.
+        - block_extensions: url extensions never loaded, e.g. `['.pdf']`.
+        - scopes: url regexes of the requests recorded, by default the ones of
+            `allow_domains`, or all of them.
+    """
+    def __init__(self, allow_domains=(), deny_domains=DEFAULT_DENY_DOMAINS,
+                 block_resource_types=DEFAULT_BLOCK_RESOURCE_TYPES, block_extensions=(), scopes=None):
+        unknown = set(block_resource_types) - set(RESOURCE_TYPES)
+        if unknown:
+            raise ValueError(f'block_resource_types should be among {RESOURCE_TYPES} rather than {sorted(unknown)}')
+        self.allow_domains = _domains(allow_domains)
+        self.deny_domains = _domains(deny_domains)
+        self.block_resource_types = tuple(block_resource_types)
+        self.block_extensions = tuple(
+            (extension if extension.startswith('.') else '.' + extension).lower() for extension in block_extensions)
+        if scopes is None:
+            scopes = [
+                rf'^[a-z]+://([^/?#]*\.)?{re.escape(domain)}(:\d+)?([/?#]|$)' for domain in self.allow_domains
+            ]
+        for scope in scopes:
+            re.compile(scope)
+        self.scopes = list(scopes)
+
+    def __repr__(self):
+        return f'CapturePolicy({self.to_dict()})'
+
+    def to_dict(self):
+        """The policy as kept with every captured record (see `requests2cypher.driver_records`)."""
+        return {
+            'allow_domains': list(self.allow_domains),
+            'deny_domains': list(self.deny_domains),
+            'block_resource_types': list(self.block_resource_types),
+            'block_extensions': list(self.block_extensions),
+            'scopes': self.scopes,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def allows(self, url, headers=None):
+        """Whether a request may be sent."""
+        host = urlsplit(url).hostname or ''
+        if self.allow_domains and not domain_matches(host, self.allow_domains):
+            return False
+        if domain_matches(host, self.deny_domains):
+            return False
+        if self.block_extensions and os.path.splitext(urlsplit(url).path)[-1].lower() in self.block_extensions:
+            return False
+        if self.block_resource_types and resource_type(url, headers) in self.block_resource_types:
+            return False
+        return True
+
+    def interceptor(self, request):
+        """selenium-wire `request_interceptor` aborting the requests not allowed."""
+        if not self.allows(request.url, request.headers):
+            request.abort()
+
+    def apply(self, driver):
+        """Apply the policy to the next pages a selenium-wire driver loads."""
+        driver.scopes = self.scopes
+        driver.request_interceptor = self.interceptor
+
+
+DEFAULT_POLICY = CapturePolicy()
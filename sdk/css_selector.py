@@ -0,0 +1,139 @@
+"""
+A small CSS selector matcher for the HTML converters.
+
+Selectors are matched while a document is walked, against the tag and
+attributes of an element and the ones of its open ancestors, so no tree
+(and no soupsieve / lxml.cssselect) is needed. Supported:
+- type `div`, universal `*`, `#id`, `.class`,
+- attributes `[name]`, `[name=value]`, `[name~=value]`, `[name|=value]`,
+    `[name^=value]`, `[name$=value]`, `[name*=value]`,
+- compounds `div.ad[data-id]`, the descendant ` ` and child `>`
+    combinators, and selector lists `script, style`.
+
+Usage:
+    selector = CssSelector('div.sidebar > ul')
+    selector.matches('ul', {}, [('html', {}), ('div', {'class': ['sidebar']})])
+"""
+import re
+
+_TOKENS = re.compile(r'''
+    \s*(?P<comma>,)\s*
+    | \s*(?P<child>>)\s*
+    | (?P<space>\s+)
+    | (?P<tag>[\w*][\w-]*)
+    | \#(?P<id>[\w-]+)
+    | \.(?P<class_>[\w-]+)
+    | \[\s*(?P<attr>[^\s~|^$*=\]]+)\s*
+        (?:(?P<op>[~|^$*]?=)\s*(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<value>[^\]\s]*))\s*)?\]
+''', re.VERBOSE)
+
+_OPERATORS = {
+    None: lambda value, expected: True,
+    '=': lambda value, expected: value == expected,
+    '~=': lambda value, expected: expected in value.split(),
+    '|=': lambda value, expected: value == expected or value.startswith(expected + '-'),
+    '^=': lambda value, expected: bool(expected) and value.startswith(expected),
+    '$=': lambda value, expected: bool(expected) and value.endswith(expected),
+    '*=': lambda value, expected: bool(expected) and expected in value,
+}
+
+
+class CssSelector:
+    """
+    Parameters:
+        - selector: the CSS selector, see the module docstring.
+    """
+    def __init__(self, selector):
+        self.selector = selector
+        # alternatives of the selector list, each a list of
+        # (combinator with the previous compound, tag, [(attribute, operator, value)])
+        self.alternatives = self._parse(selector)
+
+    def __repr__(self):
+        return f'CssSelector({self.selector!r})'
+
+    @staticmethod
+    def _parse(selector):
+        alternatives = [[]]
+        combinator = None
+        pos = 0
+        selector = selector.strip()
+        while pos < len(selector):
+            match = _TOKENS.match(selector, pos)
+            if match is None:
+                raise ValueError(f'Unsupported CSS selector {selector!r} at {selector[pos:]!r}')
+            pos = match.end()
+            compounds = alternatives[-1]
+            if match.group('comma'):
+                alternatives.append([])
+                combinator = None
+                continue
+            if match.group('child') or match.group('space'):
+                if not compounds:
+                    raise ValueError(f'CSS selector {selector!r} starts with a combinator')
+                combinator = '>' if match.group('child') else ' '
+                continue
+            if combinator is not None or not compounds:
+                compounds.append((combinator, None, []))
+                combinator = None
+            _, tag, conditions = compounds[-1]
+            if match.group('tag'):
+                if tag is not None or conditions:
+                    raise ValueError(f'Unexpected tag {match.group("tag")!r} in CSS selector {selector!r}')
+                compounds[-1] = (compounds[-1][0], match.group('tag').lower(), conditions)
+            elif match.group('id'):
+                conditions.append(('id', '=', match.group('id')))
+            elif match.group('class_'):
+                conditions.append(('class', '~=', match.group('class_')))
+            else:
+                value = next((v for v in match.group('dq', 'sq', 'value') if v is not None), None)
+                conditions.append((match.group('attr').lower(), match.group('op'), value))
+        if combinator is not None or not all(alternatives):
+            raise ValueError(f'Empty CSS selector in {selector!r}')
+        return alternatives
+
+    def matches(self, tag, attributes, ancestors=()):
+        """
+        Parameters:
+            - tag: tag name of the element.
+            - attributes: its attributes, values being strings or lists of
+                words (e.g. `class` as parsed by BeautifulSoup).
+            - ancestors: `(tag, attributes)` of the enclosing elements,
+                outermost first.
+        """
+        return any(
+            _matches(compounds, len(compounds) - 1, tag, attributes, ancestors, len(ancestors))
+            for compounds in self.alternatives
+        )
+
+
+def _compound_matches(compound_tag, conditions, tag, attributes):
+    if compound_tag is not None and compound_tag != '*' and compound_tag != tag.lower():
+        return False
+    for name, operator, expected in conditions:
+        if name not in attributes:
+            return False
+        value = attributes[name]
+        if isinstance(value, (list, tuple)):
+            value = ' '.join(value)
+        if not _OPERATORS[operator]('' if value is None else str(value), expected):
+            return False
+    return True
+
+
+def _matches(compounds, index, tag, attributes, ancestors, n_ancestors):
+    """Match `compounds[:index + 1]` against an element and its first `n_ancestors` ancestors."""
+    combinator, compound_tag, conditions = compounds[index]
+    if not _compound_matches(compound_tag, conditions, tag, attributes):
+        return False
+    if index == 0:
+        return True
+    if combinator == '>':
+        if not n_ancestors:
+            return False
+        parent_tag, parent_attributes = ancestors[n_ancestors - 1]
+        return _matches(compounds, index - 1, parent_tag, parent_attributes, ancestors, n_ancestors - 1)
+    return any(
+        _matches(compounds, index - 1, *ancestors[i], ancestors, i)
+        for i in range(n_ancestors - 1, -1, -1)
+    )
@@ -0,0 +1,211 @@
+"""
+Write only the changed part of a re-crawled graph.
+
+The nodes and links ingested for an endpoint are recorded in a local
+manifest (one JSON file per endpoint, no Neo4j round trip needed). On the
+next crawl the new graph is compared with the manifest and only the
+add / update / remove operations are sent to `Neo4jIngestor`.
+
+The diff is keyed by node / link ids, so the graph should be converted with
+`id_mode='content'` (see graph_ids.py): with random ids every crawl looks
+like a complete replacement.
+
+Usage:
+    store = ManifestStore('manifests')
+    nodes, links = json_to_graph(data, id_mode='content', source=url)
+    sync_graph(conn, store, url, nodes, links, item_to_row, node_to_record, link_to_record)
+"""
+import hashlib
+import json
+import os
+from neo4j_ingestor import NODE_LABEL, quote_label
+
+
+def fingerprint(item):
+    """
+    Short hash of everything stored for a node or link.
+    """
+    dumped = json.dumps(item, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(dumped.encode('utf-8')).hexdigest()[:16]
+
+
+class ManifestStore:
+    """
+    Directory of manifests, one per endpoint.
+
+    A manifest maps node ids to their fingerprint and link ids to
+    `[source, target, type, fingerprint]`, which is all a removal needs,
+    `type` being the relationship type written to Neo4j.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, endpoint):
+        name = hashlib.sha1(endpoint.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f'{name}.json')
+
+    def load(self, endpoint):
+        """
+        Returns:
+            dict: {'endpoint': ..., 'nodes': {...}, 'links': {...}}, empty for a new endpoint.
+        """
+        try:
+            with open(self.path(endpoint), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'endpoint': endpoint, 'nodes': {}, 'links': {}}
+
+    def save(self, endpoint, nodes, links, link_to_record=None):
+        """
+        Parameters:
+            - link_to_record: the converter's `link_to_record`, giving the
+                relationship type a link is written with (e.g. html2cypher
+                writes `CONTAINS` for a `contains` link), `link['type']` by default.
+        """
+        manifest = {
+            'endpoint': endpoint,
+            'nodes': {node['id']: fingerprint(node) for node in nodes},
+            'links': {
+                link['id']: [link['source'], link['target'], _link_type(link, link_to_record), fingerprint(link)]
+                for link in links
+            }
+        }
+        path = self.path(endpoint)
+        # write then rename, so that a crash never leaves a truncated manifest
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+
+class GraphDiff:
+    """
+    Operations turning the previously ingested graph into the new one.
+    """
+    def __init__(self):
+        self.added_nodes = []
+        self.updated_nodes = []
+        self.removed_node_ids = []
+        self.added_links = []
+        self.removed_links = []
+
+    def is_empty(self):
+        return not (self.added_nodes or self.updated_nodes or self.removed_node_ids
+                    or self.added_links or self.removed_links)
+
+    def __repr__(self):
+        return (
+            f'GraphDiff(+{len(self.added_nodes)} ~{len(self.updated_nodes)} -{len(self.removed_node_ids)} nodes, '
+            f'+{len(self.added_links)} -{len(self.removed_links)} links)'
+        )
+
+
+def _link_type(link, link_to_record):
+    return link_to_record(link)[0] if link_to_record is not None else link['type']
+
+
+def diff_graph(manifest, nodes, links):
+    """
+    Compare a newly converted graph with the manifest of the last ingestion.
+
+    Parameters:
+        - manifest: the dict returned by `ManifestStore.load`.
+        - nodes, links: the new graph.
+
+    Returns:
+        GraphDiff
+    """
+    diff = GraphDiff()
+    old_nodes = manifest['nodes']
+    old_links = manifest['links']
+    new_node_ids = set()
+    for node in nodes:
+        new_node_ids.add(node['id'])
+        old = old_nodes.get(node['id'])
+        if old is None:
+            diff.added_nodes.append(node)
+        elif old != fingerprint(node):
+            diff.updated_nodes.append(node)
+    diff.removed_node_ids = [node_id for node_id in old_nodes if node_id not in new_node_ids]
+    new_link_ids = set()
+    for link in links:
+        new_link_ids.add(link['id'])
+        old = old_links.get(link['id'])
+        if old is None or old[3] != fingerprint(link):
+            diff.added_links.append(link)
+            if old is not None:
+                diff.removed_links.append(_removed_link(link['id'], old))
+    removed_node_ids = set(diff.removed_node_ids)
+    for link_id, old in old_links.items():
+        if link_id not in new_link_ids and old[0] not in removed_node_ids and old[1] not in removed_node_ids:
+            # links of removed nodes go away with DETACH DELETE
+            diff.removed_links.append(_removed_link(link_id, old))
+    return diff
+
+
+def _removed_link(link_id, old):
+    source, target, link_type, _ = old
+    return {'id': link_id, 'source': source, 'target': target, 'type': link_type}
+
+
+def remove_node_to_row(node_id):
+    query = f"UNWIND $rows AS row MATCH (n:{NODE_LABEL} {{id: row.id}}) DETACH DELETE n"
+    return query, {'id': node_id}
+
+
+def remove_link_to_row(link):
+    query = (
+        "UNWIND $rows AS row "
+        f"MATCH (:{NODE_LABEL} {{id: row.source}})-[r:{quote_label(link['type'])}]->(:{NODE_LABEL} {{id: row.target}}) "
+        "DELETE r"
+    )
+    return query, {'source': link['source'], 'target': link['target']}
+
+
+def apply_diff(conn, diff, item_to_row, n_thread=1, desc='', node_to_record=None):
+    """
+    Send the operations of a diff to Neo4j.
+
+    Parameters:
+        - conn: Neo4jIngestor
+        - diff: GraphDiff
+        - item_to_row: the MERGE template of the converter (e.g. `json2cypher.item_to_row`).
+            Its node rows are also used to update changed nodes in place.
+        - node_to_record: the converter's `node_to_record`, giving the labels
+            of an updated node, `node['type']` by default.
+    """
+    def update_node_to_row(node):
+        _, row = item_to_row(node)
+        labels = node_to_record(node)[0] if node_to_record is not None else [node['type']]
+        # replace the whole property map, so that removed properties go away
+        query = (
+            f"UNWIND $rows AS row MATCH (n:{NODE_LABEL} {{id: row.id}}) "
+            f"SET n = row, n:{':'.join(quote_label(label) for label in labels)}"
+        )
+        return query, row
+
+    # removals first, so that a changed link re-added under the same id does not clash
+    conn.ingest_batch(diff.removed_links, remove_link_to_row, desc=desc + '.remove_links', n_thread=n_thread)
+    conn.ingest_batch(diff.removed_node_ids, remove_node_to_row, desc=desc + '.remove_nodes', n_thread=n_thread)
+    conn.ingest_batch(diff.updated_nodes, update_node_to_row, desc=desc + '.update_nodes', n_thread=n_thread)
+    conn.ingest_batch(diff.added_nodes, item_to_row, desc=desc + '.add_nodes', n_thread=n_thread)
+    conn.ingest_batch(diff.added_links, item_to_row, desc=desc + '.add_links', n_thread=n_thread)
+
+
+def sync_graph(conn, store, endpoint, nodes, links, item_to_row, node_to_record=None, link_to_record=None, n_thread=1):
+    """
+    Diff the graph of `endpoint` against its manifest, write the changes
+    and record the new manifest once they are committed.
+
+    Parameters:
+        - item_to_row, node_to_record, link_to_record: of the converter the
+            graph comes from, see `apply_diff` and `ManifestStore.save`.
+
+    Returns:
+        GraphDiff
+    """
+    diff = diff_graph(store.load(endpoint), nodes, links)
+    if not diff.is_empty():
+        apply_diff(conn, diff, item_to_row, n_thread=n_thread, desc=endpoint, node_to_record=node_to_record)
+    store.save(endpoint, nodes, links, link_to_record=link_to_record)
+    return diff
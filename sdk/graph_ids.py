@@ -0,0 +1,77 @@
+"""
+Node / link ids for the graphs produced by json2cypher and html2cypher.
+
+Two id modes are supported:
+- 'uuid': a random uuid4 per node and link (default).
+- 'content': a name-based uuid5 of the source url, the structural path of the
+    node in the document and its own content. Converting the same document
+    twice yields the same ids, so ingesting with `MERGE` skips whatever is
+    already in the database. `MERGE` never removes anything though: a changed
+    value gets a new id and the node it replaces stays, so updates have to go
+    through `graph_diff.sync_graph`, which also removes what is gone.
+"""
+import hashlib
+import json
+import uuid
+
+ID_MODES = ('uuid', 'content')
+
+
+def check_id_mode(id_mode):
+    if id_mode not in ID_MODES:
+        raise ValueError(f'id_mode should be one of {ID_MODES} rather than {id_mode}')
+
+
+def random_id():
+    return str(uuid.uuid4())
+
+
+def content_id(source, path, node_type, content):
+    """
+    Parameters:
+        - source: url (or any name) of the document.
+        - path: structural path of the node inside the document.
+        - node_type: type of the node.
+        - content: content of the node itself (not of its descendants).
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f'{source}\x00{path}\x00{node_type}\x00{content}'))
+
+
+def link_content_id(source_id, target_id, link_type):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f'{source_id}\x00{link_type}\x00{target_id}'))
+
+
+def json_digest(element):
+    """
+    Short hash of a JSON sub-document, independent of the key order.
+    """
+    dumped = json.dumps(element, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(dumped.encode('utf-8')).hexdigest()[:16]
+
+
+def json_digests(element, digests=None):
+    """
+    Short hashes of a JSON document and of all its lists and records,
+    independent of the key order, computed bottom-up in one pass: a
+    container is hashed from the hashes of its children, so every value
+    is hashed once instead of once per enclosing list.
+
+    Parameters:
+        - element: the JSON document.
+        - digests: dict to fill, `id(container) -> hash`.
+
+    Returns:
+        tuple: (hash of `element`, `digests`)
+    """
+    if digests is None:
+        digests = {}
+    if isinstance(element, list):
+        parts = ['L'] + [json_digests(item, digests)[0] for item in element]
+    elif isinstance(element, dict):
+        parts = ['D'] + sorted(
+            json.dumps(str(key), ensure_ascii=False) + json_digests(value, digests)[0] for key, value in element.items())
+    else:
+        return json_digest(element), digests
+    digest = hashlib.sha1('\x00'.join(parts).encode('utf-8')).hexdigest()[:16]
+    digests[id(element)] = digest
+    return digest, digests
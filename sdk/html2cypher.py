@@ -1,139 +1,899 @@
 """
 TODO:
-- [ ] Identify repeating part of the HTML
-    - [ ] Add beautifulsoup element object into `nodes` dictionary. 
-    - [ ] Avoid adding beautifulsoup element object into cypher. 
-    - [ ] Using neo4j to find the id of the repeating component.
-    - [ ] Store the repeating component part of HTML for further processing.
+- [x] Identify repeating part of the HTML
+    - [x] Add beautifulsoup element object into `nodes` dictionary.
+        Not needed: the structure is hashed while converting (`structural_hash`).
+    - [x] Avoid adding beautifulsoup element object into cypher.
+    - [x] Using neo4j to find the id of the repeating component.
+        Found without neo4j by the `repeats` option of `HtmlGraphBuilder`, as Pattern nodes.
+    - [x] Store the repeating component part of HTML for further processing.
+        `(container)-[:HAS_PATTERN]->(:Pattern)-[:HAS_INSTANCE]->(item)`,
+        see pattern_match_cyphers/html_repeat_pattern.cypher.
     - [ ] Develop algorithm to find difference between similar element in the list
         See: diff_extractor.py
+
+Content ids (`id_mode='content'`) come from the path of a node, in which
+repeated siblings (table rows, list items...) are addressed by the hash of
+their content rather than by their position (see `HtmlPathPlanner`).
+Inserting or removing a row only writes that row, but changing a value
+inside a repeated element gives its whole subtree new ids, and documents
+streamed in chunks keep positional paths (see `iter_html_stream_graph`).
 """
-from bs4 import BeautifulSoup
-import uuid
+import hashlib
+import re
+from html import unescape
+from html.entities import html5 as html5_entities
+from html.parser import HTMLParser
+from bs4 import BeautifulSoup, UnicodeDammit
 import requests
-from neo4j import GraphDatabase
-from neo4j.exceptions import CypherSyntaxError
-import tqdm
-import threading
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+from graph_ids import check_id_mode, random_id, content_id, link_content_id
+from neo4j_ingestor import Neo4jIngestor, NODE_LABEL, quote_label, collect_graph, is_link
+from graph_buffer import GraphBuffer, drain
+from css_selector import CssSelector
 
 
-def html_to_graph(html_content):
+def html_to_graph(html_content, id_mode='uuid', source='', parser=None, **options):
     """
     Converts an HTML document into a graph representation using the specified Node Types and Link Types.
 
     Parameters:
         html_content (str): The HTML string to be converted.
+        id_mode (str): 'uuid' for random ids, 'content' for ids derived from
+            `source`, the XPath-like path and the content (see graph_ids.py).
+            Repeated siblings are addressed by their content in the path
+            (see `HtmlPathPlanner`), so inserting a row keeps the other ids.
+        source (str): The url of the page, used by the 'content' id mode.
+        parser (str | None): 'html.parser' (BeautifulSoup, the default) or
+            'lxml', faster but repairing malformed markup differently, see
+            `parse_html`.
+        options: how the graph is shaped, see `HtmlGraphBuilder`
+            (e.g. `attributes='properties'` to store attributes on the Elements).
 
     Returns:
         tuple: A tuple containing two lists:
             - nodes: A list of dictionaries representing nodes.
             - links: A list of dictionaries representing links.
     """
-    nodes = []
-    links = []
-
-    def get_unique_node_id():
-        """Generates a unique node ID."""
-        return str(uuid.uuid4())
-
-    def get_unique_link_id():
-        """Generates a unique link ID."""
-        return str(uuid.uuid4())
-    
-    def connect_sequential_elements(element_ids):
-        """connect a sequence"""
-        nonlocal links
-        for i, element_id in enumerate(element_ids):
-            assert element_id is not None
-            if i > 0:
-                links.append({
-                    "id": get_unique_link_id(),
-                    "source": element_ids[i-1],
-                    "target": element_id,
-                    "type": "is_in_front_of"
-                })
-
-    def process_element(element, parent_id=None):
-        """Recursively processes an HTML element and its children."""
-        nonlocal nodes, links
+    _, nodes, links = html_to_graph_with_roots(html_content, id_mode=id_mode, source=source, parser=parser, **options)
+    return nodes, links
+
+
+def html_to_graph_with_roots(html_content, id_mode='uuid', source='', parser=None, **options):
+    """
+    Same as `html_to_graph` but also returns the ids of the top-level nodes,
+    so that callers can attach the document to another node (e.g., an Endpoint).
+
+    Returns:
+        tuple: (element_ids, nodes, links)
+    """
+    return collect_graph(iter_html_graph(html_content, id_mode=id_mode, source=source, parser=parser, **options))
+
+
+def html_to_graph_buffer(html_content, id_mode='uuid', source='', parser=None, **options):
+    """
+    Same as `html_to_graph_with_roots` but stores the graph in a compact
+    `GraphBuffer` (see graph_buffer.py) instead of lists of dicts.
 
+    Returns:
+        tuple: (element_ids, GraphBuffer)
+    """
+    buffer = GraphBuffer()
+    element_ids = drain(iter_html_graph(
+        html_content, id_mode=id_mode, source=source, parser=parser, buffer=buffer, **options))
+    return element_ids, buffer
+
+
+def iter_html_graph(html_content, id_mode='uuid', source='', parser=None, **options):
+    """
+    Generator form of `html_to_graph`.
+
+    Yields nodes and links as soon as they are created (a node always comes
+    before the links that reference it), so the graph can be streamed into
+    `Neo4jIngestor.ingest_batch` with `item_to_row` while it is being built.
+
+    Parameters:
+        - html_content, id_mode, source, parser: see `html_to_graph`.
+        - options: see `HtmlGraphBuilder`.
+
+    Returns:
+        the ids of the top-level nodes (as the generator return value).
+    """
+    elements = parse_html(html_content, parser)
+    if id_mode == 'content' and options.get('steps') is None:
+        options['steps'] = _tree_steps(elements)
+    builder = HtmlGraphBuilder(id_mode=id_mode, source=source, **options)
+
+    def process_element(element):
+        """Recursively processes an HTML element and its children."""
         if element.name:  # If it's an HTML tag
-            # Create a node for the element
-            element_id = get_unique_node_id()
-            nodes.append({
-                "id": element_id,
-                "tag": element.name,
-                "type": "Element",
-                "properties": {attr: element[attr] for attr in element.attrs}  # Add all attributes as properties
-            })
-
-            # If the element has a parent, create a "contains" link
-            if parent_id:
-                links.append({
-                    "id": get_unique_link_id(),
-                    "source": parent_id,
-                    "target": element_id,
-                    "type": "contains"
-                })
-
-            # Process attributes as separate nodes
-            for attr_name, attr_value in element.attrs.items():
-                attr_id = get_unique_node_id()
-                nodes.append({
-                    "id": attr_id,
-                    "name": attr_name.strip().replace('-', '_'),
-                    "value": attr_value,
-                    "type": "Attribute"
-                })
-                # Link the element to its attribute
-                links.append({
-                    "id": get_unique_link_id(),
-                    "source": element_id,
-                    "target": attr_id,
-                    "type": "has_attribute"
-                })
-
-            # Recursively process child elements
-            child_ids = []
-            for child in element.children:
-                child_id = process_element(child, element_id)
-                if child_id is not None:
-                    child_ids.append(child_id)
-            connect_sequential_elements(child_ids)
-            return element_id
-
-        elif element.string and element.string.strip():  # If it's text content
-            # Create a node for the text
-            text_id = get_unique_node_id()
-            nodes.append({
-                "id": text_id,
-                "content": element.string.strip(),
-                "type": "Text"
-            })
-
-            # Link the text node to its parent
-            if parent_id:
-                links.append({
-                    "id": get_unique_link_id(),
-                    "source": parent_id,
-                    "target": text_id,
-                    "type": "contains"
-                })
-            return text_id
-
-    # Parse the HTML content
-    soup = BeautifulSoup(html_content, "html.parser")
+            if builder.start(element.name, {attr: element[attr] for attr in element.attrs}):
+                yield from builder.pop_items()
+                for child in element.children:
+                    if builder.truncated:
+                        break
+                    yield from process_element(child)
+            builder.end()
+        else:  # If it's text content
+            builder.string(element.string)
+        yield from builder.pop_items()
 
     # Process each top-level element
-    element_ids = []
-    for element in soup.contents:
-        element_id = process_element(element)
-        if element_id is not None:
-            element_ids.append(element_id)
-    # Connect element one after another
-    connect_sequential_elements(element_ids)
+    for element in elements:
+        if builder.truncated:
+            break
+        yield from process_element(element)
+    return builder.element_ids
 
-    return nodes, links
+
+ATTRIBUTE_MODES = ('nodes', 'properties')
+TRUNCATE_POLICIES = ('stop', 'error')
+ORDER_MODES = ('chain', 'position', 'both')
+# shortest run of structurally identical siblings reported by the `repeats` option
+REPEAT_MIN_COUNT = 3
+# elements which never hold the content of a page (code, styling, vector
+# graphics, inline JSON / tracking blobs), for the `prune` option
+NON_CONTENT = ('script', 'style', 'noscript', 'template', 'svg', 'canvas', 'iframe', 'link', 'meta', '[hidden]')
+
+
+def attribute_property(name):
+    """
+    Element property holding the attribute `name` in the 'properties' mode,
+    e.g. `data-id` -> `attr_data_id`.
+    """
+    return 'attr_' + re.sub(r'\W', '_', name.strip())
+
+
+def prune_rule(rule):
+    """
+    A pruning rule as a `(tag, attributes, ancestors) -> bool` function.
+
+    Parameters:
+        - rule: a CSS selector (a tag `script`, an attribute `[aria-hidden=true]`,
+            `div.ad`, `footer > ul`..., see css_selector.py) or a
+            `(tag, attributes) -> bool` function.
+    """
+    if isinstance(rule, str):
+        return CssSelector(rule).matches
+    if callable(rule):
+        return lambda tag, attributes, ancestors: rule(tag, attributes)
+    raise ValueError(f'A pruning rule should be a CSS selector or a function, got {rule!r}')
+
+
+def structural_hash(tag, attribute_names, child_hashes):
+    """
+    Hash of the structure of an element: its tag, the sorted names (not the
+    values) of its attributes and the hashes of its children, in order.
+    Computed bottom-up, every element is hashed once.
+    """
+    signature = f"{tag}[{','.join(sorted(attribute_names))}]({','.join(child_hashes)})"
+    return hashlib.sha1(signature.encode('utf-8')).hexdigest()[:16]
+
+
+def content_hash(tag, attributes, child_contents):
+    """
+    Hash of the content of an element: its tag, its attributes (names and
+    values) and the contents of its children, in order: the stripped text
+    of a Text node, the content hash of an element.
+    """
+    attribute_str = '\x00'.join(
+        f"{name}={' '.join(value) if isinstance(value, list) else value}" for name, value in sorted(attributes.items()))
+    signature = f"{tag}\x01{attribute_str}\x01" + '\x01'.join(child_contents)
+    return hashlib.sha1(signature.encode('utf-8')).hexdigest()[:16]
+
+
+# structural hash of every Text node, whatever its content
+_TEXT_HASH = structural_hash('text()', (), ())
+
+
+# keys of the nodes / links of `HtmlGraphBuilder`, in order
+_TEXT_SHAPE = ("id", "content", "type")
+_ELEMENT_SHAPE = ("id", "tag", "type", "properties")
+_ELEMENT_ATTRIBUTES_SHAPE = ("id", "tag", "type", "attributes")
+_ATTRIBUTE_SHAPE = ("id", "name", "value", "type")
+_PATTERN_SHAPE = ("id", "signature", "tag", "count", "type")
+_LINK_SHAPE = ("id", "source", "target", "type")
+_LINK_PROPERTIES_SHAPE = _LINK_SHAPE + ("properties",)
+
+
+class HtmlGraphTruncated(ValueError):
+    """The document needs more nodes than `max_nodes` (with `truncate='error'`)."""
+
+
+class HtmlGraphBuilder:
+    """
+    Creates the nodes and links of a document from a depth-first walk:
+    `start` an element, add its strings and child elements, `end` it.
+
+    Shared by the tree walk of `iter_html_graph` and the parser callbacks of
+    `HtmlGraphParser`, so both produce the same graph for the same options.
+    Every node is linked to its parent with `contains` and, depending on
+    `order`, to its previous sibling with `is_in_front_of`.
+
+    Parameters:
+        - id_mode, source: see `html_to_graph`.
+        - attributes: 'nodes' (default) creates an Attribute node and a
+            `has_attribute` link per attribute. 'properties' stores them on the
+            Element node instead (see `attribute_property`), which roughly
+            halves the number of nodes and links of a page.
+        - attribute_nodes: in the 'properties' mode, attributes which still get
+            their own node (e.g. `('class', 'id')`), so that elements sharing
+            a value stay connected through it.
+        - prune: rules of the elements to leave out together with their
+            subtree, see `prune_rule` (e.g. `NON_CONTENT + ('nav', 'footer')`).
+        - max_depth: nodes nested deeper than this are left out, top-level
+            nodes being at depth 1.
+        - max_nodes: budget of nodes for the whole document. What does not fit
+            is handled by `truncate`.
+        - truncate: 'stop' (default) keeps the nodes created so far and drops
+            the rest of the document, setting `truncated`. 'error' raises
+            `HtmlGraphTruncated`.
+        - order: how the order of the children of an element is kept. 'chain'
+            (default) links consecutive children with `is_in_front_of`.
+            'position' puts `position` (from 0) and `sibling_count` properties
+            on the `contains` links instead, which an index serves (see
+            `get_position_index_cyphers`) without following a chain; those
+            links are created when the element ends. 'both' does the two.
+        - repeats: detect runs of at least `min_repeat` consecutive siblings
+            with the same `structural_hash` (the items of a list, the rows of
+            a table...). Each run becomes a Pattern node (`signature`, `tag`,
+            `count`), linked from the container with `has_pattern` and to
+            every item with `has_instance`, created when the container ends.
+        - buffer: a `GraphBuffer` the nodes and links are appended to, without
+            building their dicts, instead of being returned by `pop_items`.
+        - steps: in the 'content' id mode, the steps of the paths content ids
+            are derived from, worked out beforehand by an `HtmlPathPlanner`
+            (`iter_html_graph` and `iter_html_stream_graph` do it). Without
+            them the paths are positional (`/html[0]/body[0]/div[2]`), so
+            inserting an element shifts the ids of all its later siblings
+            of the same tag, and of their subtrees.
+
+    Pruned subtrees are skipped as they are met, so they cost neither nodes
+    nor a walk. Their siblings keep the paths (and content ids) they have
+    without pruning.
+    """
+    def __init__(self, id_mode='uuid', source='', attributes='nodes', attribute_nodes=(),
+                 prune=(), max_depth=None, max_nodes=None, truncate='stop', order='chain',
+                 repeats=False, min_repeat=REPEAT_MIN_COUNT, buffer=None, steps=None):
+        check_id_mode(id_mode)
+        if attributes not in ATTRIBUTE_MODES:
+            raise ValueError(f'attributes should be one of {ATTRIBUTE_MODES}, got {attributes!r}')
+        if truncate not in TRUNCATE_POLICIES:
+            raise ValueError(f'truncate should be one of {TRUNCATE_POLICIES}, got {truncate!r}')
+        if order not in ORDER_MODES:
+            raise ValueError(f'order should be one of {ORDER_MODES}, got {order!r}')
+        self.id_mode = id_mode
+        self.source = source
+        self.attributes = attributes
+        self.attribute_nodes = set(attribute_nodes)
+        self.prune = [prune_rule(rule) for rule in ([prune] if isinstance(prune, str) else prune)]
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.truncate = truncate
+        self.order = order
+        self.repeats = repeats
+        self.min_repeat = min_repeat
+        self.buffer = buffer
+        self.steps = steps
+        self.node_count = 0
+        self.truncated = False
+        # nodes and links created since the last `pop_items`
+        self.items = []
+        # ids of the top-level nodes
+        self.element_ids = []
+        self.stack = [self._frame(None, None, '')]
+        # (tag, attributes) of the open elements which are kept, for the pruning rules
+        self.ancestors = []
+
+    def pop_items(self):
+        items = self.items
+        self.items = []
+        return items
+
+    def _node_id(self, path, node_type, content):
+        if self.id_mode == 'content':
+            return content_id(self.source, path, node_type, content)
+        return random_id()
+
+    @staticmethod
+    def _frame(name, element_id, path, attribute_names=(), position=None):
+        """
+        An open element. `child_ids` is only kept for the 'position' / 'both'
+        orders and `children` (structural hash, id, tag) for `repeats`.
+        `position` is its positional path, which `steps` is keyed by.
+        """
+        return {'name': name, 'id': element_id, 'path': path, 'position': path if position is None else position,
+                'counters': {}, 'last_id': None, 'child_ids': [], 'attribute_names': attribute_names, 'children': [],
+                'pruned': False}
+
+    def _node(self, shape, *values):
+        """A node from its keys and their values, e.g. `_node(_TEXT_SHAPE, text_id, content, "Text")`."""
+        self.node_count += 1
+        if self.buffer is not None:
+            self.buffer.append(shape, values)
+        else:
+            self.items.append(dict(zip(shape, values)))
+
+    def _link(self, source_id, target_id, link_type, properties=None):
+        link_id = link_content_id(source_id, target_id, link_type) if self.id_mode == 'content' else random_id()
+        if self.buffer is not None:
+            if properties:
+                self.buffer.append(_LINK_PROPERTIES_SHAPE, (link_id, source_id, target_id, link_type, properties))
+            else:
+                self.buffer.append(_LINK_SHAPE, (link_id, source_id, target_id, link_type))
+            return
+        link = {"id": link_id, "source": source_id, "target": target_id, "type": link_type}
+        if properties:
+            link["properties"] = properties
+        self.items.append(link)
+
+    def _child_path(self, step):
+        """
+        XPath-like path of a new child, e.g. `/html[0]/body[0]/div[2]` or
+        `.../text()[0]`, with the step given by `steps` if any.
+
+        Returns:
+            tuple: (path, positional path)
+        """
+        parent = self.stack[-1]
+        counters = parent['counters']
+        counters[step] = counters.get(step, -1) + 1
+        position = f"{parent['position']}/{step}[{counters[step]}]"
+        if self.steps is None:
+            return position, position
+        planned = self.steps.get(position)
+        if planned is None:
+            return f"{parent['path']}/{step}[{counters[step]}]", position
+        return f"{parent['path']}/{planned}", position
+
+    def _attach(self, node_id):
+        """Link a new node to its parent and to its previous sibling."""
+        parent = self.stack[-1]
+        if parent['id'] is None:
+            self.element_ids.append(node_id)
+        elif self.order == 'chain':
+            self._link(parent['id'], node_id, "contains")
+        else:
+            parent['child_ids'].append(node_id)
+        if parent['last_id'] is not None and self.order != 'position':
+            self._link(parent['last_id'], node_id, "is_in_front_of")
+        parent['last_id'] = node_id
+
+    def _fits(self, n_nodes):
+        """Whether `n_nodes` more nodes fit in the budget, applying `truncate` when they do not."""
+        if self.max_nodes is None or self.node_count + n_nodes <= self.max_nodes:
+            return True
+        if self.truncate == 'error':
+            raise HtmlGraphTruncated(f'{self.source or "The document"} needs more than {self.max_nodes} nodes')
+        self.truncated = True
+        return False
+
+    def _skipped(self):
+        """Nothing is created inside a pruned element, too deep or after truncation."""
+        return self.truncated or self.stack[-1]['pruned'] or (
+            self.max_depth is not None and len(self.stack) > self.max_depth)
+
+    def string(self, text):
+        """A string child of the open element, which becomes a Text node unless it is blank."""
+        if self._skipped():
+            return
+        path, _ = self._child_path('text()')
+        if text and text.strip() and self._fits(1):
+            text_id = self._node_id(path, "Text", text.strip())
+            self._node(_TEXT_SHAPE, text_id, text.strip(), "Text")
+            self._attach(text_id)
+            if self.repeats:
+                self.stack[-1]['children'].append((_TEXT_HASH, text_id, None))
+
+    def start(self, tag, properties):
+        """
+        Open an element.
+
+        Parameters:
+            - tag: the tag name.
+            - properties: the attributes of the element.
+
+        Returns:
+            bool: False when the element is left out, so that a tree walk can
+                skip its content (`end` must still be called).
+        """
+        if self._skipped():
+            self.stack.append({'name': tag, 'pruned': True})
+            return False
+        path, position = self._child_path(tag)
+        if self.attributes == 'nodes':
+            attribute_nodes = list(properties)
+        else:
+            attribute_nodes = [name for name in properties if name in self.attribute_nodes]
+        if any(rule(tag, properties, self.ancestors) for rule in self.prune) or not self._fits(1 + len(attribute_nodes)):
+            self.stack.append({'name': tag, 'pruned': True})
+            return False
+        element_id = self._node_id(path, "Element", tag)
+        if self.attributes == 'nodes':
+            self._node(_ELEMENT_SHAPE, element_id, tag, "Element", dict(properties))
+        else:
+            self._node(
+                _ELEMENT_ATTRIBUTES_SHAPE, element_id, tag, "Element",
+                {attribute_property(name): value for name, value in properties.items()}
+            )
+        self._attach(element_id)
+        for attr_name in attribute_nodes:
+            attr_value = properties[attr_name]
+            attr_id = self._node_id(f'{path}/@{attr_name}', "Attribute", attr_value)
+            self._node(_ATTRIBUTE_SHAPE, attr_id, attr_name.strip().replace('-', '_'), attr_value, "Attribute")
+            self._link(element_id, attr_id, "has_attribute")
+        self.stack.append(self._frame(tag, element_id, path, tuple(properties), position))
+        self.ancestors.append((tag, properties))
+        return True
+
+    def end(self):
+        """Close the most recent open element."""
+        frame = self.stack.pop()
+        if frame['pruned']:
+            return
+        self.ancestors.pop()
+        child_ids = frame['child_ids']
+        for position, child_id in enumerate(child_ids):
+            self._link(frame['id'], child_id, "contains", {"position": position, "sibling_count": len(child_ids)})
+        if self.repeats:
+            children = frame['children']
+            self._find_repeats(frame)
+            element_hash = structural_hash(frame['name'], frame['attribute_names'], [child[0] for child in children])
+            self.stack[-1]['children'].append((element_hash, frame['id'], frame['name']))
+
+    def _find_repeats(self, frame):
+        """Create a Pattern node for every long enough run of identical children, in one scan."""
+        children = frame['children']
+        n_pattern = 0
+        start = 0
+        for i in range(1, len(children) + 1):
+            if i < len(children) and children[i][0] == children[start][0]:
+                continue
+            signature, _, tag = children[start]
+            if i - start >= self.min_repeat and signature != _TEXT_HASH:
+                pattern_id = self._node_id(f"{frame['path']}/pattern()[{n_pattern}]", "Pattern", signature)
+                self._node(_PATTERN_SHAPE, pattern_id, signature, tag, i - start, "Pattern")
+                self._link(frame['id'], pattern_id, "has_pattern")
+                for _, child_id, _ in children[start:i]:
+                    self._link(pattern_id, child_id, "has_instance")
+                n_pattern += 1
+            start = i
+
+    def is_open(self, tag):
+        return any(frame['name'] == tag for frame in self.stack[1:])
+
+    def close_all(self):
+        while len(self.stack) > 1:
+            self.end()
+
+
+class HtmlPathPlanner:
+    """
+    Works out the `steps` of `HtmlGraphBuilder` in a first pass over the same
+    events (`start`, `string`, `end`), so that the content ids of a page
+    survive the insertion of siblings:
+    - siblings sharing their structure (see `structural_hash`), such as the
+        rows of a table or the items of a list, are addressed by the hash of
+        their content plus an occurrence counter, e.g. `tr[#3f2a...:0]`, the
+        way json2cypher addresses list items. Prepending a row to a table
+        keeps the ids of the other rows.
+    - the other elements are counted among the siblings of the same tag, id
+        and classes only, e.g. `div#main.content[0]`, so inserting an
+        element of another kind keeps their ids.
+    A change inside an element of the first kind changes its hash, so its
+    whole subtree gets new ids, like a changed list item in json2cypher.
+    Text nodes keep their positional steps.
+    """
+    def __init__(self):
+        # positional path -> step
+        self.steps = {}
+        self.stack = [self._frame(None, '', {})]
+        # (tag, attribute names, child structures) -> structure code, 0 being a Text node
+        self._structures = {}
+
+    @staticmethod
+    def _frame(name, position, attributes):
+        # children: (structure code, content hash, tag, signature, positional path) of the child elements
+        return {'name': name, 'position': position, 'attributes': attributes, 'counters': {}, 'children': [],
+                'structure': [], 'content': []}
+
+    def _child_position(self, step):
+        parent = self.stack[-1]
+        counters = parent['counters']
+        counters[step] = counters.get(step, -1) + 1
+        return f"{parent['position']}/{step}[{counters[step]}]"
+
+    def string(self, text):
+        self._child_position('text()')
+        if text and text.strip():
+            parent = self.stack[-1]
+            parent['structure'].append(0)
+            parent['content'].append('t' + text.strip())
+
+    def start(self, tag, properties):
+        self.stack.append(self._frame(tag, self._child_position(tag), properties))
+        return True
+
+    def end(self):
+        frame = self.stack.pop()
+        self._plan(frame)
+        attributes = frame['attributes']
+        # the structure is the one of `structural_hash`, only compared between siblings
+        key = frame['name'], tuple(sorted(attributes)), tuple(frame['structure'])
+        structure = self._structures.setdefault(key, len(self._structures) + 1)
+        content = content_hash(frame['name'], attributes, frame['content'])
+        classes = attributes.get('class') or []
+        signature = frame['name'] + (f"#{attributes['id']}" if attributes.get('id') else '') + ''.join(
+            '.' + name for name in (classes.split() if isinstance(classes, str) else classes))
+        parent = self.stack[-1]
+        parent['children'].append((structure, content, frame['name'], signature, frame['position']))
+        parent['structure'].append(structure)
+        parent['content'].append('e' + content)
+
+    def _plan(self, frame):
+        """Steps of the child elements of an element, once they are all known."""
+        children = frame['children']
+        structures = {}
+        for structure, *_ in children:
+            structures[structure] = structures.get(structure, 0) + 1
+        counters = {}
+        for structure, content, tag, signature, position in children:
+            if structures[structure] > 1:
+                key = tag, content
+                counters[key] = counters.get(key, -1) + 1
+                self.steps[position] = f'{tag}[#{content}:{counters[key]}]'
+            else:
+                counters[signature] = counters.get(signature, -1) + 1
+                self.steps[position] = f'{signature}[{counters[signature]}]'
+
+    def is_open(self, tag):
+        return any(frame['name'] == tag for frame in self.stack[1:])
+
+    def close_all(self):
+        while len(self.stack) > 1:
+            self.end()
+        self._plan(self.stack[0])
+
+
+def _tree_steps(elements):
+    """`HtmlPathPlanner.steps` of the top-level nodes of `parse_html`."""
+    planner = HtmlPathPlanner()
+
+    def walk(element):
+        if element.name:
+            planner.start(element.name, {attr: element[attr] for attr in element.attrs})
+            for child in element.children:
+                walk(child)
+            planner.end()
+        else:
+            planner.string(element.string)
+
+    for element in elements:
+        walk(element)
+    planner.close_all()
+    return planner.steps
+
+
+def _stream_steps(html_content):
+    """`HtmlPathPlanner.steps` of a document parsed by `HtmlGraphParser`."""
+    planner = HtmlPathPlanner()
+    parser = HtmlGraphParser(builder=planner)
+    parser.feed(html_content)
+    parser.close()
+    return planner.steps
+
+
+PARSERS = ('lxml', 'html.parser')
+# lxml is opt-in: its repairs of malformed markup give other graphs
+DEFAULT_PARSER = 'html.parser'
+# attributes BeautifulSoup splits into lists of words, per tag ('*' for all tags)
+_LIST_ATTRIBUTES = {
+    '*': ('class', 'accesskey', 'dropzone'),
+    'a': ('rel', 'rev'),
+    'link': ('rel', 'rev'),
+    'td': ('headers',),
+    'th': ('headers',),
+    'form': ('accept-charset',),
+    'object': ('archive',),
+    'area': ('rel',),
+    'icon': ('sizes',),
+    'iframe': ('sandbox',),
+    'output': ('for',),
+}
+_WORDS = re.compile(r'\S+')
+_ROOT_START = re.compile(r'<html[\s/>]', re.IGNORECASE)
+_TOP_LEVEL_TOKEN = re.compile(r'\s+|<!--(.*?)-->|<!([^>]*)>|<\?([^>]*)>', re.DOTALL)
+
+
+def parse_html(html_content, parser=None):
+    """
+    Top-level nodes of a document, exposing the part of the BeautifulSoup
+    interface used by `iter_html_graph` (`name`, `attrs`, `children`, `string`).
+
+    Parameters:
+        - parser:
+            - 'html.parser' (default): BeautifulSoup with the pure Python parser.
+            - 'lxml': a walk over the libxml2 tree, about twice as fast,
+                when lxml is installed (html.parser otherwise).
+                Both give the same graph for documents with an `<html>` root
+                and explicit end tags. They differ where the markup has to be
+                repaired: libxml2 closes implied end tags (e.g. an unclosed
+                `<p>` or `<li>`) that html.parser nests, and it wraps content
+                without an `<html>` root into `<html><body>`.
+    """
+    parser = parser or DEFAULT_PARSER
+    if parser not in PARSERS:
+        raise ValueError(f'parser should be one of {PARSERS} rather than {parser}')
+    if parser == 'html.parser' or etree is None:
+        return BeautifulSoup(html_content, "html.parser").contents
+    if isinstance(html_content, bytes):
+        # the same encoding detection BeautifulSoup applies to bytes
+        html_content = UnicodeDammit(html_content, is_html=True).unicode_markup or ''
+    if not html_content.strip():
+        return []
+    try:
+        root = etree.fromstring(html_content, etree.HTMLParser())
+    except ValueError:
+        # str input with an XML encoding declaration, e.g. XHTML pages
+        root = etree.fromstring(html_content.encode('utf-8'), etree.HTMLParser(encoding='utf-8'))
+    if root is None:
+        return _top_level_nodes(html_content) or []
+    # libxml2 keeps neither the whitespace around the root nor the exact
+    # doctype string, so the nodes before / after `<html>...</html>` are read
+    # from the source when it only holds a doctype, comments and whitespace
+    start = _ROOT_START.search(html_content)
+    end = html_content.lower().rfind('</html')
+    before = _top_level_nodes(html_content[:start.start()]) if start else None
+    after = _top_level_nodes(html_content[html_content.find('>', end) + 1:]) if end >= 0 else None
+    if before is None or after is None:
+        before = [_lxml_node(node) for node in reversed(list(root.itersiblings(preceding=True)))]
+        after = [_lxml_node(node) for node in root.itersiblings()]
+        doctype = root.getroottree().docinfo.doctype
+        if doctype and '<!doctype' in html_content.lower():
+            before.insert(0, _LxmlNode(None, doctype[len('<!DOCTYPE '):-1]))
+    return before + [_lxml_node(root)] + after
+
+
+def _top_level_nodes(text):
+    """
+    Text nodes (doctype, comments, whitespace...) BeautifulSoup creates for a
+    piece of source outside the root element, None if it holds anything else.
+    """
+    nodes = []
+    pos = 0
+    while pos < len(text):
+        match = _TOP_LEVEL_TOKEN.match(text, pos)
+        if match is None:
+            return None
+        comment, declaration, instruction = match.groups()
+        if comment is not None:
+            nodes.append(_LxmlNode(None, comment))
+        elif declaration is not None:
+            # BeautifulSoup strips the leading `DOCTYPE ` of a declaration
+            nodes.append(_LxmlNode(None, declaration[len('DOCTYPE '):]))
+        elif instruction is not None:
+            nodes.append(_LxmlNode(None, instruction))
+        else:
+            nodes.append(_LxmlNode(None, match.group()))
+        pos = match.end()
+    return nodes
+
+
+class _LxmlNode:
+    """
+    lxml element, comment or text seen as a BeautifulSoup Tag / NavigableString.
+    """
+    __slots__ = ('element', 'name', 'string', '_attrs')
+
+    def __init__(self, element, string=None):
+        self.element = element
+        self.name = element.tag if element is not None else None
+        self.string = string
+        self._attrs = None
+
+    @property
+    def attrs(self):
+        if self._attrs is None:
+            list_attributes = _LIST_ATTRIBUTES['*'] + _LIST_ATTRIBUTES.get(self.name, ())
+            self._attrs = {
+                name: _WORDS.findall(value) if name in list_attributes else value
+                for name, value in self.element.attrib.items()
+            }
+        return self._attrs
+
+    def __getitem__(self, name):
+        return self.attrs[name]
+
+    @property
+    def children(self):
+        element = self.element
+        if element.text is not None:
+            yield _LxmlNode(None, element.text)
+        for child in element:
+            yield _lxml_node(child)
+            if child.tail is not None:
+                yield _LxmlNode(None, child.tail)
+
+
+def _lxml_node(node):
+    if isinstance(node.tag, str):
+        return _LxmlNode(node)
+    # comments and processing instructions are text for BeautifulSoup
+    return _LxmlNode(None, node.text or '')
+
+
+# tags BeautifulSoup closes right after their start tag
+_VOID_ELEMENTS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta',
+    'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex',
+    'nextid', 'spacer',
+}
+
+
+class HtmlGraphParser(HTMLParser):
+    """
+    Single pass, event driven counterpart of `iter_html_graph` (see `iter_html_stream_graph`).
+
+    Nodes and links are created from the parser callbacks with a stack of
+    open tags, following the tree BeautifulSoup builds with "html.parser"
+    (same nodes, links and content ids). The document is never held as a
+    tree, and the checks of `is_html` are collected on the way.
+
+    Parameters:
+        - id_mode, source: see `html_to_graph`.
+        - builder: what the events drive, an `HtmlGraphBuilder` made from
+            the options by default, or e.g. an `HtmlPathPlanner`.
+        - options: see `HtmlGraphBuilder`.
+    """
+    def __init__(self, id_mode='uuid', source='', builder=None, **options):
+        # character references are resolved by `handle_charref` / `handle_entityref`
+        # like BeautifulSoup does, rather than by HTMLParser
+        super().__init__(convert_charrefs=False)
+        self.builder = builder or HtmlGraphBuilder(id_mode=id_mode, source=source, **options)
+        self.data = []
+        self.already_closed = []
+        self.n_start_tag = 0
+        self.n_end_tag = 0
+        self.has_head = False
+        self.has_body = False
+
+    @property
+    def element_ids(self):
+        """ids of the top-level nodes"""
+        return self.builder.element_ids
+
+    def is_html(self):
+        """
+        The document has as many start as end tags and holds a `<head>` and a `<body>`.
+        """
+        return self.n_start_tag == self.n_end_tag and self.has_head and self.has_body
+
+    def pop_items(self):
+        return self.builder.pop_items()
+
+    def _flush(self):
+        """End the current string."""
+        if not self.data:
+            return
+        text = ''.join(self.data)
+        self.data = []
+        self.builder.string(text)
+
+    def _string(self, data):
+        """A comment, declaration... is a string on its own."""
+        self._flush()
+        self.data = [data]
+        self._flush()
+
+    def _start(self, tag, attrs):
+        self._flush()
+        list_attributes = _LIST_ATTRIBUTES['*'] + _LIST_ATTRIBUTES.get(tag, ())
+        properties = {}
+        for name, value in attrs:
+            value = '' if value is None else value
+            properties[name] = _WORDS.findall(value) if name in list_attributes else value
+        self.builder.start(tag, properties)
+        self.has_head = self.has_head or tag == 'head'
+        self.has_body = self.has_body or tag == 'body'
+
+    def _pop_to(self, tag):
+        """Close the most recent open `tag` and everything opened after it."""
+        if not self.builder.is_open(tag):
+            return
+        while self.builder.stack[-1]['name'] != tag:
+            self.builder.end()
+        self.builder.end()
+
+    def handle_starttag(self, tag, attrs):
+        self.n_start_tag += 1
+        self._start(tag, attrs)
+        if tag in _VOID_ELEMENTS:
+            self._pop_to(tag)
+            self.already_closed.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.n_start_tag += 1
+        self.n_end_tag += 1
+        self._start(tag, attrs)
+        self._pop_to(tag)
+
+    def handle_endtag(self, tag):
+        self.n_end_tag += 1
+        if tag in self.already_closed:
+            # e.g. the `</br>` of `<br></br>`
+            self.already_closed.remove(tag)
+        else:
+            self._flush()
+            self._pop_to(tag)
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_charref(self, name):
+        self.data.append(unescape(f'&#{name};'))
+
+    def handle_entityref(self, name):
+        self.data.append(html5_entities.get(name + ';', html5_entities.get(name, f'&{name}')))
+
+    def handle_comment(self, data):
+        self._string(data)
+
+    def handle_decl(self, decl):
+        self._string(decl[len('DOCTYPE '):])
+
+    def handle_pi(self, data):
+        self._string(data)
+
+    def unknown_decl(self, data):
+        self._string(data[len('CDATA['):] if data.upper().startswith('CDATA[') else data)
+
+    def close(self):
+        super().close()
+        self._flush()
+        self.builder.close_all()
+
+
+def iter_html_stream_graph(chunks, id_mode='uuid', source='', graph_parser=None, **options):
+    """
+    Streaming form of `iter_html_graph`, parsing the document in one pass.
+
+    Parameters:
+        - chunks: the HTML as a str, or an iterable of str chunks (e.g.
+            `response.iter_content(chunk_size, decode_unicode=True)`). In the
+            'content' id mode a str is parsed twice, the first pass working
+            out the paths of the content ids (see `HtmlPathPlanner`). Chunks
+            are only seen once, so their content ids keep positional paths
+            (like list items in `json2cypher.iter_json_stream_graph`) and
+            differ from those of `iter_html_graph`.
+        - id_mode, source: see `html_to_graph`.
+        - graph_parser: an `HtmlGraphParser` to use, e.g. to call `is_html`
+            once the document is consumed. Unlike the `parser` of
+            `html_to_graph`, not a backend name: the document is always
+            parsed by `HtmlGraphParser`.
+        - options: see `HtmlGraphBuilder`, when `graph_parser` is not given.
+
+    Returns:
+        the ids of the top-level nodes (as the generator return value).
+    """
+    if 'parser' in options:
+        raise ValueError(
+            'iter_html_stream_graph always parses with HtmlGraphParser, pass an HtmlGraphParser as graph_parser '
+            f"or use iter_html_graph for the {options['parser']!r} backend")
+    graph_parser = graph_parser or HtmlGraphParser(id_mode=id_mode, source=source, **options)
+    if isinstance(chunks, str):
+        builder = graph_parser.builder
+        if builder.id_mode == 'content' and builder.steps is None:
+            builder.steps = _stream_steps(chunks)
+        chunks = [chunks]
+    for chunk in chunks:
+        graph_parser.feed(chunk)
+        yield from graph_parser.pop_items()
+    graph_parser.close()
+    yield from graph_parser.pop_items()
+    return graph_parser.element_ids
 
 
 def node_to_cypher(node, ignore_text_content=False) -> str:
@@ -151,14 +911,14 @@ def node_to_cypher(node, ignore_text_content=False) -> str:
         tag = node['tag']
         assert isinstance(tag, str)
         assert tag != ''
-        query = f"CREATE (n:Element:{tag.upper()} {{id: '{node['id']}', tag: '{tag}'"
+        query = f"CREATE (n:{NODE_LABEL}:Element:{tag.upper()} {{id: '{node['id']}', tag: '{tag}'"
         query += '}'
         query += ")"
 
     elif node["type"] == "Attribute":
         value = node.get('value', '')
         value_str = f'"{value}"'
-        query = f"CREATE (n:Attribute:{node.get('name', '')} {{id: '{node['id']}', value: {value_str}}})"
+        query = f"CREATE (n:{NODE_LABEL}:Attribute:{node.get('name', '')} {{id: '{node['id']}', value: {value_str}}})"
 
     elif node["type"] == "Text":
         if ignore_text_content:
@@ -167,94 +927,136 @@ def node_to_cypher(node, ignore_text_content=False) -> str:
             node_content = node.get('content', '')
             node_content = node_content.replace('\n', '\\n').replace('"', "'")
         id = node['id']
-        query = f'CREATE (n:Text {{id: "{id}", content: "{node_content}"}})'
+        query = f'CREATE (n:{NODE_LABEL}:Text {{id: "{id}", content: "{node_content}"}})'
     else:
         raise ValueError('node is not Text/Attribute/Element')
     return query
 
 
 def link_to_cypher(link) -> str:
-    query = f"MATCH (a {{id: '{link['source']}'}}), (b {{id: '{link['target']}'}}) CREATE (a)-[:{link['type'].upper()}]->(b)"
+    query = f"MATCH (a:{NODE_LABEL} {{id: '{link['source']}'}}), (b:{NODE_LABEL} {{id: '{link['target']}'}}) CREATE (a)-[:{link['type'].upper()}]->(b)"
     return query
 
 
-def split_list_into_n_parts(lst, n):
+def node_to_row(node):
     """
-    Splits a list into n sublists as evenly as possible.
-    
-    Args:
-    lst (list): The list to be split.
-    n (int): The number of sublists to create.
-    
+    Batch counterpart of `node_to_cypher` used by `Neo4jIngestor.ingest_batch`.
+
+    Values are sent as parameters, so text content no longer needs escaping.
+
+    Parameters:
+        node (dict): A node produced by `html_to_graph`.
+
     Returns:
-    list of lists: A list containing n sublists.
+        tuple: the `UNWIND` query template and the row of parameters for this node.
+    """
+    labels, row = _node_labels_and_row(node)
+    return f"UNWIND $rows AS row CREATE (n:{NODE_LABEL}:{labels}) SET n = row", row
+
+
+def _node_labels_and_row(node):
+    labels, row = node_to_record(node)
+    return ':'.join(quote_label(label) for label in labels), row
+
+
+def node_to_record(node):
+    """
+    Labels (besides `:Node`) and properties of a node, shared by the
+    Cypher templates and the file exporters (see bulk_export.py).
+    """
+    if node["type"] == "Element":
+        tag = node['tag']
+        assert isinstance(tag, str)
+        assert tag != ''
+        return ["Element", tag.upper()], {'id': node['id'], 'tag': tag, **node.get('attributes', {})}
+    elif node["type"] == "Attribute":
+        return ["Attribute", node.get('name', '')], {'id': node['id'], 'value': node.get('value', '')}
+    elif node["type"] == "Text":
+        return ["Text"], {'id': node['id'], 'content': node.get('content', '')}
+    elif node["type"] == "Pattern":
+        return ["Pattern"], {'id': node['id'], 'signature': node['signature'], 'tag': node['tag'], 'count': node['count']}
+    else:
+        raise ValueError('node is not Text/Attribute/Element/Pattern')
+
+
+def link_to_record(link):
+    """
+    Relationship type and properties of a link, see `node_to_record`.
     """
-    # If n is larger than the list length, we can only return actual list elements
-    if n > len(lst):
-        return [lst[i:i + 1] for i in range(len(lst))] + [[] for _ in range(n - len(lst))]
+    return link['type'].upper(), dict(link.get('properties', {}))
 
-    # Calculate the size of each part: the minimum size of sublists
-    part_size, remainder = divmod(len(lst), n)
 
-    # Create the sublists
-    sublists = []
-    start = 0
-    for i in range(n):
-        # Add an extra element to some sublists to distribute the remainder
-        end = start + part_size + (1 if i < remainder else 0)
-        sublists.append(lst[start:end])
-        start = end
+def link_to_row(link):
+    """
+    Batch counterpart of `link_to_cypher` used by `Neo4jIngestor.ingest_batch`.
+    """
+    query = (
+        "UNWIND $rows AS row "
+        f"MATCH (a:{NODE_LABEL} {{id: row.source}}), (b:{NODE_LABEL} {{id: row.target}}) "
+        f"CREATE (a)-[r:{quote_label(link['type'].upper())}]->(b)"
+    )
+    return _with_link_properties(query, link)
 
-    return sublists
 
-class Neo4jIngestor:
-    def __init__(self, uri, user, password):
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
+def _with_link_properties(query, link):
+    """
+    Row of a link, setting its `properties` (e.g. `position`) when present.
+    """
+    row = {'source': link['source'], 'target': link['target']}
+    if 'properties' in link:
+        query += " SET r += row.properties"
+        row['properties'] = link['properties']
+    return query, row
+
+
+def item_to_row(item):
+    """
+    Batch template for the mixed node / link stream of `iter_html_graph`.
+
+    Batches of a stream may be committed in any order, so nodes and link
+    endpoints are MERGEd on `Node.id` instead of relying on the nodes
+    being written first. Nodes already carrying their type label and links
+    already present are left untouched, so re-ingesting an unchanged page
+    converted with `id_mode='content'` writes nothing. Nothing is removed
+    either, use `graph_diff.sync_graph` with this template to update a page.
+    """
+    if is_link(item):
+        query = (
+            "UNWIND $rows AS row "
+            f"MERGE (a:{NODE_LABEL} {{id: row.source}}) "
+            f"MERGE (b:{NODE_LABEL} {{id: row.target}}) "
+            f"MERGE (a)-[r:{quote_label(item['type'].upper())}]->(b)"
+        )
+        return _with_link_properties(query, item)
+    labels, row = _node_labels_and_row(item)
+    query = (
+        f"UNWIND $rows AS row MERGE (n:{NODE_LABEL} {{id: row.id}}) "
+        f"WITH n, row WHERE NOT n:{item['type']} SET n:{labels}, n += row"
+    )
+    return query, row
+
+
+def get_position_index_cyphers():
+    """
+    Index on the `position` of `CONTAINS` links, for the `order='position'` mode.
+    """
+    return ['CREATE INDEX position_of_contains IF NOT EXISTS FOR ()-[r:CONTAINS]-() ON (r.position);']
+
 
-    def close(self):
-        self.driver.close()
-
-    def ingest(self, items, callback_func, desc='', n_thread=1):
-        if n_thread == 1:
-            args = self.driver, items, callback_func, desc
-            t1 = threading.Thread(target=Neo4jIngestor._ingest_single_thread, args=args)
-            t1.setDaemon(True)
-            t1.start()
-            t1.join()
-        else:
-            threads = []
-            for i, items_part in enumerate(split_list_into_n_parts(items, n_thread)):
-                args = self.driver, items_part, callback_func, desc + '.' + str(i)
-                t1 = threading.Thread(target=Neo4jIngestor._ingest_single_thread, args=args)
-                t1.setDaemon(True)
-                threads.append(t1)
-                t1.start()
-            for t1 in threads:
-                t1.join()
-        
-    def _ingest_single_thread(*args):
-        driver, items, callback_func, desc = args
-        with driver.session(database="neo4j") as session:
-            for item in tqdm.tqdm(items, desc=desc):
-                try:
-                    query = callback_func(item)
-                    session.run(query)
-                except CypherSyntaxError:
-                    query = callback_func(item, ignore_text_content=True)
-                    session.run(query)
-        
 # Example Usage
 if __name__ == "__main__":
     # Example HTML content
-    res = requests.get('https://thaubing.gcaa.org.tw/facility/D32097008938')
+    url = 'https://thaubing.gcaa.org.tw/facility/D32097008938'
+    res = requests.get(url)
     print(res.status_code)
     html_content = res.content.decode('utf-8')
     with open('example.html', 'w') as f:
         f.write(html_content)
-    nodes, links = html_to_graph(html_content)
     conn = Neo4jIngestor("neo4j://localhost:7687", "neo4j", "neo4j")
     try:
-        conn.ingest(nodes, node_to_cypher, desc='nodes', n_thread=8)
-        conn.ingest(links, link_to_cypher, desc='links', n_thread=8)
+        # nodes and links are written while the page is still being converted,
+        # content ids make re-crawling an unchanged page a no-op
+        graph = iter_html_graph(html_content, id_mode='content', source=url)
+        conn.ingest_batch(graph, item_to_row, desc='graph', n_thread=8)
     finally:
         conn.close()
\ No newline at end of file
@@ -0,0 +1,358 @@
+"""
+Persistent HTTP response cache for the crawlers.
+
+Responses are stored on disk under a key made of the normalized method,
+url (sorted query, no fragment), params, body and a few request headers,
+while their bodies are stored once per content hash, so identical
+resources served under several urls take the space of one.
+
+A cached response is served as is while it is fresh (see `ttl` / `ttls`),
+then revalidated with `If-None-Match` / `If-Modified-Since`: a `304 Not
+Modified` only refreshes the entry, and when the server cannot be reached
+the stale response is served. The cache is bounded by `max_bytes`, the
+least recently used entries being evicted first. Access times are kept in
+memory and only written back every `ACCESS_WRITE_INTERVAL` seconds (or by
+`flush`), so that serving fresh entries does not rewrite their files.
+
+With `mode='replay'` nothing is requested at all: every request must be in
+the cache (see `CacheMiss`), which lets a whole crawl be replayed offline,
+together with the browser captures kept by `save_capture`.
+
+Usage:
+    cache = HttpCache('.http_cache', ttls={r'/nav': 12 * 3600}, max_bytes=2 ** 30)
+    res = cache.request(requests, 'GET', url, headers=headers, params=params)
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+CACHE_MODES = ('default', 'refresh', 'replay')
+# request headers which change the response, and so are part of the key
+DEFAULT_KEY_HEADERS = ('accept', 'accept-language', 'content-type')
+# the cached body is the decoded content, these headers no longer apply to it
+_UNSTORED_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding', 'connection')
+# seconds an entry's access time may lag behind on disk
+ACCESS_WRITE_INTERVAL = 300
+
+
+class CacheMiss(requests.exceptions.ConnectionError):
+    """A request is not in the cache while replaying it offline."""
+
+
+def _pairs(values):
+    """(name, value) pairs of params given as a dict (of values or lists) or as pairs."""
+    items = values.items() if isinstance(values, dict) else values
+    for name, value in items:
+        for item in (value if isinstance(value, (list, tuple)) else [value]):
+            yield str(name), '' if item is None else str(item)
+
+
+def cache_key(method, url, params=None, headers=None, data=None, json_body=None, key_headers=DEFAULT_KEY_HEADERS):
+    """
+    Key of a request: the same request sent with its query / params / headers
+    in another order gets the same key.
+
+    Parameters:
+        - method, url, params, headers, data: as given to `requests.request`.
+        - json_body: the `json` argument of `requests.request`.
+        - key_headers: lower-cased names of the headers taken into account.
+    """
+    parts = urlsplit(url)
+    query = list(parse_qsl(parts.query, keep_blank_values=True))
+    if params:
+        query += list(_pairs(params))
+    normalized_url = urlunsplit(
+        (parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', urlencode(sorted(query)), ''))
+    lowered = {name.lower(): value for name, value in (headers or {}).items()}
+    header_values = {name: lowered[name] for name in key_headers if name in lowered}
+    if isinstance(data, bytes):
+        body = hashlib.sha1(data).hexdigest()
+    elif isinstance(data, dict):
+        body = sorted(_pairs(data))
+    else:
+        body = data
+    key = json.dumps(
+        [method.upper(), normalized_url, header_values, body, json_body], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _write_json(path, value):
+    # write then rename, so that a crash never leaves a truncated file
+    with open(path + '.tmp', 'w') as f:
+        json.dump(value, f, ensure_ascii=False, default=str)
+    os.replace(path + '.tmp', path)
+
+
+class HttpCache:
+    """
+    Parameters:
+        - directory: where entries (`entries/`), bodies (`bodies/`) and
+            browser captures (`captures/`) are kept.
+        - ttl: seconds a response is served without revalidation, 0 to always
+            revalidate, None to never.
+        - ttls: per endpoint `ttl`, as `{url regex: ttl}`; the first pattern
+            found in the url wins, otherwise `ttl` applies.
+        - max_bytes: size limit of the stored bodies, None for no limit.
+        - mode: 'default', 'refresh' (always request and store the new
+            response) or 'replay' (never request, raise `CacheMiss`).
+        - key_headers: see `cache_key`.
+    """
+    def __init__(self, directory, ttl=0, ttls=None, max_bytes=None, mode='default', key_headers=DEFAULT_KEY_HEADERS):
+        if mode not in CACHE_MODES:
+            raise ValueError(f'mode should be one of {CACHE_MODES} rather than {mode}')
+        self.directory = directory
+        self.ttl = ttl
+        self.ttls = [(re.compile(pattern), value) for pattern, value in (ttls or {}).items()]
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.key_headers = tuple(name.lower() for name in key_headers)
+        for name in ('entries', 'bodies', 'captures'):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+        # requests may be sent from several threads (see http_fetch.Fetcher)
+        self._lock = threading.RLock()
+        self._entries = {}
+        # key -> access time written to disk, for the entries accessed since
+        self._written_access = {}
+        for name in os.listdir(os.path.join(directory, 'entries')):
+            if name.endswith('.json'):
+                try:
+                    with open(os.path.join(directory, 'entries', name), 'r') as f:
+                        entry = json.load(f)
+                except ValueError:
+                    continue
+                self._entries[entry['key']] = entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def ttl_of(self, url):
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return self.ttl
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, 'entries', f'{key}.json')
+
+    def _body_path(self, digest):
+        return os.path.join(self.directory, 'bodies', digest)
+
+    def _key(self, request):
+        return cache_key(
+            request['method'], request['url'], request.get('params'), request.get('headers'), request.get('data'),
+            request.get('json'), key_headers=self.key_headers)
+
+    def lookup(self, request):
+        """
+        Cached response of a request, whatever its age, or None.
+
+        Parameters:
+            - request: keyword arguments of `requests.request` (method, url, params, headers...).
+        """
+        with self._lock:
+            entry = self._entries.get(self._key(request))
+            return self._response(entry) if entry is not None else None
+
+    def store(self, request, status_code, headers, body):
+        """
+        Keep a response.
+
+        Parameters:
+            - request: see `lookup`.
+            - status_code, headers: of the response.
+            - body: the decoded content.
+        """
+        method, url = request['method'], request['url']
+        key = self._key(request)
+        digest = hashlib.sha256(body).hexdigest()
+        now = time.time()
+        headers = {name: value for name, value in headers.items() if name.lower() not in _UNSTORED_HEADERS}
+        entry = {
+            'key': key,
+            'method': method.upper(),
+            'url': url,
+            'status_code': status_code,
+            'headers': headers,
+            'body': digest,
+            'size': len(body),
+            'etag': CaseInsensitiveDict(headers).get('ETag'),
+            'last_modified': CaseInsensitiveDict(headers).get('Last-Modified'),
+            'stored_at': now,
+            'accessed_at': now,
+        }
+        with self._lock:
+            if not os.path.exists(self._body_path(digest)):
+                with open(self._body_path(digest) + '.tmp', 'wb') as f:
+                    f.write(body)
+                os.replace(self._body_path(digest) + '.tmp', self._body_path(digest))
+            self._entries[key] = entry
+            self._write_entry(entry)
+            self._evict()
+        return entry
+
+    def _touch(self, entry, **changes):
+        """
+        Record an access (and changes) to an entry. A mere access is only
+        written to disk once the one on disk is `ACCESS_WRITE_INTERVAL` old.
+        """
+        written_at = self._written_access.setdefault(entry['key'], entry['accessed_at'])
+        entry.update(changes, accessed_at=time.time())
+        if changes or entry['accessed_at'] - written_at >= ACCESS_WRITE_INTERVAL:
+            self._write_entry(entry)
+
+    def _write_entry(self, entry):
+        _write_json(self._entry_path(entry['key']), entry)
+        self._written_access.pop(entry['key'], None)
+
+    def flush(self):
+        """Write the access times not on disk yet."""
+        with self._lock:
+            for key in list(self._written_access):
+                entry = self._entries.get(key)
+                if entry is None or entry['accessed_at'] == self._written_access[key]:
+                    self._written_access.pop(key)
+                else:
+                    self._write_entry(entry)
+
+    def _response(self, entry):
+        """A `requests.Response` rebuilt from an entry, None if its body is gone."""
+        try:
+            with open(self._body_path(entry['body']), 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        res = requests.Response()
+        res.status_code = entry['status_code']
+        res.headers = CaseInsensitiveDict(entry['headers'])
+        res.url = entry['url']
+        res.encoding = get_encoding_from_headers(res.headers)
+        res._content = content
+        res.from_cache = True
+        return res
+
+    def request(self, session, method, url, **kwargs):
+        """
+        `session.request(method, url, **kwargs)` through the cache.
+
+        Parameters:
+            - session: a `requests.Session`, or the `requests` module.
+
+        Returns:
+            requests.Response: with `from_cache` telling whether it was served
+                from the cache (fresh, or revalidated by a 304), and `stale`
+                set when the revalidation failed with a connection error /
+                timeout and the cached response is served anyway.
+        """
+        key = self._key({**kwargs, 'method': method, 'url': url})
+        with self._lock:
+            entry = self._entries.get(key)
+            cached = self._response(entry) if entry is not None else None
+            if cached is not None and self.mode == 'replay':
+                self._touch(entry)
+                return cached
+        if self.mode == 'replay':
+            raise CacheMiss(f'{method} {url} is not in the cache')
+        if cached is not None and self.mode == 'default':
+            ttl = self.ttl_of(url)
+            if ttl is None or time.time() - entry['stored_at'] < ttl:
+                with self._lock:
+                    self._touch(entry)
+                return cached
+            headers = dict(kwargs.get('headers') or {})
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+            try:
+                res = session.request(method=method, url=url, **{**kwargs, 'headers': headers})
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                # better a stale response than none
+                with self._lock:
+                    self._touch(entry)
+                cached.stale = True
+                return cached
+        else:
+            res = session.request(method=method, url=url, **kwargs)
+        if res.status_code == 304 and cached is not None:
+            with self._lock:
+                self._touch(
+                    entry,
+                    stored_at=time.time(),
+                    etag=res.headers.get('ETag', entry['etag']),
+                    last_modified=res.headers.get('Last-Modified', entry['last_modified'])
+                )
+            return cached
+        if res.status_code == 200:
+            self.store({**kwargs, 'method': method, 'url': url}, res.status_code, res.headers, res.content)
+        res.from_cache = False
+        return res
+
+    def _evict(self):
+        """Drop the least recently used entries until the bodies fit in `max_bytes`."""
+        if self.max_bytes is None:
+            return
+        sizes = {entry['body']: entry['size'] for entry in self._entries.values()}
+        total = sum(sizes.values())
+        if total <= self.max_bytes:
+            return
+        users = {}
+        for entry in self._entries.values():
+            users[entry['body']] = users.get(entry['body'], 0) + 1
+        for entry in sorted(self._entries.values(), key=lambda entry: entry['accessed_at']):
+            if total <= self.max_bytes:
+                break
+            del self._entries[entry['key']]
+            self._written_access.pop(entry['key'], None)
+            os.remove(self._entry_path(entry['key']))
+            users[entry['body']] -= 1
+            if not users[entry['body']]:
+                total -= sizes[entry['body']]
+                try:
+                    os.remove(self._body_path(entry['body']))
+                except FileNotFoundError:
+                    pass
+
+    def _capture_path(self, page_url):
+        name = hashlib.sha1(page_url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'captures', f'{name}.json')
+
+    def save_capture(self, page_url, records):
+        """
+        Keep the requests a browser made for a page (see
+        `requests2cypher.get_webpage_records`), without their bodies. The
+        capture policy the records carry is kept once, with the capture.
+        """
+        policy = records[0].get('policy') if records else None
+        records = [
+            {
+                **{key: value for key, value in record.items() if key != 'policy'},
+                'response': {key: value for key, value in record['response'].items() if key == 'status_code' or key == 'headers'}
+            }
+            for record in records
+        ]
+        _write_json(self._capture_path(page_url), {
+            'url': page_url,
+            'saved_at': time.time(),
+            'policy': policy,
+            'records': records,
+        })
+
+    def load_capture(self, page_url):
+        """
+        Records saved by `save_capture`, their bodies are to be found in the cache.
+        """
+        try:
+            with open(self._capture_path(page_url), 'r') as f:
+                capture = json.load(f)
+        except FileNotFoundError:
+            raise CacheMiss(f'No capture of {page_url} in the cache') from None
+        for record in capture['records']:
+            record['policy'] = capture.get('policy')
+        return capture['records']
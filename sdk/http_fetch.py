@@ -0,0 +1,275 @@
+"""
+Concurrent HTTP fetching and response body decoding for requests2cypher.
+
+`Fetcher.fetch_all` sends many requests at once from a thread pool. The
+pool and the `requests.Session` of each of its threads belong to the
+`Fetcher`, so connections are reused (keep-alive) across the requests and
+the `fetch_all` calls of one `Fetcher`, until `close()` ends them. Requests wait in one queue per
+host and are only handed to a worker when their host has fewer than
+`per_host` requests in flight, so the connections opened to any one site
+are capped without a worker ever waiting on a busy host while requests to
+other hosts are ready. An optional total deadline bounds the whole
+collection: requests which have not started by then are dropped and the
+others get the remaining time as their timeout.
+
+`decode_body` / `captured_body` turn the raw bodies recorded by
+selenium-wire back into content (gzip / deflate / br / zstd), so that
+bodies the browser already downloaded do not have to be fetched again.
+
+Usage:
+    with Fetcher(n_thread=16, per_host=4, timeout=10, deadline=60) as fetcher:
+        for index, response in fetcher.fetch_all([{'method': 'GET', 'url': url}, ...]):
+            ...
+"""
+import gzip
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+# brotli and zstandard come with selenium-wire
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_N_THREAD = 16
+DEFAULT_PER_HOST = 4
+DEFAULT_TIMEOUT = 10
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """The total deadline of `Fetcher.fetch_all` passed before the request could be sent or completed."""
+
+
+class Fetcher:
+    """
+    Parameters:
+        - n_thread: number of requests in flight.
+        - per_host: maximum number of requests in flight to the same host,
+            also the size of the connection pools.
+        - timeout: timeout of a single request, in seconds.
+        - deadline: seconds for a whole `fetch_all`, None for no limit.
+        - cache: an `http_cache.HttpCache` the requests go through.
+
+    The worker threads and their sessions are kept from one `fetch_all` to
+    the next: call `close()` (or use the fetcher as a context manager) once
+    done with it.
+    """
+    def __init__(self, n_thread=DEFAULT_N_THREAD, per_host=DEFAULT_PER_HOST, timeout=DEFAULT_TIMEOUT, deadline=None,
+                 cache=None):
+        self.cache = cache
+        self.n_thread = n_thread
+        self.per_host = per_host
+        self.timeout = timeout
+        self.deadline = deadline
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sessions = []
+        self._executor = None
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def session(self):
+        """Session of the calling thread, created on first use."""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.n_thread, pool_maxsize=self.per_host)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def executor(self):
+        """Thread pool of `fetch_all`, started on first use."""
+        with self._lock:
+            if self.closed:
+                raise RuntimeError('The fetcher is closed')
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.n_thread)
+            return self._executor
+
+    def close(self):
+        """Stop the worker threads and close the connections of every session."""
+        with self._lock:
+            self.closed = True
+            executor, self._executor = self._executor, None
+            sessions, self._sessions = self._sessions, []
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        for session in sessions:
+            session.close()
+
+    def fetch(self, request, end=None):
+        """
+        Send one request.
+
+        Parameters:
+            - request: keyword arguments of `requests.request` (method, url, headers, params...).
+            - end: `time.monotonic()` deadline, see `fetch_all`.
+        """
+        timeout = self.timeout
+        if end is not None:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded(f"Deadline passed before requesting {request['url']}")
+            timeout = min(timeout, remaining)
+        if self.cache is not None:
+            return self.cache.request(self.session(), timeout=timeout, **request)
+        return self.session().request(timeout=timeout, **request)
+
+    def fetch_all(self, requests_kwargs):
+        """
+        Send requests concurrently, at most `per_host` at a time to the same
+        host, taking the hosts in turn.
+
+        Parameters:
+            - requests_kwargs: list of keyword arguments of `requests.request`.
+
+        Yields:
+            tuple: (index in `requests_kwargs`, `requests.Response` or the
+                exception raised), in completion order. Every request yields
+                exactly once, with `DeadlineExceeded` for those cut by the deadline.
+        """
+        end = time.monotonic() + self.deadline if self.deadline is not None else None
+        # host -> requests not sent yet, as (index, request); hosts are taken in turn
+        queues = {}
+        for i, request in enumerate(requests_kwargs):
+            queues.setdefault(urlparse(request['url']).netloc, deque()).append((i, request))
+        hosts = deque(queues)
+        in_flight = dict.fromkeys(queues, 0)
+        futures = {}
+        executor = self.executor()
+
+        def submit_ready():
+            # one request per host and per turn, while workers and host slots are free
+            skipped = 0
+            while hosts and len(futures) < self.n_thread and skipped < len(hosts):
+                host = hosts[0]
+                hosts.rotate(-1)
+                if in_flight[host] >= self.per_host:
+                    skipped += 1
+                    continue
+                skipped = 0
+                i, request = queues[host].popleft()
+                if not queues[host]:
+                    hosts.remove(host)
+                in_flight[host] += 1
+                futures[executor.submit(self.fetch, request, end)] = i, host
+
+        try:
+            submit_ready()
+            while futures:
+                timeout = None if end is None else max(end - time.monotonic(), 0)
+                done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    # deadline: requests still running are abandoned
+                    break
+                for future in done:
+                    i, host = futures.pop(future)
+                    in_flight[host] -= 1
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = e
+                    yield i, result
+                submit_ready()
+            cut = [i for i, _ in futures.values()] + [i for host in hosts for i, _ in queues[host]]
+            for i in sorted(cut):
+                yield i, DeadlineExceeded(f"Deadline passed while requesting {requests_kwargs[i]['url']}")
+        finally:
+            # the requests abandoned at the deadline run out their own timeout in the background
+            for future in futures:
+                future.cancel()
+
+
+def _decode_deflate(body):
+    try:
+        return zlib.decompress(body)
+    except zlib.error:
+        # raw deflate stream, without the zlib header
+        return zlib.decompress(body, -zlib.MAX_WBITS)
+
+
+def _decode_brotli(body):
+    if brotli is None:
+        raise ValueError('brotli is not installed')
+    return brotli.decompress(body)
+
+
+def _decode_zstd(body):
+    if zstandard is None:
+        raise ValueError('zstandard is not installed')
+    return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+
+
+_DECODERS = {
+    'identity': lambda body: body,
+    'gzip': gzip.decompress,
+    'x-gzip': gzip.decompress,
+    'deflate': _decode_deflate,
+    'br': _decode_brotli,
+    'zstd': _decode_zstd,
+}
+
+
+def decode_body(body, content_encoding=None):
+    """
+    Undo the `Content-Encoding` of a raw body.
+
+    Parameters:
+        - body: the bytes sent by the server.
+        - content_encoding: value of the header, e.g. 'gzip' or 'deflate, br'
+            (applied in that order, so undone in reverse).
+
+    Raises:
+        ValueError: for an unknown encoding or a corrupt / truncated body.
+    """
+    codings = [coding.strip().lower() for coding in (content_encoding or '').split(',') if coding.strip()]
+    for coding in reversed(codings):
+        decoder = _DECODERS.get(coding)
+        if decoder is None:
+            raise ValueError(f'Unsupported Content-Encoding {coding!r}')
+        try:
+            body = decoder(body)
+        except ValueError:
+            raise
+        except Exception as e:
+            # OSError / EOFError / zlib.error, brotli.error, zstandard.ZstdError
+            raise ValueError(f'Cannot decode {coding} body: {e}') from e
+    return body
+
+
+def captured_body(method, status_code, headers, body):
+    """
+    Content of a response recorded by the browser, or None when it has to be
+    fetched again: no body while one was expected, fewer bytes than
+    `Content-Length` (e.g. a download cut when the page was left) or an
+    undecodable body.
+
+    Parameters:
+        - method, status_code, headers, body: of the recorded request / response.
+    """
+    if not body:
+        return b'' if method == 'HEAD' or status_code in (204, 304) else None
+    content_length = headers.get('Content-Length')
+    if content_length is not None and content_length.strip().isdigit() and len(body) < int(content_length):
+        return None
+    try:
+        return decode_body(body, headers.get('Content-Encoding'))
+    except ValueError:
+        return None
@@ -7,18 +7,42 @@ Developed by prompt: https://poe.com/s/iGsAR5d8qzsI6DATAqMd
 """
 
 import json
-import uuid
-import tqdm
-import threading
-from neo4j import GraphDatabase
-from neo4j.exceptions import CypherSyntaxError
+from graph_ids import check_id_mode, random_id, content_id, link_content_id, json_digest, json_digests
+from neo4j_ingestor import Neo4jIngestor, NODE_LABEL, NODE_CONSTRAINT_CYPHER, collect_graph, is_link
+from json_events import iter_json_events, DEFAULT_CHUNK_SIZE
+from graph_buffer import GraphBuffer, drain
 
-def json_to_graph(json_data):
+def json_to_graph(json_data, id_mode='uuid', source='', shared_fields=False, uniform_lists=None, order='chain'):
     """
     Converts a JSON object into a graph representation with specific node and link types.
 
     Parameters:
         json_data (dict | list | str | int | float | bool | None): The JSON data to convert.
+        id_mode (str): 'uuid' for random ids, 'content' for ids derived from
+            `source`, the structural path and the content (see graph_ids.py).
+        source (str): The url the JSON comes from, used by the 'content' id mode.
+        shared_fields (bool): Create one `Field` node per distinct field path
+            (list indices ignored) shared by all the records having that field,
+            instead of one `Field` node per record and key. Atomic values are
+            then kept as `value` / `value_type` properties of the `has_field`
+            link, and nested lists / records hang from the record through a
+            `has_value` link carrying the `field` name.
+        uniform_lists (str | None): How to encode a list of at least
+            `UNIFORM_LIST_MIN_ROWS` records sharing the same keys and holding
+            only atomic values (the shape `pattern_match_cyphers/json_struct_list.cypher`
+            looks for), e.g. the NAV history of a fund:
+            - None: as a tree, like any other list.
+            - 'table': one `Table` node with the key names in `columns` and
+                one typed array property per column.
+            - 'rows': the `List` node with one `Row` node per record holding
+                the values as properties (nulls left out).
+        order (str): How the order of list items is kept:
+            - 'chain': an `is_in_front_of` link between consecutive items.
+            - 'position': `position` (from 0) and `sibling_count` properties on
+                the `has_element` links, which an index on
+                `has_element.position` serves (see `get_position_index_cyphers`)
+                without following a chain.
+            - 'both': the two of them.
 
     Returns:
         tuple: A tuple containing two lists:
@@ -27,88 +51,205 @@ def json_to_graph(json_data):
 
     NOTE: Develop Prompt: https://poe.com/s/cUix9NxAto7NEDvaPaYe
     """
-    def generate_id():
-        """Generates a unique ID for each node."""
-        return str(uuid.uuid4())
+    _, nodes, links = collect_graph(iter_json_graph(
+        json_data, id_mode=id_mode, source=source, shared_fields=shared_fields, uniform_lists=uniform_lists,
+        order=order))
+    return nodes, links
 
-    def create_node(node_id, content, node_type):
-        """Creates a node dictionary."""
-        return {"id": node_id, "content": content, "type": node_type}
+def json_to_graph_buffer(json_data, id_mode='uuid', source='', shared_fields=False, uniform_lists=None, order='chain'):
+    """
+    Same as `json_to_graph` but stores the graph in a compact `GraphBuffer`
+    (see graph_buffer.py) instead of lists of dicts.
 
-    def create_link(source_id, target_id, link_type):
-        """Creates a link dictionary."""
-        return {"id": generate_id(), "source": source_id, "target": target_id, "type": link_type}
+    Returns:
+        GraphBuffer
+    """
+    buffer = GraphBuffer()
+    drain(iter_json_graph(
+        json_data, id_mode=id_mode, source=source, shared_fields=shared_fields, uniform_lists=uniform_lists,
+        order=order, buffer=buffer))
+    return buffer
+
+def iter_json_graph(json_data, id_mode='uuid', source='', shared_fields=False, uniform_lists=None, order='chain',
+                    buffer=None):
+    """
+    Generator form of `json_to_graph`.
+
+    Yields nodes and links as soon as they are created (a node always comes
+    before the links that reference it), so the graph can be streamed into
+    `Neo4jIngestor.ingest_batch` with `item_to_row` while it is being built.
+
+    Parameters:
+        buffer (GraphBuffer | None): append the nodes and links to the columns
+            of this buffer instead, without building their dicts; the
+            generator then yields their indices.
 
-    nodes = []
-    links = []
+    Returns:
+        the id of the root node (as the generator return value).
+    """
+    check_id_mode(id_mode)
+    if uniform_lists not in UNIFORM_LIST_MODES:
+        raise ValueError(f'uniform_lists should be one of {UNIFORM_LIST_MODES} rather than {uniform_lists}')
+    check_order(order)
+
+    def generate_id(path, node_type, content):
+        """Generates a unique ID for each node."""
+        if id_mode == 'content':
+            return content_id(source, path, node_type, content)
+        return random_id()
 
-    def process_element(element, parent_id=None, link_type=None):
+    def create_node(node_id, content, node_type, properties=None):
+        """Creates a node dictionary."""
+        if buffer is not None:
+            if properties:
+                return buffer.append(_NODE_PROPERTIES_SHAPE, (node_id, content, node_type, properties))
+            return buffer.append(_NODE_SHAPE, (node_id, content, node_type))
+        node = {"id": node_id, "content": content, "type": node_type}
+        if properties:
+            node["properties"] = properties
+        return node
+
+    def create_link(source_id, target_id, link_type, properties=None):
+        """Creates a link dictionary."""
+        link_id = link_content_id(source_id, target_id, link_type) if id_mode == 'content' else random_id()
+        if buffer is not None:
+            if properties:
+                return buffer.append(_LINK_PROPERTIES_SHAPE, (link_id, source_id, target_id, link_type, properties))
+            return buffer.append(_LINK_SHAPE, (link_id, source_id, target_id, link_type))
+        link = {"id": link_id, "source": source_id, "target": target_id, "type": link_type}
+        if properties:
+            link["properties"] = properties
+        return link
+
+    # field path (list indices replaced by `[*]`) -> id of the shared Field node
+    shared_field_ids = {}
+    # id of every list / record -> hash of its content, for the list item paths
+    digests = json_digests(json_data)[1] if id_mode == 'content' else None
+
+    def shared_field(schema_path, key):
+        """Yields the shared Field node of a field path the first time it is seen."""
+        field_id = shared_field_ids.get(schema_path)
+        if field_id is None:
+            field_id = shared_field_ids[schema_path] = generate_id(schema_path, "Field", key)
+            yield create_node(field_id, key, "Field")
+        return field_id
+
+    def item_paths(path, items):
+        """
+        Paths of the list items. In 'content' mode an item is addressed by the
+        hash of its content (plus an occurrence counter for duplicates) rather
+        than by its index, so inserting a record keeps the ids of the others.
         """
-        Processes a JSON element recursively, creating nodes and links.
+        if id_mode != 'content':
+            return [f'{path}[{i}]' for i in range(len(items))]
+        paths = []
+        seen = {}
+        for item in items:
+            digest = digests[id(item)] if isinstance(item, (list, dict)) else json_digest(item)
+            seen[digest] = seen.get(digest, -1) + 1
+            paths.append(f'{path}[#{digest}:{seen[digest]}]')
+        return paths
+
+    def process_element(element, parent_id=None, link_type=None, path='$', schema_path='$', link_properties=None):
+        """
+        Processes a JSON element recursively, yielding nodes and links.
 
         Parameters:
             element: The current JSON element to process.
             parent_id: The ID of the parent node (if any).
             link_type: The link type connecting the parent to this element (if any).
+            path: The structural path of the element in the document.
+            schema_path: The same path with list indices replaced by `[*]`.
+            link_properties: Properties of the link from the parent (if any).
         """
         if isinstance(element, (int, float, bool, str)) or element is None:
             # AtomicElement node
-            content = str(element) if element is not None else "null"
-            node_type = "Number" if isinstance(element, (int, float)) else \
-                        "Boolean" if isinstance(element, bool) else \
-                        "String"
-            node_id = generate_id()
-            nodes.append(create_node(node_id, content, node_type))
+            content, node_type = atomic_content_and_type(element)
+            node_id = generate_id(path, node_type, content)
+            yield create_node(node_id, content, node_type)
 
             # Create a link to the parent node (if applicable)
             if parent_id and link_type:
-                links.append(create_link(parent_id, node_id, link_type))
+                yield create_link(parent_id, node_id, link_type, link_properties)
 
             return node_id
 
         elif isinstance(element, list):
+            columns = uniform_columns(element) if uniform_lists else None
+            if columns is not None and uniform_lists == 'table':
+                # Table node holding the whole list
+                node_id = generate_id(path, "Table", "Table")
+                yield create_node(node_id, "Table", "Table", table_properties(element, columns))
+                if parent_id and link_type:
+                    yield create_link(parent_id, node_id, link_type, link_properties)
+                return node_id
+
             # List node
-            node_id = generate_id()
-            nodes.append(create_node(node_id, "List", "List"))
+            node_id = generate_id(path, "List", "List")
+            yield create_node(node_id, "List", "List")
 
             # Create a link to the parent node (if applicable)
             if parent_id and link_type:
-                links.append(create_link(parent_id, node_id, link_type))
+                yield create_link(parent_id, node_id, link_type, link_properties)
 
             # Process each element in the list
             item_ids = []
-            for item in element:
-                item_id = process_element(item, parent_id=node_id, link_type="has_element")
+            for i, (item, item_path) in enumerate(zip(element, item_paths(path, element))):
+                position = {"position": i, "sibling_count": len(element)} if order != 'chain' else None
+                if columns is not None:
+                    # Row node with the values of the record as properties
+                    item_id = generate_id(item_path, "Row", "Row")
+                    yield create_node(item_id, "Row", "Row", {key: value for key, value in item.items() if value is not None})
+                    yield create_link(node_id, item_id, "has_element", position)
+                    item_ids.append(item_id)
+                    continue
+                item_id = yield from process_element(
+                    item, parent_id=node_id, link_type="has_element", path=item_path, schema_path=f'{schema_path}[*]',
+                    link_properties=position)
                 item_ids.append(item_id)
 
             # Connect List element one after another
-            for i, item_id in enumerate(item_ids):
-                if i > 0:
-                    links.append(create_link(item_ids[i-1], item_id, 'is_in_front_of'))
+            if order != 'position':
+                for i, item_id in enumerate(item_ids):
+                    if i > 0:
+                        yield create_link(item_ids[i-1], item_id, 'is_in_front_of')
             return node_id
 
         elif isinstance(element, dict):
             # Record node
-            node_id = generate_id()
-            nodes.append(create_node(node_id, "Record", "Record"))
+            node_id = generate_id(path, "Record", "Record")
+            yield create_node(node_id, "Record", "Record")
 
             # Create a link to the parent node (if applicable)
             if parent_id and link_type:
-                links.append(create_link(parent_id, node_id, link_type))
+                yield create_link(parent_id, node_id, link_type, link_properties)
 
             # Process each key-value pair in the dictionary
             for key, value in element.items():
+                step = f'[{json.dumps(key, ensure_ascii=False)}]'
+                if shared_fields:
+                    field_id = yield from shared_field(schema_path + step, key)
+                    if isinstance(value, (list, dict)):
+                        yield create_link(node_id, field_id, "has_field")
+                        yield from process_element(
+                            value, parent_id=node_id, link_type="has_value",
+                            path=path + step, schema_path=schema_path + step, link_properties={"field": key})
+                    else:
+                        content, value_type = atomic_content_and_type(value)
+                        yield create_link(node_id, field_id, "has_field", {"value": content, "value_type": value_type})
+                    continue
+
                 # Create a Field node for the key
-                field_id = generate_id()
-                field_node = create_node(field_id, key, "Field")
-                nodes.append(field_node)
+                field_path = path + step
+                field_id = generate_id(field_path, "Field", key)
+                yield create_node(field_id, key, "Field")
 
                 # Link the Record to the Field
-                links.append(create_link(node_id, field_id, "has_field"))
+                yield create_link(node_id, field_id, "has_field")
 
                 # Process the value and link the Field to the value
-                value_id = process_element(value)
-                links.append(create_link(field_id, value_id, "has_value"))
+                value_id = yield from process_element(value, path=field_path, schema_path=schema_path + step)
+                yield create_link(field_id, value_id, "has_value")
 
             return node_id
 
@@ -116,9 +257,203 @@ def json_to_graph(json_data):
             raise ValueError(f"Unsupported JSON element type: {type(element)}")
 
     # Start processing the JSON data
-    process_element(json_data)
+    return (yield from process_element(json_data))
+
+# keys of the nodes / links, for `GraphBuffer.append`
+_NODE_SHAPE = ("id", "content", "type")
+_NODE_PROPERTIES_SHAPE = _NODE_SHAPE + ("properties",)
+_LINK_SHAPE = ("id", "source", "target", "type")
+_LINK_PROPERTIES_SHAPE = _LINK_SHAPE + ("properties",)
+# see the `uniform_lists` and `order` options of `json_to_graph`
+UNIFORM_LIST_MODES = (None, 'table', 'rows')
+ORDER_MODES = ('chain', 'position', 'both')
+UNIFORM_LIST_MIN_ROWS = 2
+
+
+def check_order(order):
+    if order not in ORDER_MODES:
+        raise ValueError(f'order should be one of {ORDER_MODES} rather than {order}')
+# keys which would collide with the node properties of a Table / Row
+_RESERVED_KEYS = ('id', 'content', 'type', 'columns')
+
+def uniform_columns(items):
+    """
+    Keys shared by all the records of a list, or None when the list is not
+    made of at least `UNIFORM_LIST_MIN_ROWS` records with the same keys and
+    atomic values only.
+    """
+    if len(items) < UNIFORM_LIST_MIN_ROWS or not all(isinstance(item, dict) for item in items):
+        return None
+    columns = list(items[0])
+    keys = set(columns)
+    if not columns or keys.intersection(_RESERVED_KEYS):
+        return None
+    for item in items:
+        if item.keys() != keys or any(isinstance(value, (list, dict)) for value in item.values()):
+            return None
+    return columns
+
+def table_properties(items, columns):
+    """
+    Properties of a Table node: the column names and one array per column.
+    Neo4j arrays are homogeneous and cannot hold nulls, so a column mixing
+    integers and floats is stored as floats, and a column mixing other types
+    or holding nulls as the contents given by `atomic_content_and_type`.
+    """
+    properties = {"columns": columns}
+    for column in columns:
+        values = [item[column] for item in items]
+        if all(isinstance(value, bool) for value in values) or all(isinstance(value, str) for value in values):
+            properties[column] = values
+        elif all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+            is_integer = all(isinstance(value, int) for value in values)
+            properties[column] = values if is_integer else [float(value) for value in values]
+        else:
+            properties[column] = [atomic_content_and_type(value)[0] for value in values]
+    return properties
 
-    return nodes, links
+def atomic_content_and_type(element):
+    """
+    Content and node type of an atomic JSON value (str, int, float, bool or None).
+    """
+    content = str(element) if element is not None else "null"
+    node_type = "Number" if isinstance(element, (int, float)) else \
+                "Boolean" if isinstance(element, bool) else \
+                "String"
+    return content, node_type
+
+def iter_json_stream_graph(stream, id_mode='uuid', source='', shared_fields=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                           order='chain'):
+    """
+    Streaming form of `iter_json_graph` for documents too large (or too deep)
+    to be loaded with `json.load`.
+
+    The JSON is read incrementally from `stream` as parse events (see
+    json_events.py) and converted with an explicit stack instead of recursion,
+    so the memory use only depends on the nesting depth. Nodes and links are
+    the same as those of `iter_json_graph`, except that:
+        - `is_in_front_of` links are yielded as soon as the next list item starts.
+        - in 'content' mode list items are addressed by their index, since the
+          hash of an item is only known once the whole item is read.
+        - with `order='position'` / 'both', the `has_element` links of a list are
+          yielded when the list ends, once `sibling_count` is known.
+
+    Parameters:
+        - stream: a file-like object, e.g. `open(path, 'rb')` or `socket.makefile('rb')`.
+        - id_mode, source, shared_fields, order: see `json_to_graph`.
+        - chunk_size: size of the chunks read from `stream`.
+
+    Returns:
+        the id of the root node (as the generator return value).
+    """
+    check_id_mode(id_mode)
+    check_order(order)
+
+    def generate_id(path, node_type, content):
+        if id_mode == 'content':
+            return content_id(source, path, node_type, content)
+        return random_id()
+
+    def create_link(source_id, target_id, link_type, properties=None):
+        link_id = link_content_id(source_id, target_id, link_type) if id_mode == 'content' else random_id()
+        link = {"id": link_id, "source": source_id, "target": target_id, "type": link_type}
+        if properties:
+            link["properties"] = properties
+        return link
+
+    # one frame per open List / Record, holding the position of the next child
+    stack = []
+    root_id = None
+    # field path (list indices replaced by `[*]`) -> id of the shared Field node
+    shared_field_ids = {}
+
+    def start_value(content, node_type):
+        """Create the node of a value and the links attaching it to its parent."""
+        nonlocal root_id
+        parent = stack[-1] if stack else None
+        if shared_fields and parent is not None and parent['type'] == 'Record':
+            if node_type not in ("List", "Record"):
+                # atomic values become properties of the link to the shared Field
+                yield create_link(parent['id'], parent['field_id'], "has_field", {"value": content, "value_type": node_type})
+                return None, None
+            yield create_link(parent['id'], parent['field_id'], "has_field")
+        if id_mode != 'content':
+            # paths grow with the depth and are only needed for content ids
+            path = None
+        elif parent is None:
+            path = '$'
+        elif parent['type'] == 'Record':
+            path = parent['field_path']
+        else:
+            path = f"{parent['path']}[{parent['index']}]"
+        node_id = generate_id(path, node_type, content)
+        yield {"id": node_id, "content": content, "type": node_type}
+        if parent is None:
+            root_id = node_id
+        elif parent['type'] == 'Record' and shared_fields:
+            yield create_link(parent['id'], node_id, "has_value", {"field": parent['field_key']})
+        elif parent['type'] == 'Record':
+            yield create_link(parent['field_id'], node_id, "has_value")
+        else:
+            if order == 'chain':
+                yield create_link(parent['id'], node_id, "has_element")
+            else:
+                parent['item_ids'].append(node_id)
+            if parent['last_id'] is not None and order != 'position':
+                yield create_link(parent['last_id'], node_id, 'is_in_front_of')
+            parent['index'] += 1
+            parent['last_id'] = node_id
+        return node_id, path
+
+    def child_schema_path():
+        """Field path of the value being started, only tracked for `shared_fields`."""
+        if not shared_fields:
+            return None
+        if not stack:
+            return '$'
+        parent = stack[-1]
+        return parent['field_schema_path'] if parent['type'] == 'Record' else parent['schema_path'] + '[*]'
+
+    for event, value in iter_json_events(stream, chunk_size=chunk_size):
+        if event == 'start_map':
+            schema_path = child_schema_path()
+            node_id, path = yield from start_value("Record", "Record")
+            stack.append({'type': 'Record', 'id': node_id, 'path': path, 'schema_path': schema_path,
+                          'field_path': None, 'field_schema_path': None, 'field_id': None, 'field_key': None})
+        elif event == 'start_array':
+            schema_path = child_schema_path()
+            node_id, path = yield from start_value("List", "List")
+            stack.append({'type': 'List', 'id': node_id, 'path': path, 'schema_path': schema_path,
+                          'index': 0, 'last_id': None, 'item_ids': []})
+        elif event == 'map_key':
+            record = stack[-1]
+            step = f"[{json.dumps(value, ensure_ascii=False)}]"
+            field_path = record['path'] + step if id_mode == 'content' else None
+            if shared_fields:
+                field_schema_path = record['schema_path'] + step
+                field_id = shared_field_ids.get(field_schema_path)
+                if field_id is None:
+                    field_id = shared_field_ids[field_schema_path] = generate_id(field_schema_path, "Field", value)
+                    yield {"id": field_id, "content": value, "type": "Field"}
+                # the has_field link is created with the value, see `start_value`
+                record['field_schema_path'] = field_schema_path
+            else:
+                field_id = generate_id(field_path, "Field", value)
+                yield {"id": field_id, "content": value, "type": "Field"}
+                yield create_link(record['id'], field_id, "has_field")
+            record['field_path'] = field_path
+            record['field_id'] = field_id
+            record['field_key'] = value
+        elif event in ('end_map', 'end_array'):
+            frame = stack.pop()
+            if frame['type'] == 'List' and order != 'chain':
+                for i, item_id in enumerate(frame['item_ids']):
+                    yield create_link(frame['id'], item_id, "has_element",
+                                      {"position": i, "sibling_count": len(frame['item_ids'])})
+        else:
+            content, node_type = atomic_content_and_type(value)
+            yield from start_value(content, node_type)
+    return root_id
 
 def node_to_cypher(node, ignore_text_content=False) -> str:
     """
@@ -127,9 +462,9 @@ def node_to_cypher(node, ignore_text_content=False) -> str:
     """
     if ignore_text_content:
         content = '[CANNOT ATTACH TO CYPHER]'
-        node_query = f"CREATE (:{node['type']} {{id: '{node['id']}', content: '{content}', type: '{node['type']}'}});"
+        node_query = f"CREATE (:{NODE_LABEL}:{node['type']} {{id: '{node['id']}', content: '{content}', type: '{node['type']}'}});"
     else:
-        node_query = f"CREATE (:{node['type']} {{id: '{node['id']}', content: '{node['content']}', type: '{node['type']}'}});"
+        node_query = f"CREATE (:{NODE_LABEL}:{node['type']} {{id: '{node['id']}', content: '{node['content']}', type: '{node['type']}'}});"
     return  node_query
 
 def link_to_cypher(link) -> str:
@@ -138,90 +473,116 @@ def link_to_cypher(link) -> str:
         - link is a dictionary with keys 'id', 'source', 'target', and 'type'.
     """
     link_query = (
-            f"MATCH (a {{id: '{link['source']}'}}), (b {{id: '{link['target']}'}}) "
+            f"MATCH (a:{NODE_LABEL} {{id: '{link['source']}'}}), (b:{NODE_LABEL} {{id: '{link['target']}'}}) "
             f"CREATE (a)-[:{link['type']} {{id: '{link['id']}'}}]->(b);"
         )
     return link_query
 
-def split_list_into_n_parts(lst, n):
+def node_to_row(node):
     """
-    Splits a list into n sublists as evenly as possible.
-    
-    Args:
-    lst (list): The list to be split.
-    n (int): The number of sublists to create.
-    
+    Batch counterpart of `node_to_cypher` used by `Neo4jIngestor.ingest_batch`.
+
+    Parameters:
+        - node is a dictionary with keys 'id', 'content', and 'type'.
+
     Returns:
-    list of lists: A list containing n sublists.
-    """
-    # If n is larger than the list length, we can only return actual list elements
-    if n > len(lst):
-        return [lst[i:i + 1] for i in range(len(lst))] + [[] for _ in range(n - len(lst))]
-
-    # Calculate the size of each part: the minimum size of sublists
-    part_size, remainder = divmod(len(lst), n)
-
-    # Create the sublists
-    sublists = []
-    start = 0
-    for i in range(n):
-        # Add an extra element to some sublists to distribute the remainder
-        end = start + part_size + (1 if i < remainder else 0)
-        sublists.append(lst[start:end])
-        start = end
-
-    return sublists
-
-class Neo4jIngestor:
-    def __init__(self, uri, user, password):
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
-
-    def close(self):
-        self.driver.close()
-
-    def ingest(self, items, callback_func, desc='', n_thread=1):
-        if n_thread == 1:
-            args = self.driver, items, callback_func, desc
-            t1 = threading.Thread(target=Neo4jIngestor._ingest_single_thread, args=args)
-            t1.setDaemon(True)
-            t1.start()
-            t1.join()
-        else:
-            threads = []
-            for i, items_part in enumerate(split_list_into_n_parts(items, n_thread)):
-                args = self.driver, items_part, callback_func, desc + '.' + str(i)
-                t1 = threading.Thread(target=Neo4jIngestor._ingest_single_thread, args=args)
-                t1.setDaemon(True)
-                threads.append(t1)
-                t1.start()
-            for t1 in threads:
-                t1.join()
-        
-    def _ingest_single_thread(*args):
-        driver, items, callback_func, desc = args
-        with driver.session(database="neo4j") as session:
-            for item in tqdm.tqdm(items, desc=desc):
-                try:
-                    query = callback_func(item)
-                    session.run(query)
-                except CypherSyntaxError:
-                    query = callback_func(item, ignore_text_content=True)
-                    session.run(query)
-
-node_types = ['Field', 'List', 'Number', 'Record', 'String']
+        tuple: the `UNWIND` query template shared by all nodes of the same type
+            and the row of parameters for this node.
+    """
+    query = f"UNWIND $rows AS row CREATE (n:{NODE_LABEL}:{node['type']}) SET n = row"
+    return query, _node_properties(node)
+
+def link_to_row(link):
+    """
+    Batch counterpart of `link_to_cypher` used by `Neo4jIngestor.ingest_batch`.
+
+    Parameters:
+        - link is a dictionary with keys 'id', 'source', 'target', and 'type',
+            plus 'properties' for some links of the `shared_fields` mode.
+    """
+    query = (
+            "UNWIND $rows AS row "
+            f"MATCH (a:{NODE_LABEL} {{id: row.source}}), (b:{NODE_LABEL} {{id: row.target}}) "
+            f"CREATE (a)-[r:{link['type']} {{id: row.id}}]->(b)"
+        )
+    return _with_link_properties(query, link)
+
+def _with_link_properties(query, link):
+    """
+    Row of a link, setting the `properties` of `shared_fields` links when present.
+    """
+    row = {'id': link['id'], 'source': link['source'], 'target': link['target']}
+    if 'properties' in link:
+        query += " SET r += row.properties"
+        row['properties'] = link['properties']
+    return query, row
+
+def _node_properties(node):
+    """
+    Properties of a node, including those of the Table / Row nodes of `uniform_lists`.
+    """
+    return {'id': node['id'], 'content': node['content'], 'type': node['type'], **node.get('properties', {})}
+
+def node_to_record(node):
+    """
+    Labels (besides `:Node`) and properties of a node, shared by the
+    Cypher templates and the file exporters (see bulk_export.py).
+    """
+    return [node['type']], _node_properties(node)
+
+def link_to_record(link):
+    """
+    Relationship type and properties of a link, see `node_to_record`.
+    """
+    return link['type'], {'id': link['id'], **link.get('properties', {})}
+
+def item_to_row(item):
+    """
+    Batch template for the mixed node / link stream of `iter_json_graph`.
+
+    Batches of a stream may be committed in any order, so nodes and link
+    endpoints are MERGEd on `Node.id` instead of relying on the nodes
+    being written first. Nodes already carrying their type label and links
+    already present are left untouched, so re-ingesting an unchanged graph
+    converted with `id_mode='content'` writes nothing. Nothing is removed
+    either: when a value changed, its new node is added next to the old one.
+    Use `graph_diff.sync_graph` with this template to update a graph.
+    """
+    if is_link(item):
+        query = (
+                "UNWIND $rows AS row "
+                f"MERGE (a:{NODE_LABEL} {{id: row.source}}) "
+                f"MERGE (b:{NODE_LABEL} {{id: row.target}}) "
+                f"MERGE (a)-[r:{item['type']} {{id: row.id}}]->(b)"
+            )
+        return _with_link_properties(query, item)
+    query = (
+            f"UNWIND $rows AS row MERGE (n:{NODE_LABEL} {{id: row.id}}) "
+            f"WITH n, row WHERE NOT n:{item['type']} SET n:{item['type']}, n += row"
+        )
+    return query, _node_properties(item)
+
+node_types = ['Field', 'List', 'Number', 'Record', 'Row', 'String', 'Table']
 link_types = ['has_element', 'has_field', 'has_value', 'is_in_front_of']
 
 
 def get_node_constraint_cyphers():
-    cyphers = []
-    for node_type in node_types:
-        cyphers.append()
-    return cyphers
+    """
+    All node types share the `:Node` label, so one uniqueness constraint
+    on `Node.id` covers them and backs the link lookups.
+    """
+    return [NODE_CONSTRAINT_CYPHER]
+
+def get_position_index_cyphers():
+    """
+    Index on the `position` of `has_element` links, for the `order='position'` mode.
+    """
+    return ['CREATE INDEX position_of_has_element IF NOT EXISTS FOR ()-[r:has_element]-() ON (r.position);']
 
 def get_link_constraint_cyphers():
     cyphers = []
     for link_type in link_types:
-        cyphers.append(f'CREATE CONSTRAINT unique_id_for_{link_type.lower()} FOR ()-[n:{link_type})-() REQUIRE n.id IS UNIQUE;')
+        cyphers.append(f'CREATE CONSTRAINT unique_id_for_{link_type.lower()} IF NOT EXISTS FOR ()-[n:{link_type}]-() REQUIRE n.id IS UNIQUE;')
     return cyphers
     
 
@@ -229,21 +590,17 @@ def get_link_constraint_cyphers():
 # Example usage
 if __name__ == "__main__":
     # sample_json = json.load(open('../examples/cnyes/funds/jsons/RegionCrawler.json', 'r'))
-    # sample_json = json.load(open('pypi.json', 'r')) NOTE: too complex
-    # sample_json = json.load(open('html.json', 'r')) NOTE: entire html too complex
+    # large documents (e.g. pypi.json, html.json) can be streamed with
+    # `iter_json_stream_graph(open(path, 'rb'))` instead of `json.load`
     sample_json = json.load(open('endpoint_records.json', 'r'))
-    nodes, links = json_to_graph(sample_json)
-    conn = Neo4jIngestor("neo4j://localhost:7687", "neo4j", "neo4j")
+    conn = Neo4jIngestor(
+        "neo4j://localhost:7687", "neo4j", "neo4j",
+        constraint_cyphers=get_node_constraint_cyphers() + get_link_constraint_cyphers()
+    )
     try:
-        conn.ingest(node_types, 
-                    lambda node_type: f'CREATE CONSTRAINT unique_id_for_{node_type.lower()} FOR (n:{node_type}) REQUIRE n.id IS UNIQUE;', 
-                    desc='node_constraint'
-        )
-        conn.ingest(link_types, 
-                    lambda link_type: f'CREATE CONSTRAINT unique_id_for_{link_type.lower()} FOR ()-[n:{link_type}]-() REQUIRE n.id IS UNIQUE;', 
-                    desc='link_constraint'
-        )
-        conn.ingest(nodes, node_to_cypher, desc='nodes', n_thread=16)
-        conn.ingest(links, link_to_cypher, desc='links', n_thread=16)
+        # nodes and links are written while the graph is still being built,
+        # content ids make running this script twice a no-op
+        graph = iter_json_graph(sample_json, id_mode='content', source='endpoint_records.json')
+        conn.ingest_batch(graph, item_to_row, desc='graph', n_thread=16)
     finally:
         conn.close()
\ No newline at end of file
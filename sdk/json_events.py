@@ -0,0 +1,171 @@
+"""
+Incremental JSON parsing into a flat stream of parse events.
+
+`iter_json_events` reads a file / socket object chunk by chunk and yields
+`(event, value)` pairs with the same names as `ijson.basic_parse`:
+
+    start_map, map_key, end_map, start_array, end_array,
+    null, boolean, integer, double, string
+
+so that a document never has to be loaded as a whole. When ijson is
+installed its C backend is used, otherwise a pure Python tokenizer.
+"""
+import codecs
+import json
+import re
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_NUMBER = re.compile(r'-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?')
+_NUMBER_CHARS = re.compile(r'[-+.eE0-9]*')
+# what the tokenizer expects next -> description for the error messages
+_STATES = {
+    'value': 'a value',
+    'value_or_close': "a value or ']'",
+    'key': 'a key',
+    'key_or_close': "a key or '}'",
+    'colon': "':'",
+    'comma': "',' or the end of the container",
+    'end': 'the end of the stream',
+}
+_LITERALS = {
+    'true': ('boolean', True),
+    'false': ('boolean', False),
+    'null': ('null', None),
+}
+
+
+def iter_json_events(stream, chunk_size=DEFAULT_CHUNK_SIZE, use_ijson=True):
+    """
+    Parameters:
+        - stream: a file-like object with `read(size)`, in text or binary mode
+            (e.g. `open(path, 'rb')` or `socket.makefile('rb')`).
+        - chunk_size: number of bytes / characters read at a time.
+        - use_ijson: use ijson when it is installed.
+    """
+    if use_ijson and ijson is not None:
+        yield from ijson.basic_parse(stream, use_float=True, buf_size=chunk_size)
+    else:
+        yield from _iter_events(stream, chunk_size)
+
+
+def _iter_events(stream, chunk_size):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    eof = False
+    # '{' or '[' of the open containers
+    containers = []
+    # what may come next, see `_STATES`
+    state = 'value'
+
+    def more():
+        """Append the next chunk to the buffer, return False at the end of the stream."""
+        nonlocal buffer, pos, eof
+        if eof:
+            return False
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            # the end of the stream is told by the raw read: a short read
+            # inside a multi-byte character decodes to ''
+            eof = True
+            chunk = decoder.decode(b'', final=True)
+            if not chunk:
+                return False
+        elif isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        return True
+
+    def unexpected(char):
+        return ValueError(f'Unexpected {char!r} in JSON stream, expecting {_STATES[state]}')
+
+    def after_value():
+        return 'comma' if containers else 'end'
+
+    while True:
+        pos = _WHITESPACE.match(buffer, pos).end()
+        if pos >= len(buffer):
+            if more():
+                continue
+            break
+        char = buffer[pos]
+        if char == '{' or char == '[':
+            if state != 'value' and state != 'value_or_close':
+                raise unexpected(char)
+            containers.append(char)
+            state = 'key_or_close' if char == '{' else 'value_or_close'
+            pos += 1
+            yield ('start_map' if char == '{' else 'start_array'), None
+        elif char == '}' or char == ']':
+            opening = '{' if char == '}' else '['
+            if not containers or containers[-1] != opening or \
+                    state not in ('comma', 'key_or_close' if char == '}' else 'value_or_close'):
+                raise unexpected(char)
+            containers.pop()
+            state = after_value()
+            pos += 1
+            yield ('end_map' if char == '}' else 'end_array'), None
+        elif char == ',':
+            if state != 'comma':
+                raise unexpected(char)
+            state = 'key' if containers[-1] == '{' else 'value'
+            pos += 1
+        elif char == ':':
+            if state != 'colon':
+                raise unexpected(char)
+            state = 'value'
+            pos += 1
+        elif char == '"':
+            if state not in ('key', 'key_or_close', 'value', 'value_or_close'):
+                raise unexpected(char)
+            match = _STRING.match(buffer, pos)
+            while match is None and more():
+                match = _STRING.match(buffer, pos)
+            if match is None:
+                raise ValueError('Unterminated string in JSON stream')
+            pos = match.end()
+            value = json.loads(match.group())
+            if state == 'key' or state == 'key_or_close':
+                state = 'colon'
+                yield 'map_key', value
+            else:
+                state = after_value()
+                yield 'string', value
+        else:
+            if state != 'value' and state != 'value_or_close':
+                raise unexpected(char)
+            if char == '-' or char.isdigit():
+                # a number only ends at the first character that cannot be part of it
+                while _NUMBER_CHARS.match(buffer, pos).end() == len(buffer) and more():
+                    pass
+                match = _NUMBER.match(buffer, pos)
+                if match is None:
+                    raise ValueError(f'Invalid number {buffer[pos:pos + 10]!r} in JSON stream')
+                pos = match.end()
+                state = after_value()
+                if match.group(1) or match.group(2):
+                    yield 'double', float(match.group())
+                else:
+                    yield 'integer', int(match.group())
+                continue
+            while len(buffer) - pos < 5 and more():
+                pass
+            for literal, event in _LITERALS.items():
+                if buffer.startswith(literal, pos):
+                    pos += len(literal)
+                    state = after_value()
+                    yield event
+                    break
+            else:
+                raise ValueError(f'Unexpected {buffer[pos:pos + 10]!r} in JSON stream')
+    if state != 'end':
+        raise ValueError('Unexpected end of JSON stream')
@@ -0,0 +1,489 @@
+"""
+Shared Neo4j ingestion helpers for json2cypher, html2cypher and requests2cypher.
+
+Two ingestion modes are provided:
+- `Neo4jIngestor.ingest`: one cypher statement per item (legacy, f-string based).
+- `Neo4jIngestor.ingest_batch`: items are turned into `(query, row)` pairs,
+    grouped by query template and sent as parameter lists through
+    `UNWIND $rows AS row ...` inside explicit write transactions.
+
+Both modes accept a list or any iterator / generator. Items are streamed
+through a bounded queue to a persistent pool of writer threads owned by the
+ingestor, so converting a document and writing it to Neo4j overlap, memory
+stays flat and idle writers pick up whatever work is left.
+
+Every converter node carries the shared `:Node` label. Link queries match
+through it so that lookups hit the `Node.id` uniqueness index, which is
+created by `Neo4jIngestor.prepare` before the first write.
+"""
+import queue
+import threading
+import time
+from collections.abc import Sized
+import tqdm
+from neo4j import GraphDatabase
+from neo4j.exceptions import CypherSyntaxError, TransientError
+
+DEFAULT_BATCH_SIZE = 1000
+# maximum number of pending items / batches between the producer and the writers
+DEFAULT_QUEUE_SIZE = 64
+# seconds the driver keeps retrying a failed transaction before a batch is split
+DEFAULT_RETRY_TIME = 5.0
+NODE_LABEL = 'Node'
+NODE_CONSTRAINT_CYPHER = f'CREATE CONSTRAINT unique_id_for_node IF NOT EXISTS FOR (n:{NODE_LABEL}) REQUIRE n.id IS UNIQUE'
+# shutdown marker put on the work queue, one per worker
+_STOP = object()
+
+
+def split_list_into_n_parts(lst, n):
+    """
+    Splits a list into n sublists as evenly as possible.
+
+    Args:
+    lst (list): The list to be split.
+    n (int): The number of sublists to create.
+
+    Returns:
+    list of lists: A list containing n sublists.
+    """
+    # If n is larger than the list length, we can only return actual list elements
+    if n > len(lst):
+        return [lst[i:i + 1] for i in range(len(lst))] + [[] for _ in range(n - len(lst))]
+
+    # Calculate the size of each part: the minimum size of sublists
+    part_size, remainder = divmod(len(lst), n)
+
+    # Create the sublists
+    sublists = []
+    start = 0
+    for i in range(n):
+        # Add an extra element to some sublists to distribute the remainder
+        end = start + part_size + (1 if i < remainder else 0)
+        sublists.append(lst[start:end])
+        start = end
+
+    return sublists
+
+
+def quote_label(label):
+    """
+    Escape a label or relationship type so it can be embedded into a query template.
+    """
+    return '`' + str(label).replace('`', '``') + '`'
+
+
+def iter_batches(items, callback_func, batch_size=DEFAULT_BATCH_SIZE, n_partition=1):
+    """
+    Groups items by the query template produced by `callback_func`
+    and yields a `(query, rows)` batch as soon as a group holds `batch_size` rows.
+    The remaining partial groups are flushed once `items` is exhausted,
+    so `items` can be a generator that is never fully materialized.
+
+    Parameters:
+        - items: nodes or links to be ingested (any iterable).
+        - callback_func: maps an item into a `(query, row)` tuple where `query`
+            is an `UNWIND $rows AS row ...` template and `row` its parameters.
+            An empty query skips the item.
+        - batch_size: maximum number of rows sent in one transaction.
+        - n_partition: link rows are further split into this many groups
+            by their `source` node, so that all links of one node end up in
+            the same few batches instead of touching it from every batch.
+    """
+    groups = {}
+    for item in items:
+        query, row = callback_func(item)
+        if not query:
+            continue
+        key = query
+        if n_partition > 1 and 'source' in row:
+            key = query, hash(row['source']) % n_partition
+        rows = groups.setdefault(key, [])
+        rows.append(row)
+        if len(rows) >= batch_size:
+            yield query, rows
+            groups[key] = []
+    for key, rows in groups.items():
+        if rows:
+            yield (key if isinstance(key, str) else key[0]), rows
+
+
+def group_into_batches(items, callback_func, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    List form of `iter_batches`.
+
+    Returns:
+        list of `(query, rows)` tuples.
+    """
+    return list(iter_batches(items, callback_func, batch_size))
+
+
+def batch_node_ids(rows):
+    """
+    Ids of the nodes a batch locks while it is written:
+    both endpoints of every link row, or the id of every node row.
+    """
+    ids = set()
+    for row in rows:
+        if 'source' in row:
+            ids.add(row['source'])
+            ids.add(row['target'])
+        elif 'id' in row:
+            ids.add(row['id'])
+    return ids
+
+
+def is_link(item):
+    """
+    Tell a link apart from a node in a mixed stream of graph items.
+    """
+    return 'source' in item and 'target' in item
+
+
+def collect_graph(items):
+    """
+    Split a mixed stream of graph items into node and link lists.
+
+    Parameters:
+        - items: an iterator of nodes and links (e.g., `iter_json_graph`).
+
+    Returns:
+        tuple: (return value of the generator, nodes, links)
+    """
+    nodes = []
+    links = []
+    items = iter(items)
+    while True:
+        try:
+            item = next(items)
+        except StopIteration as stop:
+            return stop.value, nodes, links
+        if is_link(item):
+            links.append(item)
+        else:
+            nodes.append(item)
+
+
+def _task_node_ids(task):
+    _, handle, item, _ = task
+    if handle is Neo4jIngestor._ingest_rows:
+        return batch_node_ids(item[1])
+    return set()
+
+
+class _Job:
+    """
+    Book-keeping of one `ingest` / `ingest_batch` call on the shared worker pool.
+
+    A job keeps its own commit latency figures, so that a job of single
+    statements does not set the baseline a job of large batches is judged by,
+    and never runs more than `n_thread` tasks at once, whatever the pool size.
+    """
+    def __init__(self, desc, total=None, n_thread=1):
+        self.pending = 0
+        self.errors = []
+        self.cond = threading.Condition()
+        self.progress = tqdm.tqdm(desc=desc, total=total)
+        self.n_thread = n_thread
+        # tasks being written, guarded by the pool condition
+        self.running = 0
+        self.latency = None
+        self.best_latency = None
+        self.n_observed = 0
+
+    def add(self):
+        with self.cond:
+            self.pending += 1
+
+    def done(self, error=None):
+        with self.cond:
+            if error is not None:
+                self.errors.append(error)
+            self.pending -= 1
+            self.progress.update()
+            if self.pending == 0:
+                self.cond.notify_all()
+
+    def wait(self):
+        with self.cond:
+            while self.pending > 0:
+                self.cond.wait()
+        self.progress.close()
+
+
+class _WorkerPool:
+    """
+    Long-lived writer threads sharing one bounded work queue.
+
+    Every worker keeps its own session open for its whole life and takes the
+    next task as soon as it is idle, so throughput follows the fastest workers
+    instead of the slowest static slice.
+
+    Batches claim the ids of the nodes they lock (see `batch_node_ids`) before
+    they are written, and a batch whose nodes are claimed by a running batch is
+    deferred until they are released. Two workers therefore never lock the same
+    node at the same time, which removes the deadlocks between relationship
+    batches sharing a parent node. The number of workers allowed to take
+    tasks (`active`) is adapted to the commit latency observed for the running
+    job: it shrinks while latency degrades (lock contention, overloaded server)
+    and grows back while latency stays close to the best one seen in that job.
+    Each job starts again from all the workers, and the tasks of a job only
+    take up to its `n_thread` workers.
+    """
+    # completed tasks between two adaptation steps
+    ADAPT_EVERY = 32
+    # weight of the newest sample in the latency moving average
+    EWMA_ALPHA = 0.2
+    SHRINK_RATIO = 2.0
+    GROW_RATIO = 1.25
+
+    def __init__(self, driver, queue_size):
+        self.driver = driver
+        self.tasks = queue.Queue(maxsize=queue_size)
+        # tasks waiting for their nodes to be released, with their node ids
+        self.deferred = []
+        self.max_deferred = queue_size
+        self.claimed = set()
+        self.threads = []
+        self.max_workers = 0
+        self.active = 0
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def resize(self, n_worker):
+        """
+        Make sure at least `n_worker` workers exist, and let all of them take
+        tasks again (a job starts from a fresh latency baseline, see `_Job`).
+        """
+        with self.cond:
+            while len(self.threads) < n_worker:
+                t1 = threading.Thread(target=self._work, args=(len(self.threads),))
+                t1.setDaemon(True)
+                self.threads.append(t1)
+                t1.start()
+            self.max_workers = max(self.max_workers, n_worker)
+            self.active = self.max_workers
+            self.cond.notify_all()
+
+    def submit(self, job, handle, item, callback_func):
+        job.add()
+        self.tasks.put((job, handle, item, callback_func))
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for _ in self.threads:
+            self.tasks.put(_STOP)
+        for t1 in self.threads:
+            t1.join()
+
+    def _work(self, index):
+        with self.driver.session(database="neo4j") as session:
+            while True:
+                with self.cond:
+                    while index >= self.active and not self.closed:
+                        self.cond.wait()
+                task, node_ids = self._next_task()
+                if task is None:
+                    continue
+                if task is _STOP:
+                    break
+                job, handle, item, callback_func = task
+                start = time.perf_counter()
+                try:
+                    if job.errors:
+                        # the job already failed, drain its remaining tasks
+                        job.done()
+                        continue
+                    handle(session, item, callback_func)
+                except Exception as e:
+                    job.done(e)
+                else:
+                    self._observe(job, time.perf_counter() - start)
+                    job.done()
+                finally:
+                    self._release(job, node_ids)
+
+    def _next_task(self):
+        """
+        Take a deferred task which can run (its nodes are free and its job
+        is below `n_thread` running tasks), otherwise the next queued task.
+
+        Returns:
+            tuple: (task, claimed node ids), or (None, None) when the queued
+                task had to be deferred.
+        """
+        with self.cond:
+            while True:
+                for i, (task, node_ids) in enumerate(self.deferred):
+                    if self._can_run(task, node_ids):
+                        del self.deferred[i]
+                        return self._claim(task, node_ids)
+                if len(self.deferred) < self.max_deferred or self.closed:
+                    break
+                self.cond.wait()
+            has_deferred = bool(self.deferred)
+        try:
+            # deferred tasks may become runnable while the queue stays empty
+            task = self.tasks.get(timeout=0.1 if has_deferred else None)
+        except queue.Empty:
+            return None, None
+        if task is _STOP:
+            return task, set()
+        node_ids = _task_node_ids(task)
+        with self.cond:
+            if self._can_run(task, node_ids):
+                return self._claim(task, node_ids)
+            self.deferred.append((task, node_ids))
+        return None, None
+
+    def _can_run(self, task, node_ids):
+        return task[0].running < task[0].n_thread and self.claimed.isdisjoint(node_ids)
+
+    def _claim(self, task, node_ids):
+        task[0].running += 1
+        self.claimed |= node_ids
+        return task, node_ids
+
+    def _release(self, job, node_ids):
+        with self.cond:
+            job.running -= 1
+            self.claimed -= node_ids
+            self.cond.notify_all()
+
+    def _observe(self, job, latency):
+        with self.cond:
+            if job.latency is None:
+                job.latency = latency
+            else:
+                job.latency = self.EWMA_ALPHA * latency + (1 - self.EWMA_ALPHA) * job.latency
+            job.n_observed += 1
+            if job.n_observed % self.ADAPT_EVERY:
+                return
+            if job.best_latency is None or job.latency < job.best_latency:
+                job.best_latency = job.latency
+            if job.latency > self.SHRINK_RATIO * job.best_latency and self.active > 1:
+                self.active -= 1
+            elif job.latency < self.GROW_RATIO * job.best_latency and self.active < self.max_workers:
+                self.active += 1
+                self.cond.notify_all()
+
+
+class Neo4jIngestor:
+    # (uri, database, constraint cypher) already in place
+    _prepared = set()
+    _prepare_lock = threading.Lock()
+
+    def __init__(self, uri, user, password, batch_size=DEFAULT_BATCH_SIZE, constraint_cyphers=None,
+                 queue_size=DEFAULT_QUEUE_SIZE, retry_time=DEFAULT_RETRY_TIME):
+        self.uri = uri
+        self.driver = GraphDatabase.driver(uri, auth=(user, password), max_transaction_retry_time=retry_time)
+        self.batch_size = batch_size
+        self.constraint_cyphers = [NODE_CONSTRAINT_CYPHER]
+        for cypher in constraint_cyphers or []:
+            if cypher not in self.constraint_cyphers:
+                self.constraint_cyphers.append(cypher)
+        self.pool = _WorkerPool(self.driver, queue_size)
+
+    def close(self):
+        self.pool.close()
+        self.driver.close()
+
+    def prepare(self):
+        """
+        Create the constraints (and their backing indexes) once per database
+        and wait until they are online. Each constraint is created once, so
+        ingestors with other `constraint_cyphers` still create theirs.
+        """
+        with Neo4jIngestor._prepare_lock:
+            keys = [(self.uri, "neo4j", cypher) for cypher in self.constraint_cyphers]
+            missing = [key for key in keys if key not in Neo4jIngestor._prepared]
+            if not missing:
+                return
+            with self.driver.session(database="neo4j") as session:
+                for _, _, cypher in missing:
+                    session.run(cypher).consume()
+                session.run('CALL db.awaitIndexes()').consume()
+            Neo4jIngestor._prepared.update(missing)
+
+    def ingest(self, items, callback_func, desc='', n_thread=1):
+        """
+        Ingest items with one cypher statement each.
+
+        Parameters:
+            - items: a list, or any iterator / generator of items.
+            - callback_func: maps an item into a cypher statement.
+            - desc: progress bar description.
+            - n_thread: number of pool workers to make available, and the most
+                tasks of this call written at once.
+        """
+        self.prepare()
+        total = len(items) if isinstance(items, Sized) else None
+        self._run_job(items, callback_func, desc, n_thread, Neo4jIngestor._ingest_item, total)
+
+    def ingest_batch(self, items, callback_func, desc='', n_thread=1, batch_size=None):
+        """
+        Ingest items with parameterized `UNWIND` templates.
+
+        Parameters:
+            - items: nodes or links to be ingested, as a list, a `GraphBuffer`
+                or any iterator / generator. Batches are built on the fly and streamed to the
+                workers, so conversion and writing overlap.
+            - callback_func: maps an item into a `(query, row)` tuple (see `iter_batches`).
+            - desc: progress bar description.
+            - n_thread: number of pool workers to make available, and the most
+                tasks of this call written at once.
+            - batch_size: rows per transaction, defaults to `self.batch_size`.
+        """
+        self.prepare()
+        batches = iter_batches(items, callback_func, batch_size or self.batch_size, n_partition=n_thread)
+        self._run_job(batches, None, desc, n_thread, Neo4jIngestor._ingest_rows)
+
+    def _run_job(self, items, callback_func, desc, n_thread, handle, total=None):
+        """
+        Feed `items` to the shared worker pool and wait until all of them are written.
+        Submitting blocks while the work queue is full, which throttles the producer.
+        """
+        self.pool.resize(n_thread)
+        job = _Job(desc, total, n_thread)
+        try:
+            for item in items:
+                if job.errors:
+                    break
+                self.pool.submit(job, handle, item, callback_func)
+        finally:
+            job.wait()
+        if job.errors:
+            raise job.errors[0]
+
+    @staticmethod
+    def _ingest_item(session, item, callback_func):
+        try:
+            query = callback_func(item)
+            if len(query.strip()) > 0:
+                session.run(query).consume()
+        except CypherSyntaxError:
+            query = callback_func(item, ignore_text_content=True)
+            if len(query.strip()) > 0:
+                session.run(query).consume()
+
+    @staticmethod
+    def _ingest_rows(session, batch, _):
+        """
+        Write one batch. Transient errors (deadlocks, lock timeouts) are retried
+        by the driver first; if the batch still fails it is split in halves,
+        which are retried on their own.
+        """
+        query, rows = batch
+        try:
+            session.execute_write(Neo4jIngestor._write_rows, query, rows)
+        except TransientError:
+            if len(rows) == 1:
+                raise
+            middle = len(rows) // 2
+            Neo4jIngestor._ingest_rows(session, (query, rows[:middle]), None)
+            Neo4jIngestor._ingest_rows(session, (query, rows[middle:]), None)
+
+    @staticmethod
+    def _write_rows(tx, query, rows):
+        tx.run(query, rows=rows).consume()
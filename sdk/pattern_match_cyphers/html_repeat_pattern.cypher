@@ -1,20 +1,9 @@
-MATCH 
-  (e1:Element)-[:CONTAINS]->(child1),
-  (e2:Element)-[:CONTAINS]->(child2),
-  (e3:Element)-[:CONTAINS]->(child3),
-  (e1)-[:IS_IN_FRONT_OF]->(e2),
-  (e2)-[:IS_IN_FRONT_OF]->(e3),
-  (child1)-[:HAS_ATTRIBUTE]->(attr1),
-  (child2)-[:HAS_ATTRIBUTE]->(attr2),
-  (child3)-[:HAS_ATTRIBUTE]->(attr3),
-  (parent:Element)-[:CONTAINS]->(e1),
-  (parent:Element)-[:CONTAINS]->(e2),
-  (parent:Element)-[:CONTAINS]->(e3)
-WHERE 
-  e1.tag = e2.tag AND e2.tag = e3.tag AND
-  child1.tag = child2.tag AND child2.tag = child3.tag AND
-  attr1.value = attr2.value AND attr2.value = attr3.value
-WITH parent
-MATCH path=(root:Element)-[:CONTAINS*]->(parent:Element)
+// Repeating parts of a page, detected while converting it with
+// `html_to_graph(..., repeats=True)` (see `HtmlGraphBuilder` in html2cypher.py):
+// every run of structurally identical siblings is a Pattern node.
+MATCH (parent:Element)-[:HAS_PATTERN]->(pattern:Pattern)
+WHERE pattern.count >= 3
 SET parent:Highlighted
-RETURN path
\ No newline at end of file
+WITH parent, pattern
+MATCH (pattern)-[:HAS_INSTANCE]->(item)
+RETURN parent, pattern, collect(item) AS items
@@ -4,291 +4,217 @@
 把endpoint與網頁輸入的網址做比對
 從最相關排到最不相關
 """
+import json
+import re
 from typing import List, Dict, Tuple
 from urllib.parse import unquote
-from requests.exceptions import JSONDecodeError
-from bs4 import BeautifulSoup
-from seleniumwire import webdriver
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
 import requests
-import threading 
-from neo4j import GraphDatabase
-from neo4j.exceptions import CypherSyntaxError
-import tqdm
 import uuid
 import os
 from urllib.parse import urlparse
 import ssl
-from html.parser import HTMLParser
-
-
-class ConfirmHTMLParser(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self.start_tags = list()
-        self.end_tags = list()
-        self.attributes = list()
-    
-    def is_text_html(self):
-        return len(self.start_tags) == len(self.end_tags)
-
-    def handle_starttag(self, tag, attrs):
-        self.start_tags.append(tag)
-        self.attributes.append(attrs)
+from neo4j_ingestor import Neo4jIngestor, NODE_LABEL, is_link, quote_label
+from graph_diff import ManifestStore, sync_graph
+from graph_buffer import GraphBuffer, drain
+from http_fetch import Fetcher, captured_body
+from http_cache import HttpCache
+from browser_pool import BrowserPool
+from capture_policy import CapturePolicy, DEFAULT_POLICY
+from html2cypher import (
+    HtmlGraphParser,
+    iter_html_stream_graph,
+    item_to_row as html_item_to_row,
+    node_to_record as html_node_to_record,
+    link_to_record as html_link_to_record,
+)
+
+
+def get_webpage_records(url: str, pool: BrowserPool = None, policy: CapturePolicy = DEFAULT_POLICY) -> List[Dict]:
+    """
+    Parameters:
+        - pool: browsers to load the page with (see browser_pool.py), otherwise
+            a headless browser is launched for this page only.
+        - policy: requests the browser may send and the ones recorded (see
+            capture_policy.py), by default no images, fonts, media, Google
+            or Facebook.
 
-    def handle_endtag(self, tag):
-        self.end_tags.append(tag)
+    Returns:
+        request recorded data. `response['body']` holds the decoded body the
+        browser received, or None when it is missing / truncated and has to
+        be fetched again by `collect_response_body`, and `policy` the
+        `CapturePolicy.to_dict()` the page was captured under.
+    """
+    capture = lambda driver, url: driver_records(driver, url, policy=policy)
+    if pool is not None:
+        return pool.run(capture, url)
+    with BrowserPool(size=1) as pool:
+        return pool.run(capture, url)
 
-    def handle_data(self, data):
-        pass
 
-def has_head_n_body(html_content):
-    soup = BeautifulSoup(html_content, 'html.parser')
-    
-    # Check for <head> and <body> tags
-    has_head = soup.head is not None
-    has_body = soup.body is not None
+def get_webpages_records(urls: List[str], pool: BrowserPool, policy: CapturePolicy = DEFAULT_POLICY) -> List[List[Dict]]:
+    """
+    `get_webpage_records` of several pages, loaded in parallel by all the browsers of `pool`.
 
-    return has_head and has_body
+    Returns:
+        the records of each page, in the order of `urls`.
+    """
+    return pool.map(lambda driver, url: driver_records(driver, url, policy=policy), urls)
 
 
-def get_webpage_records(url: str) -> List[Dict]:
+def driver_records(driver, url: str, policy: CapturePolicy = DEFAULT_POLICY) -> List[Dict]:
     """
-    Returns:
-        request recorded data
+    Load a page in a clean browser and record the requests it made, see `get_webpage_records`.
     """
-    driver = webdriver.Chrome(
-        service=Service(executable_path=ChromeDriverManager().install()),
-    )
+    policy.apply(driver)
+    driver.get(url)
+    # every record tells which policy it was captured under
+    policy_data = policy.to_dict()
     results = []
-    try:
-        driver.get(url)
-        for i, request in enumerate(driver.requests):
-            if request.response:
-                request.response.headers
-                if 'google' not in request.url and 'facebook' not in request.url and request.response.status_code == 200:
-                    print(f'REQUEST No.{i}', request.response.status_code, request.method, request.response.headers['Content-Type'])
-                    # body = decode(request.response.body, request.response.headers.get('Content-Encoding', 'identity')).decode('utf-8')
-                    results.append(
-                        {
-                            'id': i,
-                            'request': {
-                                'headers': dict(request.headers),
-                                'url': unquote(request.url),
-                                'method': request.method,
-                                'params': request.params
-                            },
-                            'response': {
-                                'status_code': request.response.status_code,
-                                'headers': dict(request.response.headers),
-                            }
-                        }
-                    )
-        return results
-    finally:
-        driver.close()
-
-def collect_response_body(records: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+    for i, request in enumerate(driver.requests):
+        if request.response:
+            # aborted requests are answered 403 by selenium-wire
+            if policy.allows(request.url, request.headers) and request.response.status_code == 200:
+                print(f'REQUEST No.{i}', request.response.status_code, request.method, request.response.headers['Content-Type'])
+                body = captured_body(
+                    request.method, request.response.status_code, request.response.headers, request.response.body)
+                results.append(
+                    {
+                        'id': i,
+                        'request': {
+                            'headers': dict(request.headers),
+                            'url': unquote(request.url),
+                            'method': request.method,
+                            'params': request.params
+                        },
+                        'response': {
+                            'status_code': request.response.status_code,
+                            'headers': dict(request.response.headers),
+                            'body': body,
+                        },
+                        'policy': policy_data,
+                    }
+                )
+    return results
+
+def collect_response_body(records: List[Dict], html_options: Dict = None, fetcher: Fetcher = None,
+                          refetch: bool = False) -> Tuple[List[Dict], List[Dict]]:
     """
-    Access the endpoint againt to get the response body
+    Get the response body of the endpoints
+
+    Bodies captured by the browser (`response['body']`, see
+    `get_webpage_records`) are used as they are. Only the endpoints without
+    one (or all of them with `refetch=True`) are accessed again, concurrently
+    through `fetcher` (see http_fetch.py: pooled sessions, per-host limits
+    and an optional total deadline), so collecting the bodies takes about as
+    long as the slowest host. Records are updated in place and keep their
+    capture order.
+
+    An HTML body is parsed once: the same pass checks that it is a page
+    (see `HtmlGraphParser.is_html`) and converts it into a graph with content
+    ids, kept as `(top-level ids, GraphBuffer)` in `response['graph']`.
+    `html_options` shape that graph, see `html2cypher.HtmlGraphBuilder`.
     """
+    if fetcher is None:
+        with Fetcher() as fetcher:
+            return collect_response_body(records, html_options=html_options, fetcher=fetcher, refetch=refetch)
+    to_fetch = []
     for i, record in enumerate(records):
-        url = record['request']['url']
-        method = record['request']['method']
+        body = record['response'].get('body')
+        if body is None or refetch:
+            to_fetch.append(i)
+            continue
+        headers = requests.structures.CaseInsensitiveDict(record['response']['headers'])
+        encoding = requests.utils.get_encoding_from_headers(headers) or 'utf-8'
         try:
-            res = requests.request(
-                url=url,
-                params=record['request']['params'] if record['request']['method'] == 'POST' else None,
-                method=method,
-                headers=record['request']['headers'],
-                timeout=10
-            )
+            text = body.decode(encoding, errors='replace')
+        except LookupError:
+            # unknown charset in the header
+            text = body.decode('utf-8', errors='replace')
+        data_type = set_response_data(
+            record, url=record['request']['url'], content=body, text=text, html_options=html_options,
+            content_type=headers.get('Content-Type'))
+        print(f"ENDPOINT No.{i} {data_type} {record['response']['status_code']} {record['request']['method']} captured from {record['request']['url']}")
+    requests_kwargs = [endpoint_request(records[i]) for i in to_fetch]
+    for j, res in fetcher.fetch_all(requests_kwargs):
+        i = to_fetch[j]
+        url = records[i]['request']['url']
+        method = records[i]['request']['method']
+        try:
+            if isinstance(res, BaseException):
+                raise res
             records[i]['response']['status_code_v2'] = res.status_code
-            try:
-                data = res.json()
-                data_type = 'json'
-            except JSONDecodeError as e:
-                data = res.content
-                text = res.text
-                parser = ConfirmHTMLParser()
-                parser.feed(text)
-                if parser.is_text_html() and has_head_n_body(text):
-                    data_type = 'html'
-                else:
-                    data_type = None
-            except BaseException as e:
-                data = None
-                data_type = None
-                raise e
+            data_type = set_response_data(
+                records[i], url=url, content=res.content, text=res.text, html_options=html_options,
+                content_type=res.headers.get('Content-Type'))
             print(f"ENDPOINT No.{i} {data_type} {res.status_code} {method} from {url}")
-        except (ssl.SSLCertVerificationError, requests.exceptions.SSLError, requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as e:
-            data = str(e)
-            data_type = None
-            print(f"ENDPOINT No.{i} {data_type} ssl error {method} from {url}")
-        finally:
-            records[i]['response']['data'] = data
-            records[i]['response']['data_type'] = data_type
+        except (ssl.SSLCertVerificationError, requests.exceptions.SSLError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            records[i]['response']['data'] = str(e)
+            records[i]['response']['data_type'] = None
+            print(f"ENDPOINT No.{i} None {type(e).__name__} {method} from {url}")
     return records
 
 
-def html_to_graph(html_content):
+def endpoint_request(record: Dict) -> Dict:
     """
-    Converts an HTML document into a graph representation using the specified Node Types and Link Types.
-
-    Parameters:
-        html_content (str): The HTML string to be converted.
-
-    Returns:
-        tuple: A tuple containing two lists:
-            - nodes: A list of dictionaries representing nodes.
-            - links: A list of dictionaries representing links.
+    Keyword arguments of `requests.request` accessing the endpoint of a record again.
     """
-    nodes = []
-    links = []
+    return {
+        'url': record['request']['url'],
+        'params': record['request']['params'] if record['request']['method'] == 'POST' else None,
+        'method': record['request']['method'],
+        'headers': record['request']['headers'],
+    }
 
-    def get_unique_node_id():
-        """Generates a unique node ID."""
-        return str(uuid.uuid4())
-
-    def get_unique_link_id():
-        """Generates a unique link ID."""
-        return str(uuid.uuid4())
-    
-    def connect_sequential_elements(element_ids):
-        """connect a sequence"""
-        nonlocal links
-        for i, element_id in enumerate(element_ids):
-            assert element_id is not None
-            if i > 0:
-                links.append({
-                    "id": get_unique_link_id(),
-                    "source": element_ids[i-1],
-                    "target": element_id,
-                    "type": "is_in_front_of"
-                })
-
-    def process_element(element, parent_id=None):
-        """Recursively processes an HTML element and its children."""
-        nonlocal nodes, links
-
-        if element.name:  # If it's an HTML tag
-            # Create a node for the element
-            element_id = get_unique_node_id()
-            nodes.append({
-                "id": element_id,
-                "tag": element.name,
-                "type": "Element",
-                "properties": {attr: element[attr] for attr in element.attrs}  # Add all attributes as properties
-            })
-
-            # If the element has a parent, create a "contains" link
-            if parent_id:
-                links.append({
-                    "id": get_unique_link_id(),
-                    "source": parent_id,
-                    "target": element_id,
-                    "type": "contains"
-                })
-
-            # Process attributes as separate nodes
-            for attr_name, attr_value in element.attrs.items():
-                attr_id = get_unique_node_id()
-                nodes.append({
-                    "id": attr_id,
-                    "name": attr_name.strip().replace('-', '_'),
-                    "value": attr_value,
-                    "type": "Attribute"
-                })
-                # Link the element to its attribute
-                links.append({
-                    "id": get_unique_link_id(),
-                    "source": element_id,
-                    "target": attr_id,
-                    "type": "has_attribute"
-                })
-
-            # Recursively process child elements
-            child_ids = []
-            for child in element.children:
-                child_id = process_element(child, element_id)
-                if child_id is not None:
-                    child_ids.append(child_id)
-            connect_sequential_elements(child_ids)
-            return element_id
-
-        elif element.string and element.string.strip():  # If it's text content
-            # Create a node for the text
-            text_id = get_unique_node_id()
-            nodes.append({
-                "id": text_id,
-                "content": element.string.strip(),
-                "type": "Text"
-            })
-
-            # Link the text node to its parent
-            if parent_id:
-                links.append({
-                    "id": get_unique_link_id(),
-                    "source": parent_id,
-                    "target": text_id,
-                    "type": "contains"
-                })
-            return text_id
-    soup = BeautifulSoup(html_content, "html.parser")
-    # Process each top-level element
-    element_ids = []
-    for element in soup.contents:
-        element_id = process_element(element)
-        if element_id is not None:
-            element_ids.append(element_id)
-    # Connect element one after another
-    connect_sequential_elements(element_ids)
-    return element_ids, nodes, links
-
-
-def html_node_to_cypher(node, ignore_text_content=False) -> str:
-    """
-    Converts graph nodes into Cypher queries for Neo4j.
 
-    Parameters:
-        nodes (list): A list of dictionaries representing nodes.
+# media types which are never a page, whatever the body looks like
+NON_HTML_CONTENT_TYPES = re.compile(
+    r'^\s*(text/(css|javascript|plain|csv)|application/(javascript|x-javascript|ecmascript|octet-stream|pdf|wasm)'
+    r'|image/|font/|audio/|video/)', re.IGNORECASE)
+_HTML_START = re.compile(r'<(!doctype\s+html|html|head|body)[\s>/]', re.IGNORECASE)
 
-    Returns:
-        str: A string containing the Cypher queries.
+
+def looks_like_html(text: str, content_type: str = None) -> bool:
     """
-    if node["type"] == "Element":
-        # Flatten properties for Element nodes
-        tag = node['tag']
-        assert isinstance(tag, str)
-        assert tag != ''
-        query = f"CREATE (n:Element:{tag.upper()} {{id: '{node['id']}', tag: '{tag}'"
-        query += '}'
-        query += ")"
-
-    elif node["type"] == "Attribute":
-        value = node.get('value', '')
-        value_str = f'"{value}"'
-        query = f"CREATE (n:Attribute:{node.get('name', '')} {{id: '{node['id']}', value: {value_str}}})"
-
-    elif node["type"] == "Text":
-        if ignore_text_content:
-            node_content = '[CANNOT ATTACH TO CYPHER]'
-        else:
-            node_content = node.get('content', '')
-            node_content = node_content.replace('\n', '\\n').replace('"', "'")
-        id = node['id']
-        query = f'CREATE (n:Text {{id: "{id}", content: "{node_content}"}})'
-    else:
-        raise ValueError('node is not Text/Attribute/Element')
-    return query
+    Cheap check, before a body is converted: no non-HTML `Content-Type`, no
+    NUL (binaries decoded as text) and an `<html>`, `<head>`, `<body>` or
+    doctype tag near the start. The conversion still confirms it is a page.
+    """
+    if content_type and NON_HTML_CONTENT_TYPES.match(content_type):
+        return False
+    start = text[:2048]
+    return '\x00' not in start and _HTML_START.search(start) is not None
 
 
-def html_link_to_cypher(link) -> str:
-    query = f"MATCH (a {{id: '{link['source']}'}}), (b {{id: '{link['target']}'}}) CREATE (a)-[:{link['type'].upper()}]->(b)"
-    return query
+def set_response_data(record: Dict, url: str, content: bytes, text: str, html_options: Dict = None,
+                      content_type: str = None) -> str:
+    """
+    Classify a response body and keep it in `response['data']` / `response['data_type']`:
+    'json' (parsed data), 'html' (raw body, plus `response['graph']`) or None.
+    Only bodies passing `looks_like_html` are converted into a graph.
 
-def webpage_to_graph(url):
+    Returns:
+        the data type
+    """
+    try:
+        data = json.loads(text)
+        data_type = 'json'
+    except ValueError:
+        data = content
+        data_type = None
+    if data_type is None and looks_like_html(text, content_type):
+        graph = GraphBuffer()
+        graph_parser = HtmlGraphParser(id_mode='content', source=url, buffer=graph, **(html_options or {}))
+        top_ids = drain(iter_html_stream_graph(text, graph_parser=graph_parser))
+        if graph_parser.is_html():
+            data_type = 'html'
+            record['response']['graph'] = (top_ids, graph)
+    record['response']['data'] = data
+    record['response']['data_type'] = data_type
+    return data_type
+
+
+def webpage_to_graph(url, cache: HttpCache = None, fetcher: Fetcher = None, pool: BrowserPool = None,
+                     policy: CapturePolicy = DEFAULT_POLICY):
     """
     Converts a JSON object into a graph representation with specific node and link types.
 
@@ -300,14 +226,33 @@ def webpage_to_graph(url):
             - nodes: A list of dictionaries representing the nodes.
             - links: A list of dictionaries representing the links.
 
+    With a `cache` (see http_cache.py), the browser capture and the bodies
+    are kept on disk: endpoints are revalidated rather than downloaded again,
+    and with `HttpCache(..., mode='replay')` the page is rebuilt offline from
+    its last capture. A `pool` (see browser_pool.py) saves launching a
+    browser for every page, and `policy` (see capture_policy.py) restricts
+    what the browser loads, the policy being kept with the capture.
+
     NOTE: Develop Prompt: https://poe.com/s/cUix9NxAto7NEDvaPaYe
     """
     endpoint_nodes = []
     domain_nodes = []
     links = []
 
-    records = get_webpage_records(url)
-    collect_response_body(records)
+    if cache is not None and cache.mode == 'replay':
+        records = cache.load_capture(url)
+    else:
+        records = get_webpage_records(url, pool=pool, policy=policy)
+        if cache is not None:
+            cache.save_capture(url, records)
+            for record in records:
+                if record['response']['body'] is not None and record['response']['status_code'] == 200:
+                    cache.store(endpoint_request(record), 200, record['response']['headers'], record['response']['body'])
+    if fetcher is None:
+        with Fetcher(cache=cache) as fetcher:
+            collect_response_body(records, fetcher=fetcher)
+    else:
+        collect_response_body(records, fetcher=fetcher)
     for record in records:
         endpoint_id = str(uuid.uuid4())
         url = record['request']['url']
@@ -320,7 +265,8 @@ def webpage_to_graph(url):
                 'method': record['request']['method'],
                 'data_type': record['response']['data_type'],
                 'type': 'Endpoint',
-                'data': record['response']['data']
+                'data': record['response']['data'],
+                'graph': record['response'].get('graph')
             }
         )
         domain = urlparse(url).netloc
@@ -341,73 +287,25 @@ def webpage_to_graph(url):
     return endpoint_nodes, domain_nodes, links
 
 
-def split_list_into_n_parts(lst, n):
+def webpage_node_to_record(x):
     """
-    Splits a list into n sublists as evenly as possible.
-    
-    Args:
-    lst (list): The list to be split.
-    n (int): The number of sublists to create.
-    
-    Returns:
-    list of lists: A list containing n sublists.
+    Labels and properties of the Endpoint / Domain nodes of `webpage_to_graph`
+    for the file exporters (see bulk_export.py), matching `endpoint2cypher`.
     """
-    # If n is larger than the list length, we can only return actual list elements
-    if n > len(lst):
-        return [lst[i:i + 1] for i in range(len(lst))] + [[] for _ in range(n - len(lst))]
-
-    # Calculate the size of each part: the minimum size of sublists
-    part_size, remainder = divmod(len(lst), n)
-
-    # Create the sublists
-    sublists = []
-    start = 0
-    for i in range(n):
-        # Add an extra element to some sublists to distribute the remainder
-        end = start + part_size + (1 if i < remainder else 0)
-        sublists.append(lst[start:end])
-        start = end
-
-    return sublists
-
-class Neo4jIngestor:
-    def __init__(self, uri, user, password):
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
-
-    def close(self):
-        self.driver.close()
-
-    def ingest(self, items, callback_func, desc='', n_thread=1):
-        if n_thread == 1:
-            args = self.driver, items, callback_func, desc
-            t1 = threading.Thread(target=Neo4jIngestor._ingest_single_thread, args=args)
-            t1.setDaemon(True)
-            t1.start()
-            t1.join()
-        else:
-            threads = []
-            for i, items_part in enumerate(split_list_into_n_parts(items, n_thread)):
-                args = self.driver, items_part, callback_func, desc + '.' + str(i)
-                t1 = threading.Thread(target=Neo4jIngestor._ingest_single_thread, args=args)
-                t1.setDaemon(True)
-                threads.append(t1)
-                t1.start()
-            for t1 in threads:
-                t1.join()
-        
-    def _ingest_single_thread(*args):
-        driver, items, callback_func, desc = args
-        with driver.session(database="neo4j") as session:
-            for item in tqdm.tqdm(items, desc=desc):
-                try:
-                    query = callback_func(item)
-                    if len(query.strip()) > 0:
-                        session.run(query)
-                except CypherSyntaxError:
-                    query = callback_func(item, ignore_text_content=True)
-                    if len(query.strip()) > 0:
-                        session.run(query)
-
+    if x['type'] == 'Domain':
+        return ['Domain'], {'id': x['id']}
+    labels = [x['type'], x['method']]
+    if x['extension']:
+        extension = x['extension'].replace('.', '')
+        if len(extension) > 0 and extension[0].isalpha():
+            labels.append(extension.upper())
+    return labels, {
+        'id': x['id'],
+        'path': x['path'],
+        'url': x['url'],
+        'extension': x['extension'],
+        'data_type': x['data_type'] or ''
+    }
 
 def endpoint2cypher(x):
     extension_label = ''
@@ -478,55 +376,97 @@ def has_response_type2cypher(x):
 
 
 
+# labels of the (source, target) nodes of each link type of `webpage_items`
+WEBPAGE_LINK_ENDS = {
+    'has_endpoint': ('Domain', 'Endpoint'),
+    'has_extension': ('Endpoint', 'Extension'),
+    'has_response': ('Endpoint', 'ResponseType'),
+    'has_html': ('Endpoint', NODE_LABEL),
+}
+
+
+def webpage_items(endpoint_nodes, domain_nodes, links):
+    """
+    Nodes and links of `webpage_to_graph`, plus the Extension / ResponseType
+    nodes of the endpoints (once each) and their `has_extension` /
+    `has_response` links, as written by `endpoint2cypher` & co.
+
+    Returns:
+        tuple: (nodes, links), for `webpage_item_to_row`.
+    """
+    nodes = {}
+    lookup_links = []
+    for x in domain_nodes + endpoint_nodes:
+        nodes.setdefault(x['id'], x)
+    for x in endpoint_nodes:
+        labels, _ = webpage_node_to_record(x)
+        if len(labels) > 2:
+            nodes.setdefault(('Extension', labels[2]), {'id': labels[2], 'type': 'Extension'})
+            lookup_links.append({'source': x['id'], 'target': labels[2], 'type': 'has_extension'})
+        if x['data_type']:
+            data_type_label = x['data_type'].upper()
+            nodes.setdefault(('ResponseType', data_type_label), {'id': data_type_label, 'type': 'ResponseType'})
+            if not x['data_type'].startswith('has'):
+                lookup_links.append({'source': x['id'], 'target': data_type_label, 'type': 'has_response'})
+    return list(nodes.values()), links + lookup_links
+
+
+def webpage_item_to_row(item):
+    """
+    Batch counterpart of `endpoint2cypher` & co. for `Neo4jIngestor.ingest_batch`,
+    mapping the nodes and links of `webpage_items` into a `(query, row)` tuple.
+    Everything is MERGEd, so a page crawled again adds no duplicates. Links
+    MATCH their nodes, so the nodes have to be ingested first.
+    """
+    if is_link(item):
+        source_label, target_label = WEBPAGE_LINK_ENDS[item['type']]
+        query = (
+            "UNWIND $rows AS row "
+            f"MATCH (f:{source_label} {{id: row.source}}) "
+            f"MATCH (t:{target_label} {{id: row.target}}) "
+            f"MERGE (f)-[:{quote_label(item['type'])}]->(t)"
+        )
+        return query, {'source': item['source'], 'target': item['target']}
+    if item['type'] in ('Extension', 'ResponseType'):
+        return f"UNWIND $rows AS row MERGE (n:{item['type']} {{id: row.id}})", {'id': item['id']}
+    labels, row = webpage_node_to_record(item)
+    query = f"UNWIND $rows AS row MERGE (n:{quote_label(labels[0])} {{id: row.id}}) SET n += row"
+    if len(labels) > 1:
+        query += ', n:' + ':'.join(quote_label(label) for label in labels[1:])
+    return query, row
+
+
 node_types = ['Domain', 'Endpoint', 'ResponseType', 'Extension']
 
 if __name__ == '__main__':
     n_thread = 16
     url = "https://www.cmoney.tw/finance/6916/f00036"
     endpoint_nodes, domain_nodes, domain_endpoint_links = webpage_to_graph(url)
-    conn = Neo4jIngestor("neo4j://localhost:7687", "neo4j", "neo4j")
+    conn = Neo4jIngestor("neo4j://localhost:7687", "neo4j", "neo4j", constraint_cyphers=[
+        f'CREATE CONSTRAINT unique_id_for_{node_type.lower()} IF NOT EXISTS FOR (n:{node_type}) REQUIRE n.id IS UNIQUE;'
+        for node_type in node_types
+    ])
+    manifests = ManifestStore('manifests')
     try:
-        conn.ingest(node_types, 
-                    lambda node_type: f'CREATE CONSTRAINT unique_id_for_{node_type.lower()} IF NOT EXISTS FOR (n:{node_type}) REQUIRE n.id IS UNIQUE;', 
-                    desc='node_constraint'
-        )
-        conn.ingest(endpoint_nodes, 
-                    endpoint2cypher, 
-                    desc='endpoints', n_thread=n_thread)
-        conn.ingest(endpoint_nodes, 
-                    response_type2cypher, 
-                    desc='response_type', n_thread=n_thread)
-        conn.ingest(endpoint_nodes, 
-                    extension2cypher, 
-                    desc='extension', n_thread=n_thread)
-        conn.ingest(endpoint_nodes, 
-                    has_extension2cypher, 
-                    desc='has_extension', n_thread=n_thread)
-        conn.ingest(endpoint_nodes, 
-                    has_response_type2cypher, 
-                    desc='has_response_type', n_thread=n_thread)
-        conn.ingest(domain_nodes, 
-                    lambda x: f'MERGE (n:{x["type"]} {{id: "{x["id"]}"}});', 
-                    desc='domain', n_thread=n_thread)
-        conn.ingest(domain_endpoint_links, 
-                    lambda x: f'MATCH (f:Domain {{id: "{x["source"]}"}}) MATCH (t:Endpoint {{id: "{x["target"]}"}}) CREATE (f)-[:has_endpoint]->(t);'
-                    , desc='domain_endpoint_links', n_thread=n_thread)
+        webpage_nodes, webpage_links = webpage_items(endpoint_nodes, domain_nodes, domain_endpoint_links)
+        conn.ingest_batch(webpage_nodes, webpage_item_to_row, desc='webpage_nodes', n_thread=n_thread)
         html_endpoint_links = []
         for endpoint_node in endpoint_nodes:
             if endpoint_node['data_type'] == 'html':
-                top_ids, html_nodes, html_links = html_to_graph(endpoint_node['data'])
-                print(f'#html node: {len(html_nodes)} & #html link: {len(html_links)}')
-                conn.ingest(html_nodes, html_node_to_cypher, desc='nodes', n_thread=n_thread)
-                conn.ingest(html_links, html_link_to_cypher, desc='links', n_thread=n_thread)
+                # content ids + manifest: only what changed since the last crawl is written
+                top_ids, html_graph = endpoint_node['graph']
+                print(f'#html node: {html_graph.node_count} & #html link: {html_graph.link_count}')
+                diff = sync_graph(conn, manifests, endpoint_node['url'], html_graph.nodes, html_graph.links,
+                                  html_item_to_row, html_node_to_record, html_link_to_record, n_thread=n_thread)
+                print(diff)
                 for top_id in top_ids:
                     html_endpoint_links.append(
                         {
                             'source': endpoint_node['id'],
-                            'target': top_id
+                            'target': top_id,
+                            'type': 'has_html'
                         }
                     )
-        conn.ingest(html_endpoint_links, 
-            lambda x: f'MATCH (f:Endpoint {{id: "{x["source"]}"}}) MATCH (t {{id: "{x["target"]}"}}) CREATE (f)-[:has_html]->(t);'
-            , desc='has_html_link', n_thread=n_thread)
+        conn.ingest_batch(webpage_links + html_endpoint_links, webpage_item_to_row, desc='webpage_links', n_thread=n_thread)
     finally:
-        conn.close()
\ No newline at end of file
+        conn.close()
@@ -0,0 +1,70 @@
+"""
+Stability of the 'content' ids of html2cypher (see `HtmlPathPlanner`): the
+number of nodes / links `graph_diff.sync_graph` has to write when a page
+changes.
+
+Run from sdk/:
+    python -m pytest -q test_html_content_ids.py
+"""
+import os
+import pytest
+from html2cypher import html_to_graph, iter_html_stream_graph
+from neo4j_ingestor import collect_graph
+
+EXAMPLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example.html')
+BACKENDS = ('html.parser', 'stream')
+TABLE = '<html><head><title>NAV</title></head><body><table class="nav">{}</table></body></html>'
+ROWS = ''.join(f'<tr><td>2024/01/{day:02d}</td><td>{10 + day / 10}</td></tr>' for day in range(1, 31))
+NEW_ROW = '<tr><td>2024/02/01</td><td>13.1</td></tr>'
+
+
+def ids(html_content, backend):
+    if backend == 'stream':
+        _, nodes, links = collect_graph(iter_html_stream_graph(html_content, id_mode='content', source='test'))
+    else:
+        nodes, links = html_to_graph(html_content, id_mode='content', source='test', parser=backend)
+    return {node['id'] for node in nodes}, {link['id'] for link in links}
+
+
+def diff_size(old_html, new_html, backend):
+    """(nodes added, nodes removed, links added, links removed)"""
+    (old_nodes, old_links), (new_nodes, new_links) = ids(old_html, backend), ids(new_html, backend)
+    return len(new_nodes - old_nodes), len(old_nodes - new_nodes), len(new_links - old_links), len(old_links - new_links)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_prepended_row_keeps_the_other_rows(backend):
+    # the row, its 2 cells and their 2 texts; 5 `contains` and 2 `is_in_front_of` links
+    assert diff_size(TABLE.format(ROWS), TABLE.format(NEW_ROW + ROWS), backend) == (5, 0, 7, 0)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_appended_row_keeps_the_other_rows(backend):
+    assert diff_size(TABLE.format(ROWS), TABLE.format(ROWS + NEW_ROW), backend) == (5, 0, 7, 0)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_changed_value_rewrites_its_row(backend):
+    # like a changed list item in json2cypher, the whole row gets new ids
+    changed = ROWS.replace('<td>10.5</td>', '<td>10.6</td>')
+    assert diff_size(TABLE.format(ROWS), TABLE.format(changed), backend) == (5, 5, 8, 8)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_element_inserted_at_the_top_of_the_body(backend):
+    with open(EXAMPLE_PATH, 'r', encoding='utf-8') as f:
+        html_content = f.read()
+    body = html_content.find('>', html_content.find('<body')) + 1
+    inserted = html_content[:body] + '<div>new</div>' + html_content[body:]
+    # the div and its text; their `contains` links and the `is_in_front_of` link to the next sibling
+    assert diff_size(html_content, inserted, backend) == (2, 0, 3, 0)
+
+
+def test_chunks_keep_positional_paths():
+    # chunks are only seen once, so a prepended row shifts the ids of the others
+    def chunked(html_content):
+        return (html_content[i:i + 100] for i in range(0, len(html_content), 100))
+
+    _, old_nodes, _ = collect_graph(iter_html_stream_graph(chunked(TABLE.format(ROWS)), id_mode='content'))
+    _, new_nodes, _ = collect_graph(iter_html_stream_graph(chunked(TABLE.format(NEW_ROW + ROWS)), id_mode='content'))
+    assert len({node['id'] for node in new_nodes} - {node['id'] for node in old_nodes}) > 5
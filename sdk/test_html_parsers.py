@@ -0,0 +1,113 @@
+"""
+Conformance of the HTML parser backends of html2cypher.
+
+`html_to_graph(..., parser='lxml')`, `parser='html.parser'` and the single
+pass `HtmlGraphParser` must give the same graph (same content ids) for
+well-formed pages. Where markup has to be repaired they differ, and the
+differences are pinned below.
+
+Run from sdk/:
+    python -m pytest -q test_html_parsers.py
+"""
+import os
+import pytest
+from html2cypher import HtmlGraphParser, html_to_graph, iter_html_stream_graph
+from neo4j_ingestor import collect_graph
+
+pytest.importorskip('lxml')
+
+EXAMPLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example.html')
+BACKENDS = ('lxml', 'html.parser', 'stream')
+
+
+def convert(html_content, backend):
+    if backend == 'stream':
+        graph_parser = HtmlGraphParser(id_mode='content', source='test')
+        _, nodes, links = collect_graph(iter_html_stream_graph(html_content, graph_parser=graph_parser))
+        return nodes, links
+    return html_to_graph(html_content, id_mode='content', source='test', parser=backend)
+
+
+def graph_key(nodes, links):
+    """Everything the backends must agree on, independent of the emission order."""
+    return (
+        sorted(node['id'] for node in nodes),
+        sorted((link['source'], link['target'], link['type'], link['id']) for link in links),
+    )
+
+
+def outline(nodes, links):
+    """The element / text tree of a graph, e.g. `div(p('a') p('b'))`."""
+    by_id = {node['id']: node for node in nodes}
+    children = {}
+    contained = set()
+    for link in links:
+        if link['type'] == 'contains':
+            children.setdefault(link['source'], []).append(link['target'])
+            contained.add(link['target'])
+
+    def show(node_id):
+        node = by_id[node_id]
+        label = node['tag'] if node['type'] == 'Element' else repr(node.get('content'))
+        if node_id not in children:
+            return label
+        return label + '(' + ' '.join(show(child) for child in children[node_id]) + ')'
+
+    return ' '.join(
+        show(node['id']) for node in nodes if node['id'] not in contained and node['type'] != 'Attribute')
+
+
+def test_example_page_gives_the_same_graph_on_every_backend():
+    with open(EXAMPLE_PATH, 'r', encoding='utf-8') as f:
+        html_content = f.read()
+    graphs = {backend: convert(html_content, backend) for backend in BACKENDS}
+    assert graphs['lxml'][0]
+    assert graph_key(*graphs['lxml']) == graph_key(*graphs['html.parser'])
+    assert graph_key(*graphs['html.parser']) == graph_key(*graphs['stream'])
+
+
+@pytest.mark.parametrize('html_content', [
+    '<html><head><title>t</title></head><body><p>a</p><br><img src="x"></body></html>',
+    '<html><body><table><tr><td>1</table></body></html>',
+    # misnested inline tags are closed the same way
+    '<html><body><b><i>x</b>y</i></body></html>',
+    '<!DOCTYPE html>\n<html lang="zh-TW"><body><a href="/?a=1&amp;b=2">&lt;&#x4e2d;&gt;</a></body></html>\n',
+])
+def test_repairs_shared_by_every_backend(html_content):
+    graphs = [convert(html_content, backend) for backend in BACKENDS]
+    assert graph_key(*graphs[0]) == graph_key(*graphs[1]) == graph_key(*graphs[2])
+
+
+@pytest.mark.parametrize('html_content, lxml_outline, html_parser_outline', [
+    # libxml2 closes the implied end tag of <p> / <li>, html.parser nests the next one
+    ('<html><body><div><p>a<p>b</div></body></html>',
+     "html(body(div(p('a') p('b'))))",
+     "html(body(div(p('a' p('b')))))"),
+    ('<html><body><ul><li>a<li>b</ul></body></html>',
+     "html(body(ul(li('a') li('b'))))",
+     "html(body(ul(li('a' li('b')))))"),
+    # libxml2 wraps a fragment into <html><body>
+    ('<p>x</p>',
+     "html(body(p('x')))",
+     "p('x')"),
+    # libxml2 drops a stray end tag and joins the text around it
+    ('<html><body><div>a</span>b</div></body></html>',
+     "html(body(div('ab')))",
+     "html(body(div('a' 'b')))"),
+])
+def test_known_differences_on_malformed_markup(html_content, lxml_outline, html_parser_outline):
+    assert outline(*convert(html_content, 'lxml')) == lxml_outline
+    assert outline(*convert(html_content, 'html.parser')) == html_parser_outline
+    # the single pass parser follows html.parser
+    assert graph_key(*convert(html_content, 'stream')) == graph_key(*convert(html_content, 'html.parser'))
+
+
+@pytest.mark.parametrize('html_content', [
+    '<html><body><div><p>a<p>b</div></body></html>',
+    '<p>x</p>',
+    '<html><body><table><tr><td>1</td></tr></table></body></html>',
+])
+def test_default_parser_is_html_parser(html_content):
+    # lxml is opt-in, so the graphs of existing callers do not change with it being installed
+    default = html_to_graph(html_content, id_mode='content', source='test')
+    assert graph_key(*default) == graph_key(*convert(html_content, 'html.parser'))
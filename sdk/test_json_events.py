@@ -0,0 +1,68 @@
+"""
+The pure Python tokenizer of json_events.py against `json.loads`.
+
+Run from sdk/:
+    python -m pytest -q test_json_events.py
+"""
+import io
+import json
+import pytest
+from json_events import iter_json_events
+
+DOCUMENTS = [
+    '{"name": "基金淨值", "nav": [10.5, -2, 3e2, true, false, null], "ok": {}}',
+    '[{"é": "ü\\u00e9\\"", "emoji": "😀"}, [], [[]], ""]',
+    '"中文"',
+    '0',
+]
+
+
+def build(events):
+    """The value of a stream of events."""
+    stack = [[]]
+    keys = []
+    for event, value in events:
+        if event in ('start_map', 'start_array'):
+            stack.append({} if event == 'start_map' else [])
+        elif event == 'map_key':
+            keys.append(value)
+        else:
+            if event in ('end_map', 'end_array'):
+                value = stack.pop()
+            parent = stack[-1]
+            if isinstance(parent, dict):
+                parent[keys.pop()] = value
+            else:
+                parent.append(value)
+    return stack[0][0]
+
+
+@pytest.mark.parametrize('document', DOCUMENTS)
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 64 * 1024])
+def test_bytes_read_in_short_chunks(document, chunk_size):
+    # a 1 byte read ends inside every multi-byte UTF-8 character
+    stream = io.BytesIO(document.encode('utf-8'))
+    assert build(iter_json_events(stream, chunk_size=chunk_size, use_ijson=False)) == json.loads(document)
+
+
+@pytest.mark.parametrize('document', DOCUMENTS)
+def test_text_stream(document):
+    stream = io.StringIO(document)
+    assert build(iter_json_events(stream, chunk_size=1, use_ijson=False)) == json.loads(document)
+
+
+@pytest.mark.parametrize('document', [
+    '{1: 2}', '[1 2]', '{"a" 1}', '{"a": 1 "b": 2}', '[1,]', '{"a": 1,}', '[, 1]', '{"a": }',
+    '{: 1}', '{"a": 1]', '[1}', '1 2', '{} []', '', '[1', '"a" : 1', '[1:2]',
+])
+def test_invalid_documents(document):
+    with pytest.raises(ValueError):
+        json.loads(document)
+    with pytest.raises(ValueError):
+        list(iter_json_events(io.BytesIO(document.encode('utf-8')), chunk_size=1, use_ijson=False))
+
+
+def test_truncated_character():
+    stream = io.BytesIO('"中"'.encode('utf-8')[:-2])
+    with pytest.raises(ValueError):
+        list(iter_json_events(stream, chunk_size=1, use_ijson=False))